@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import sys
+from multiprocessing import Pool
+from timeit import default_timer as time
+
+import loader
+from instrument import Probe
+from planner import Planner, compile_recipes
+from simulator import Simulator
+
+# Plans a stream of problems in one go. Each input line is a JSON object with the problem's 'Initial' inventory and
+# 'Goal', and optionally an 'id', its own time 'limit' in seconds, and a 'recipes' path to a crafting file whose Items
+# and Recipes replace the default ones for that problem. Results are written as they finish, one JSON line per problem:
+#   {"id": ..., "plan": [action, ...], "cost": ..., "states": ..., "time": ..., "valid": ...}
+# with "plan" and "cost" null when no plan was found in time, or {"id": ..., "error": ...} for a bad problem. "valid"
+# says whether the plan replays to the goal (see simulator.py), null without a plan. With --search anytime each result
+# also has the suboptimality "bound" of its plan, null unless the heuristic is admissible (see Planner.plan), and with
+# --profile a "profile" with the counters and timers of an instrument.Probe.
+#
+#   python batch_planner.py problems.jsonl --recipes Crafting.json --workers 8 > plans.jsonl
+#   cat problems.jsonl | python batch_planner.py
+
+_default = None             #the Crafting dict the workers plan with when a problem has no 'recipes'
+_options = {}               #Planner options
+_limit = 30                 #seconds allowed per problem, unless the problem sets its own 'limit'
+_profile = False            #whether results get the probe's counters and timers
+_loaded = {}                #recipes path -> Crafting dict, per worker
+
+
+def init_worker(Crafting, options, limit, profile=False):
+    # Runs once in each worker. The default recipes are compiled here, once per process (with fork they were already
+    # compiled by the parent, so this is a cache hit), and every problem after that reuses them
+    global _default, _options, _limit, _profile
+    #the searches print as they go, which would only end up in the results
+    sys.stdout = open(os.devnull, 'w')
+    _default = Crafting
+    _options = options
+    _limit = limit
+    _profile = profile
+    compile_recipes(Crafting['Items'], Crafting['Recipes'])
+
+
+def load_crafting(path):
+    if path not in _loaded:
+        _loaded[path] = loader.load_crafting(path)
+    return _loaded[path]
+
+
+def solve(job):
+    # Plans one problem in a worker. job is (line number, problem dict), and the result is the dict written out for it
+    number, problem = job
+    #a line that is valid JSON but not an object still gets its own error, instead of failing the batch
+    if not isinstance(problem, dict):
+        return {'id': number, 'error': 'a problem should be an object, not ' + type(problem).__name__}
+    result = {'id': number}
+    start_time = time()
+    try:
+        result['id'] = problem.get('id', number)
+        if 'error' in problem:
+            result['error'] = problem['error']
+            return result
+        Crafting = load_crafting(problem['recipes']) if 'recipes' in problem else _default
+        planner = Planner.from_crafting(Crafting, **_options)
+        stats = {}
+        probe = Probe() if _profile else None
+        #a problem may ask for its own time limit
+        plan = planner.plan(problem.get('Initial', {}), problem['Goal'], problem.get('limit', _limit), stats=stats,
+                            probe=probe)
+        result['plan'] = [action for state, action in plan[:-1]] if plan else None
+        result['cost'] = sum(Crafting['Recipes'][action]['Time'] for action in result['plan']) if plan else None
+        result['states'] = stats.get('states')
+        if 'bound' in stats:
+            result['bound'] = stats['bound']
+        result['time'] = time() - start_time
+        result['valid'] = Simulator(planner.compiled.table).run(plan, problem.get('Initial', {}),
+                                                                problem['Goal']).goal_met if plan else None
+    except Exception as e:
+        return {'id': result['id'], 'error': repr(e)}
+    if probe is not None:
+        report = probe.report()
+        result['profile'] = {'counters': report['counters'], 'timers': report['timers']}
+    return result
+
+
+def read_problems(lines):
+    # (line number, problem) for each non-blank line. Lines that aren't valid JSON are passed on as errors, so they
+    # still get a result line
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            yield number, {'error': 'bad JSON: ' + str(e)}
+
+
+def batch_plan(problems, Crafting, workers=None, limit=30, profile=False, **options):
+    # Plans every (line number, problem) pair across a pool of worker processes, yielding results as they finish. The
+    # recipes are compiled before the pool starts, so forked workers share the compiled copy
+    compile_recipes(Crafting['Items'], Crafting['Recipes'])
+    with Pool(workers, initializer=init_worker, initargs=(Crafting, options, limit, profile)) as pool:
+        for result in pool.imap_unordered(solve, problems):
+            yield result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan a JSONL stream of crafting problems.')
+    parser.add_argument('problems', nargs='?', help='JSONL file of problems (default: stdin)')
+    parser.add_argument('--recipes', default='Crafting.json', help='crafting file with the default Items and Recipes')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--limit', type=float, default=30, help='seconds allowed per problem')
+    parser.add_argument('--heuristic', default='priority', choices=['priority', 'hand_tuned', 'relaxed', 'pattern'])
+    parser.add_argument('--search', default='astar', choices=['astar', 'anytime', 'bounded', 'regression',
+                                                                     'hierarchical', 'bulk'])
+    parser.add_argument('--no-macros', action='store_true', help='search over the primitive recipes')
+    parser.add_argument('--node-budget', type=int, default=100000, help='states kept in memory by --search bounded')
+    parser.add_argument('--profile', action='store_true', help='add counters and timers to every result')
+    args = parser.parse_args()
+
+    Crafting = load_crafting(args.recipes)
+    lines = open(args.problems) if args.problems else sys.stdin
+    options = {'heuristic': args.heuristic, 'search': args.search, 'macros': not args.no_macros,
+               'node_budget': args.node_budget}
+    for result in batch_plan(read_problems(lines), Crafting, args.workers, args.limit, args.profile, **options):
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
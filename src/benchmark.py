@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import resource
+import sys
+from multiprocessing import get_context
+from queue import Empty
+from timeit import default_timer as time
+
+import craft_planner_modified as modified
+from loader import load_crafting
+from planner import Planner
+from simulator import check_plan
+
+# Benchmarks the planners on a fixed corpus of problems and checks them against a stored baseline. Every run happens in
+# a fresh process, so the peak memory of one run doesn't carry over into the next, and the searches' printing goes to
+# devnull so it isn't timed. For each variant and problem this records the wall time, states visited, states per
+# second, peak memory (max RSS of the process, in KB) and plan cost, and whether the plan replays to the goal (see
+# simulator.py).
+#
+#   python benchmark.py                 run everything and compare against benchmark_baseline.json
+#   python benchmark.py --update        run everything and store the results as the new baseline
+#
+# Times depend on the machine, so the baseline should be updated on the machine the benchmark is run on.
+
+# Problems are run with the recipes from the --recipes crafting file
+CORPUS = [
+    {'name': 'cart rail20', 'Initial': {}, 'Goal': {'cart': 1, 'rail': 20}},
+    {'name': 'cart2 rail32 iron_axe', 'Initial': {}, 'Goal': {'cart': 2, 'rail': 32, 'iron_axe': 1}},
+    {'name': 'bench', 'Initial': {}, 'Goal': {'bench': 1}},
+    {'name': 'wooden_pickaxe', 'Initial': {}, 'Goal': {'wooden_pickaxe': 1}},
+    {'name': 'stone_pickaxe', 'Initial': {}, 'Goal': {'stone_pickaxe': 1}},
+    {'name': 'furnace', 'Initial': {}, 'Goal': {'furnace': 1}},
+    {'name': 'iron_pickaxe', 'Initial': {}, 'Goal': {'iron_pickaxe': 1}},
+    {'name': 'rail64', 'Initial': {}, 'Goal': {'rail': 64}},
+    {'name': 'cart4', 'Initial': {}, 'Goal': {'cart': 4}},
+    {'name': 'ingot32 from tools', 'Initial': {'bench': 1, 'furnace': 1, 'stone_pickaxe': 1}, 'Goal': {'ingot': 32}},
+]
+
+# Planner options for each craft_planner.py variant (see planner.Planner). 'modified' is the search in
+# craft_planner_modified.py
+VARIANTS = {
+    'priority macros': {'heuristic': 'priority', 'macros': True, 'skip_dominated': True},
+    'priority': {'heuristic': 'priority', 'macros': False, 'skip_dominated': False},
+    'relaxed macros': {'heuristic': 'relaxed', 'macros': True, 'skip_dominated': True},
+    'bulk': {'search': 'bulk'},
+    'regression': {'search': 'regression', 'weight': 1.5},
+    'hierarchical': {'search': 'hierarchical', 'heuristic': 'priority', 'macros': True, 'skip_dominated': True},
+    'modified': None,
+}
+
+# How much worse than the baseline a result may be before it counts as a regression: time, states and memory may grow
+# by the given factor (time also by an absolute slack, since short runs are noisy), and cost may not grow at all
+THRESHOLDS = {'time': 1.5, 'time_slack': 0.05, 'states': 1.1, 'peak_kb': 1.25, 'cost': 1.0}
+
+#how long past its limit a run is waited on, for starting its process and checking its plan, before it counts as failed
+RESULT_SLACK = 10
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+def plan_modified(Crafting, initial, goal, limit, stats):
+    # Runs the search from craft_planner_modified.py, which works from module globals its main would fill in
+    modified.all_recipes = [modified.Recipe(name, modified.make_checker(rule), modified.make_effector(rule),
+                                            rule['Time']) for name, rule in Crafting['Recipes'].items()]
+    state = modified.State({key: 0 for key in Crafting['Items']})
+    state.update(initial)
+    return modified.search(modified.graph, state, modified.make_goal_checker(goal), limit,
+                           modified.make_heuristic(goal), stats)
+
+
+def failure(error):
+    # The result of a run that raised or never reported back
+    return {'time': None, 'states': None, 'states_per_sec': None, 'peak_kb': None, 'cost': None, 'valid': None,
+            'error': error}
+
+
+def run_one(Crafting, variant, problem, limit, results):
+    # Runs one variant on one problem, in its own process
+    sys.stdout = open(os.devnull, 'w')
+    stats = {}
+    start_time = time()
+    try:
+        if VARIANTS[variant] is None:
+            plan = plan_modified(Crafting, problem['Initial'], problem['Goal'], limit, stats)
+        else:
+            planner = Planner.from_crafting(Crafting, **VARIANTS[variant])
+            plan = planner.plan(problem['Initial'], problem['Goal'], limit, stats=stats)
+        elapsed = time() - start_time
+        cost = sum(Crafting['Recipes'][action]['Time'] for state, action in plan[:-1]) if plan else None
+        states = stats.get('states')
+        #replayed outside the timing, whether the plan really reaches the goal
+        valid = check_plan(Crafting, plan, problem['Initial'], problem['Goal']).goal_met if plan else None
+    except Exception as e:
+        results.put(failure(repr(e)))
+        return
+    results.put({'time': elapsed, 'states': states, 'states_per_sec': states / elapsed if states else None,
+                 'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'cost': cost, 'valid': valid})
+
+
+def measure(Crafting, variant, problem, limit, repeat=1):
+    # Best of repeat runs (by wall time) of one variant on one problem. A run that raises, dies or doesn't report back
+    # in time gives a failure, kept only if no run succeeds
+    context = get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        results = context.Queue()
+        process = context.Process(target=run_one, args=(Crafting, variant, problem, limit, results))
+        process.start()
+        give_up = time() + limit + RESULT_SLACK
+        result = None
+        while result is None:
+            try:
+                result = results.get(timeout=0.1)
+            except Empty:
+                if not process.is_alive():
+                    #the result may still have been on its way out when the process ended
+                    try:
+                        result = results.get(timeout=1)
+                    except Empty:
+                        result = failure('died with exit code %s' % process.exitcode)
+                elif time() > give_up:
+                    process.terminate()
+                    result = failure('no result within %gs' % (limit + RESULT_SLACK))
+        process.join()
+        if best is None or best.get('error') or (not result.get('error') and result['time'] < best['time']):
+            best = result
+    return best
+
+
+def regressions(result, baseline, thresholds=THRESHOLDS):
+    # The ways result is worse than baseline, as a list of messages. A baseline run that ran out of time has nothing
+    # to compare against, since how far it got depends on the machine
+    found = []
+    if baseline['cost'] is None:
+        return found
+    if result['cost'] is None:
+        return ['no plan (baseline cost ' + str(baseline['cost']) + ')']
+    if result.get('valid') is False:
+        found.append('plan does not replay to the goal')
+    if result['cost'] > baseline['cost'] * thresholds['cost']:
+        found.append('cost ' + str(result['cost']) + ' > ' + str(baseline['cost']))
+    if result['time'] > baseline['time'] * thresholds['time'] + thresholds['time_slack']:
+        found.append('time %.3fs > %.3fs' % (result['time'], baseline['time']))
+    if baseline['states'] and result['states'] and result['states'] > baseline['states'] * thresholds['states']:
+        found.append('states ' + str(result['states']) + ' > ' + str(baseline['states']))
+    if result['peak_kb'] > baseline['peak_kb'] * thresholds['peak_kb']:
+        found.append('peak ' + str(result['peak_kb']) + ' KB > ' + str(baseline['peak_kb']) + ' KB')
+    return found
+
+
+def row(variant, problem, result):
+    def show(value, form):
+        return form % value if value is not None else '-'
+    return '%-16s %-24s %8s %8s %10s %9s %6s' % (variant, problem, show(result['time'], '%.3f'),
+                                                 show(result['states'], '%d'), show(result['states_per_sec'], '%.0f'),
+                                                 show(result['peak_kb'], '%d'), show(result['cost'], '%d'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the planners against a stored baseline.')
+    parser.add_argument('--recipes', default='Crafting.json', help='crafting file with the Items and Recipes')
+    parser.add_argument('--variants', nargs='*', default=list(VARIANTS), help='variants to run')
+    parser.add_argument('--problems', nargs='*', default=[problem['name'] for problem in CORPUS],
+                        help='problems to run')
+    parser.add_argument('--limit', type=float, default=30, help='seconds allowed per run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per variant and problem, the fastest is kept')
+    parser.add_argument('--update', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    Crafting = load_crafting(args.recipes)
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    print('%-16s %-24s %8s %8s %10s %9s %6s' % ('variant', 'problem', 'time', 'states', 'states/s', 'peak KB', 'cost'))
+    failed = []
+    for variant in args.variants:
+        for problem in [problem for problem in CORPUS if problem['name'] in args.problems]:
+            result = measure(Crafting, variant, problem, args.limit, args.repeat)
+            print(row(variant, problem['name'], result))
+            sys.stdout.flush()
+            previous = baseline.get(variant, {}).get(problem['name'])
+            if result.get('error'):
+                failed.append(variant + ' / ' + problem['name'] + ': failed: ' + result['error'])
+            elif args.update:
+                baseline.setdefault(variant, {})[problem['name']] = result
+            elif previous is not None:
+                for message in regressions(result, previous):
+                    failed.append(variant + ' / ' + problem['name'] + ': ' + message)
+
+    if args.update:
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print('Baseline written to', BASELINE)
+    if failed:
+        print('')
+        print('Regressions:')
+        for message in failed:
+            print('\t', message)
+        sys.exit(1)
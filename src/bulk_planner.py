@@ -0,0 +1,174 @@
+from math import ceil
+from timeit import default_timer as time
+
+from craft_planner import Layout, RecipeTable, cheapest_units
+
+# Plans by quantity instead of by single steps. The problem is first solved structurally: which tools to make and in
+# which order, and how many times each recipe fires. Those firings are then laid out as a concrete list of steps. The
+# planning work depends on the number of distinct items and tools, not on the amounts asked for, so a goal of 500
+# rails costs the same to plan as a goal of 1.
+
+
+def heights(table, makers):
+    # How far each item is from the raw resources along the chosen recipes. Consumers sit above their ingredients
+    height = {}
+
+    def measure(slot, seen):
+        if slot not in height:
+            row = makers[slot]
+            if row is None or slot in seen:
+                return 0
+            inputs = [other for other, amount in enumerate(table.consumes[row].tolist()) if amount]
+            height[slot] = 1 + max([measure(other, seen | {slot}) for other in inputs] or [0])
+        return height[slot]
+
+    for slot in range(len(makers)):
+        measure(slot, frozenset())
+    return height
+
+
+def firings_for(table, rows, counts, needed):
+    # Integer firing counts that leave at least needed[slot] of each item, starting from counts and using only the
+    # given recipe rows. Each missing item is made with its cheapest recipe, fired as many whole times as the
+    # outstanding amount needs, and what that recipe consumes is added to what is needed. Items are settled from the
+    # top of the recipe tree down, so every consumer adds its demand before its ingredients are made, and what is held
+    # is used up before anything is made. Recipes are priced with the items held costing nothing, so a held ingot
+    # isn't priced (or made) by the furnace these rows may not have; a held item still gets its own cheapest recipe
+    # in case more of it is needed than is held.
+    # Returns ({row: times}, counts afterwards), or None when an item can't be made with these recipes.
+    costs, makers = cheapest_units(table, rows, [slot for slot, count in enumerate(counts) if count > 0])
+    own_makers = cheapest_units(table, rows)[1]
+    makers = [own_makers[slot] if maker is None else maker for slot, maker in enumerate(makers)]
+    height = heights(table, makers)
+    have = list(counts)
+    targets = list(needed)
+    needed = list(needed)
+    fired = {}
+    for _ in range(len(have) * len(rows) + 1):
+        missing = [slot for slot in range(len(have)) if needed[slot] > have[slot]]
+        if not missing:
+            break
+        slot = max(missing, key=lambda slot: height.get(slot, 0))
+        row = makers[slot]
+        if row is None:
+            return None
+        times = ceil((needed[slot] - have[slot]) / int(table.produces[row, slot]))
+        fired[row] = fired.get(row, 0) + times
+        for other, amount in enumerate(table.produces[row].tolist()):
+            have[other] += amount * times
+        for other, amount in enumerate(table.consumes[row].tolist()):
+            needed[other] += amount * times
+    else:
+        return None
+    #what was needed on top of the target amounts gets used up when the consumers fire
+    after = [have[slot] - (needed[slot] - target) for slot, target in enumerate(targets)]
+    return fired, after
+
+
+def order_firings(table, fired):
+    # Lays firings out so every recipe fires after all the fired recipes making its ingredients
+    makers = {}
+    for row in fired:
+        for slot, amount in enumerate(table.produces[row].tolist()):
+            if amount:
+                makers.setdefault(slot, []).append(row)
+    level = {}
+
+    def measure(row, seen):
+        if row not in level:
+            inputs = [slot for slot, amount in enumerate(table.consumes[row].tolist()) if amount]
+            below = [measure(other, seen | {row}) for slot in inputs for other in makers.get(slot, [])
+                     if other not in seen and other != row]
+            level[row] = 1 + max(below or [0])
+        return level[row]
+
+    for row in fired:
+        measure(row, frozenset())
+    return sorted(fired.items(), key=lambda firing: (level[firing[0]], firing[0]))
+
+
+def bulk_firings(table, state, goal):
+    # Solves the problem structurally. Tools are picked up one at a time, each made with the recipes the tools before
+    # it allow, and the goal is then made with the recipes the final tool set allows. The cheapest order is found by
+    # dynamic programming over tool sets, so the work is at most (number of tool sets) x (number of tools) integer
+    # solves. Returns (cost, [(recipe name, times)]) in the order they should fire, or None if the goal can't be met.
+    index = table.layout.index
+    tools = table.tools
+    row_tools = [set(required) for required in table.required]
+    target = [0] * len(table.layout.items)
+    for item, amount in goal.items():
+        target[index[item]] = amount
+
+    def allowed(held):
+        return [row for row, required in enumerate(row_tools) if required <= held]
+
+    start = frozenset(slot for slot in tools if state.counts[slot] > 0)
+    #tool set -> (cost so far, counts, [(row, times)] so far)
+    best = {start: (0, list(state.counts), [])}
+    finished = None
+    for size in range(len(start), len(tools) + 1):
+        for held in [held for held in best if len(held) == size]:
+            cost, counts, steps = best[held]
+            rows = allowed(held)
+            #finish from here
+            solved = firings_for(table, rows, counts, [max(amount, 0) for amount in target])
+            if solved is not None:
+                fired, after = solved
+                total = cost + sum(table.costs[row] * times for row, times in fired.items())
+                if finished is None or total < finished[0]:
+                    finished = (total, steps + order_firings(table, fired))
+            #or pick up one more tool first
+            for tool in tools:
+                if tool in held:
+                    continue
+                needed = [0] * len(counts)
+                needed[tool] = 1
+                solved = firings_for(table, rows, counts, needed)
+                if solved is None:
+                    continue
+                fired, after = solved
+                grown = frozenset(held | set(slot for slot in tools if after[slot] > 0))
+                total = cost + sum(table.costs[row] * times for row, times in fired.items())
+                if grown not in best or total < best[grown][0]:
+                    best[grown] = (total, after, steps + order_firings(table, fired))
+    if finished is None:
+        return None
+    total, steps = finished
+    return total, [(table.names[row], times) for row, times in steps]
+
+
+def bulk_plan(table, state, goal):
+    # Plans with bulk_firings and lays the firings out as a [(state, action)] plan, like search returns
+    solved = bulk_firings(table, state, goal)
+    if solved is None:
+        return None
+    cost, firings = solved
+    deltas = table.deltas.tolist()
+    path = []
+    for name, times in firings:
+        delta = deltas[table.rows[name]]
+        for _ in range(times):
+            path.append((state, name))
+            state = state.with_counts(tuple(count + change for count, change in zip(state.counts, delta)))
+    path.append((state, "End of Path"))
+    return path
+
+
+if __name__ == '__main__':
+    from loader import load_crafting
+    Crafting = load_crafting('Crafting.json')
+
+    layout = Layout(Crafting['Items'])
+    recipe_table = RecipeTable(Crafting['Recipes'], layout)
+    state = layout.state(Crafting['Initial'])
+
+    start_time = time()
+    solved = bulk_firings(recipe_table, state, Crafting['Goal'])
+    if solved is None:
+        print("No way to reach", Crafting['Goal'], "from", state)
+    else:
+        cost, firings = solved
+        print("Compute Time: " + str(time() - start_time))
+        print("Game Time: {cost = " + str(cost) + "} {len = " + str(sum(times for name, times in firings)) + "}")
+        for name, times in firings:
+            print('\t', times, 'x', name)
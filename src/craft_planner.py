@@ -1,15 +1,26 @@
-import json
-from collections import namedtuple, defaultdict, OrderedDict
+import os
+import sys
+from collections import namedtuple, defaultdict
+from copy import copy
 from timeit import default_timer as time
 from heapq import heappop, heappush
+from functools import reduce
+from math import ceil, gcd
+from operator import mul
+from random import Random
+
+import numpy as np
+
+from plan_cache import PlanCache, cached_search
 
 Recipe = namedtuple('Recipe', ['name', 'check', 'effect', 'cost'])
 resources=['wood', 'cobble', 'coal', 'ore']
 materials=['plank', 'ingot', 'stick', 'cart', 'rail']
 tools = ["bench", "wooden_axe", "wooden_pickaxe", "stone_axe", "stone_pickaxe", "furnace", "iron_axe", "iron_pickaxe"]
+HASH_MASK = (1 << 64) - 1
 
 #fills out the priority list, which is used to push the search towards items that will reach will the goal
-def make_priority_list(item, priority):
+def make_priority_list(item, priority, rules, priority_list):
     #find the rule that produces the given item
     for rule in rules:
         if item in rule["Produces"]:
@@ -22,7 +33,7 @@ def make_priority_list(item, priority):
                         priority_list[consumed] = priority + 1
                     #if its not a natural resource, recursively call this function to get the next level of ingredients
                     if consumed not in  resources:
-                        make_priority_list(consumed, priority + 1)
+                        make_priority_list(consumed, priority + 1, rules, priority_list)
             #also take note of tools required to make materials. These are given a much higher priority in the heuristic
             if "Requires" in rule:
                 for tool in rule["Requires"]:
@@ -34,172 +45,633 @@ def make_priority_list(item, priority):
             break
     pass
 
-class State(OrderedDict):
-    """ This class is a thin wrapper around an OrderedDict, which is simply a dictionary which keeps the order in
-        which elements are added (for consistent key-value pair comparisons). Here, we have provided functionality
-        for hashing, should you need to use a state as a key in another dictionary, e.g. distance[state] = 5. By
-        default, dictionaries are not hashable. Additionally, when the state is converted to a string, it removes
-        all items with quantity 0.
+def make_priorities(goal, rules):
+    # Builds the priority list for a goal: which items we'll want to make to reach it. It is a new dict for every goal,
+    # so goals planned side by side don't share one
+    priority_list = {}
+    #Fringe case: force make an iron_pickaxe when making more than 16 rails
+    if "rail" in goal.keys():
+        if goal["rail"] > 16:
+            priority_list["iron_pickaxe"] = True
+    #Fringe case: Add stone_pickaxe to the priority list if the goal itself is a furnace
+    if "furnace" in goal.keys():
+        priority_list["stone_pickaxe"] = True
+    #Figure out which items will be relevant for the goal
+    for item in goal:
+        make_priority_list(item, 0, rules, priority_list)
+    return priority_list
+
+def item_limits(recipes, layout, goal):
+    # The most of each item worth holding before making more of it, as a vector over the layout's slots: the goal
+    # amount, the most any one recipe consumes at once, and 1 of every tool a recipe requires. An item at its limit
+    # already covers the next recipe that needs it, so making more can wait until after that recipe. Items nothing
+    # needs get a limit of 0 and are never made. This takes the place of the hand-picked caps in make_pruner
+    limits = np.zeros(len(layout.items), dtype=np.int64)
+    for rule in recipes.values():
+        for item, amount in rule.get("Consumes", {}).items():
+            limits[layout.index[item]] = max(limits[layout.index[item]], amount)
+        for item in rule.get("Requires", {}):
+            limits[layout.index[item]] = max(limits[layout.index[item]], 1)
+    for item, amount in goal.items():
+        limits[layout.index[item]] = max(limits[layout.index[item]], amount)
+    return limits
+
+def make_consume_limit(rules):
+    #figure out limits for any given item: the most of it (other than wood) any one recipe consumes
+    consume_limit = {}
+    for rule in rules:
+        if "Consumes" in rule:
+            for limit in rule["Consumes"]:
+                if limit != "wood":
+                    if limit not in consume_limit or consume_limit[limit] < rule["Consumes"][limit]:
+                        consume_limit[limit] = rule["Consumes"][limit]
+    return consume_limit
+
+class Layout(object):
+    """ Fixed layout shared by every State of one crafting problem. Each item name in Crafting['Items'] is mapped once
+        to an integer slot, so states only need to carry their counts.
+
+        Each slot also gets a random 64-bit key, and a state's hash is the sum of its counts times the keys, mod 2**64
+        (Zobrist-style, with counts in place of on/off bits). A recipe then changes the hash by a fixed amount, so a
+        successor's hash is its parent's plus the recipe's hash_delta, whatever the size of the inventory.
+    """
+    __slots__ = ('items', 'index', 'keys')
+
+    def __init__(self, items):
+        self.items = tuple(items)
+        self.index = {item: slot for slot, item in enumerate(self.items)}
+        keys = Random(len(self.items))
+        self.keys = tuple(keys.getrandbits(64) for item in self.items)
+
+    def hash(self, counts):
+        return sum(map(mul, counts, self.keys)) & HASH_MASK
+
+    def hash_delta(self, changes):
+        #how much the hash moves when the counts change by the given {slot: change} amounts
+        return sum(self.keys[slot] * change for slot, change in changes.items()) & HASH_MASK
+
+    def state(self, inventory=()):
+        #build a state from a {item: amount} dict, e.g. Crafting['Initial']
+        counts = [0] * len(self.items)
+        for item, amount in dict(inventory).items():
+            counts[self.index[item]] = amount
+        return State(self, tuple(counts))
 
-        Use of this state representation is optional, should you prefer another.
+
+class State(object):
+    """ A compact inventory: the item counts are stored in a tuple laid out by a Layout, and the hash is computed once
+        when the state is built (or handed down from the parent, see Layout). distances, parentState and the heap hash
+        and compare states millions of times, so neither may rebuild anything. States can still be read by item name,
+        e.g. state['wood'], and when the state is converted to a string, it removes all items with quantity 0.
+
+        applicable is left to RecipeTable.incremental_successors, which keeps what it needs to find the recipes
+        applicable in the state there.
     """
+    __slots__ = ('layout', 'counts', '_hash', 'applicable')
+
+    def __init__(self, layout, counts, _hash=None, applicable=None):
+        self.layout = layout
+        self.counts = counts
+        self._hash = layout.hash(counts) if _hash is None else _hash
+        self.applicable = applicable
 
-    def __key(self):
-        return tuple(self.items())
+    def __getitem__(self, item):
+        return self.counts[self.layout.index[item]]
 
     def __hash__(self):
-        return hash(self.__key())
+        return self._hash
+
+    def __eq__(self, other):
+        return self._hash == other._hash and self.counts == other.counts
+
+    def __ne__(self, other):
+        return not self == other
 
     def __lt__(self, other):
-        return self.__key() < other.__key()
+        return self.counts < other.counts
+
+    def keys(self):
+        return self.layout.items
+
+    def items(self):
+        return zip(self.layout.items, self.counts)
 
     def copy(self):
-        new_state = State()
-        new_state.update(self)
-        return new_state
+        return State(self.layout, self.counts)
+
+    def with_counts(self, counts):
+        #a state on the same layout with the given counts tuple
+        return State(self.layout, counts)
 
     def __str__(self):
         return str(dict(item for item in self.items() if item[1] > 0))
 
-def make_checker(rule):
+def make_checker(rule, layout):
     # Implement a function that returns a function to determine whether a state meets a
     # rule's requirements. This code runs once, when the rules are constructed before
     # the search is attempted.
 
+    #turn rule['Consumes'] and rule['Requires'] into (slot, minimum amount) pairs once, so the check never touches a
+    #dict
+    needs = []
+    if "Consumes" in rule:
+        for material, amount in rule["Consumes"].items():
+            needs.append((layout.index[material], amount))
+    if "Requires" in rule:
+        for tool in rule["Requires"]:
+            needs.append((layout.index[tool], 1))
+
     def check(state):
-        b = True
         # This code is called by graph(state) and runs millions of times.
-        # Tip: Do something with rule['Consumes'] and rule['Requires'].
         #if the state has the required materials for consumes and the required tools in requires
-        if "Consumes" in rule:
-            materials = rule["Consumes"].keys()
-            for material in materials:
-                if state[material] < rule["Consumes"][material]:
-                    b = False
-                    break
-        if "Requires" in rule:
-            tools = rule["Requires"].keys()
-            if b:
-                for tool in tools:
-                    if state[tool] <= 0:
-                        b = False
-                        break
-        return b
+        counts = state.counts
+        for slot, amount in needs:
+            if counts[slot] < amount:
+                return False
+        return True
 
     return check
 
 
-def make_effector(rule):
+def make_effector(rule, layout):
     # Implement a function that returns a function which transitions from state to
     # new_state given the rule. This code runs once, when the rules are constructed
     # before the search is attempted.
 
-    #figure out limits for any given item
+    #put Produces and Consumes together as a single (slot, change) list, and work out the change to the hash once
+    changes = defaultdict(int)
+    for product, amount in rule["Produces"].items():
+        changes[layout.index[product]] += amount
     if "Consumes" in rule:
-        for limit in rule["Consumes"]:
-            if limit != "wood":
-                if limit not in consume_limit or consume_limit[limit] < rule["Consumes"][limit]:
-                    consume_limit[limit] = rule["Consumes"][limit]
+        for cost, amount in rule["Consumes"].items():
+            changes[layout.index[cost]] -= amount
+    hash_delta = layout.hash_delta(changes)
+    changes = list(changes.items())
 
     def effect(state):
         # This code is called by graph(state) and runs millions of times
-        # Tip: Do something with rule['Produces'] and rule['Consumes'].
-        next_state = state.copy()
-        #put the key-value pairs of Produces and Consumes in a single dict
-        products = rule["Produces"].copy()
-        #get updated values for each item in Produces
-        for product in products:
-            products[product] += state[product]
-        #update next_state to reflect those changes
-        next_state.update(products)
-        #repeat for Consumes
-        if "Consumes" in rule:
-            costs = rule["Consumes"].copy()
-            for cost in costs:
-                costs[cost] = state[cost]-costs[cost]
-            next_state.update(costs)
-        return next_state
+        counts = list(state.counts)
+        for slot, change in changes:
+            counts[slot] += change
+        return State(state.layout, tuple(counts), (state._hash + hash_delta) & HASH_MASK)
 
     return effect
 
 
-def make_goal_checker(goal):
+class RecipeTable(object):
+    """ Crafting['Recipes'] compiled once into dense matrices over a Layout's slots: one row per recipe holding the
+        minimum amount of each item it needs (Consumes amounts, and 1 for each tool in Requires), the amounts it
+        consumes and produces, their combined delta, and the recipe's Time. The recipes applicable to a state then come
+        from a single comparison against the minimums, and all of its successors from a single broadcast add.
+
+        With skip_dominated, a recipe is left out whenever another applicable recipe has the same effect for less
+        Time, e.g. punching for wood once a stone_axe is held. A table made by with_limits also leaves out every
+        recipe that makes more of an item the state already holds its limit of (see item_limits), as part of the same
+        comparison, so those successors are never built.
+
+        incremental_successors gives the same successors without looking at every recipe: the recipes applicable in a
+        state are worked out from its parent's by checking again only the recipes that need or make an item the fired
+        recipe changed (the dependency index in recheck), and only in the direction the change could flip them.
+    """
+
+    def __init__(self, recipes, layout, skip_dominated=False):
+        self.layout = layout
+        self.names = list(recipes)
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.costs = [recipes[name]['Time'] for name in self.names]
+        shape = (len(self.names), len(layout.items))
+        self.consumes = np.zeros(shape, dtype=np.int64)
+        self.minimums = np.zeros(shape, dtype=np.int64)
+        self.produces = np.zeros(shape, dtype=np.int64)
+        self.required = []          #slots of the tools in each recipe's Requires
+        for row, name in enumerate(self.names):
+            rule = recipes[name]
+            for item, amount in rule.get("Consumes", {}).items():
+                self.consumes[row, layout.index[item]] = amount
+            for item, amount in rule.get("Requires", {}).items():
+                #Requires holds true for tools, but allow an explicit amount as well
+                self.minimums[row, layout.index[item]] = 1 if amount is True else amount
+            self.required.append([layout.index[item] for item in rule.get("Requires", {})])
+            for item, amount in rule["Produces"].items():
+                self.produces[row, layout.index[item]] = amount
+        self.minimums = np.maximum(self.minimums, self.consumes)
+        self.deltas = self.produces - self.consumes
+        self.tools = sorted(set(slot for required in self.required for slot in required))
+        #cheaper[row, other] is set when other has the same effect as row for less Time (ties go to the earlier recipe)
+        self.cheaper = None
+        if skip_dominated:
+            same = (self.deltas[:, None, :] == self.deltas[None, :, :]).all(axis=2)
+            costs = np.array(self.costs)
+            order = np.arange(len(self.names))
+            less = ((costs[None, :] < costs[:, None]) |
+                    ((costs[None, :] == costs[:, None]) & (order[None, :] < order[:, None])))
+            self.cheaper = same & less
+        self.limits = None
+        self.limit_list = None
+        self.makes = self.deltas > 0
+        #the same recipes as (slot, amount) lists, and how much each one moves a state's hash
+        self.needs = [[(slot, amount) for slot, amount in enumerate(row) if amount] for row in self.minimums.tolist()]
+        self.changes = [[(slot, change) for slot, change in enumerate(row) if change] for row in self.deltas.tolist()]
+        self.made = [[slot for slot, change in row if change > 0] for row in self.changes]
+        self.hash_deltas = [layout.hash_delta(dict(row)) for row in self.changes]
+        self.hash_steps = np.array(self.hash_deltas, dtype=np.uint64)
+        #dependency index: needed_by[slot] and made_by[slot] are the recipes that need or make the item in slot, as bit
+        #masks. After row fires, a recipe can only become applicable if an item it needs went up or an item it makes
+        #went down, and only stop being applicable the other way round, so recheck[row] holds the two (gains, losses)
+        needed_by = [0] * len(layout.items)
+        made_by = [0] * len(layout.items)
+        for row in range(len(self.names)):
+            for slot, amount in self.needs[row]:
+                needed_by[slot] |= 1 << row
+            for slot in self.made[row]:
+                made_by[slot] |= 1 << row
+        self.recheck = []
+        for row in range(len(self.names)):
+            gains = losses = 0
+            for slot, change in self.changes[row]:
+                if change > 0:
+                    gains |= needed_by[slot]
+                    losses |= made_by[slot]
+                else:
+                    gains |= made_by[slot]
+                    losses |= needed_by[slot]
+            self.recheck.append((gains, losses))
+        self.cheaper_masks = None
+        if skip_dominated:
+            self.cheaper_masks = [sum(1 << other for other in np.flatnonzero(row).tolist()) for row in self.cheaper]
+
+    def with_limits(self, limits):
+        # A copy of the table that also skips recipes making more of an item already at its limit. The matrices are
+        # shared with this table, not copied
+        table = copy(self)
+        table.limits = np.asarray(limits)
+        table.limit_list = table.limits.tolist()
+        return table
+
+    def applicable(self, counts):
+        #indices of every recipe whose minimums are met by the given counts
+        counts = np.asarray(counts)
+        valid = (counts >= self.minimums).all(axis=1)
+        if self.cheaper is not None:
+            valid &= ~(self.cheaper & valid).any(axis=1)
+        if self.limits is not None:
+            valid &= ~(self.makes & (counts >= self.limits)).any(axis=1)
+        return np.flatnonzero(valid)
+
+    def successors(self, state):
+        # Same contract as graph(state): (name, next_state, cost) for each recipe that is valid in the state
+        counts = np.array(state.counts)
+        rows = self.applicable(counts)
+        next_counts = (self.deltas[rows] + counts).tolist()
+        next_hashes = (self.hash_steps[rows] + np.uint64(state._hash)).tolist()
+        layout = state.layout
+        for row, row_counts, row_hash in zip(rows.tolist(), next_counts, next_hashes):
+            yield (self.names[row], State(layout, tuple(row_counts), row_hash), self.costs[row])
+
+    def fits(self, row, counts):
+        #whether the recipe in row is applicable with the given counts, limits included
+        for slot, amount in self.needs[row]:
+            if counts[slot] < amount:
+                return False
+        if self.limit_list is not None:
+            limits = self.limit_list
+            for slot in self.made[row]:
+                if counts[slot] >= limits[slot]:
+                    return False
+        return True
+
+    def incremental_successors(self, state):
+        # Same contract as successors. A successor only carries its parent's applicable recipes and the recipe that
+        # made it, and its own applicable recipes are worked out from those when it is expanded, so states that are
+        # never expanded cost nothing. A state that didn't come from this table is checked from scratch
+        carried = state.applicable
+        counts = state.counts
+        if carried is not None and carried[0] is self:
+            table, applicable, row = carried
+            gains, losses = self.recheck[row]
+            #recipes that might turn on are checked if they are off, and those that might turn off if they are on
+            candidates = (gains & ~applicable) | (losses & applicable)
+            applicable &= ~candidates
+            while candidates:
+                other = candidates & -candidates
+                candidates ^= other
+                if self.fits(other.bit_length() - 1, counts):
+                    applicable |= other
+        else:
+            applicable = 0
+            for row in range(len(self.names)):
+                if self.fits(row, counts):
+                    applicable |= 1 << row
+        cheaper = self.cheaper_masks
+        layout = state.layout
+        remaining = applicable
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            row = bit.bit_length() - 1
+            if cheaper is not None and cheaper[row] & applicable:
+                continue
+            next_counts = list(counts)
+            for slot, change in self.changes[row]:
+                next_counts[slot] += change
+            next_state = State(layout, tuple(next_counts), (state._hash + self.hash_deltas[row]) & HASH_MASK,
+                               (self, applicable, row))
+            yield (self.names[row], next_state, self.costs[row])
+
+
+def make_goal_checker(goal, layout):
     # Implement a function that returns a function which checks if the state has
     # met the goal criteria. This code runs once, before the search is attempted.
 
-    #Fringe case: force make an iron_pickaxe when making more than 16 rails
-    if "rail" in goal.keys():
-        if goal["rail"] > 16:
-            priority_list["iron_pickaxe"] = True
-    #Fringe case: Add stone_pickaxe to the priority list if the goal itself is a furnace
-    if "furnace" in goal.keys():
-        priority_list["stone_pickaxe"] = True
+    #determine the conditions for a goal state
+    conditions = [(layout.index[item], amount) for item, amount in goal.items()]
 
     def is_goal(state):
-        #assume the goal will be met
-        b = True
-        #determine the conditions for a goal state
-        items = goal.keys()
-        #check each condition
-        for item in items:
-            #if a condition is broken, stop checking and return false
-            if state[item] < goal[item]:
-                b = False
-                break
-        return b
+        counts = state.counts
+        #check each condition, if a condition is broken, stop checking and return false
+        for slot, amount in conditions:
+            if counts[slot] < amount:
+                return False
+        return True
 
     return is_goal
 
 
-def graph(state):
-    # Iterates through all recipes/rules, checking which are valid in the given state.
-    # If a rule is valid, it returns the rule's name, the resulting state after application
-    # to the given state, and the cost for the rule.
-    for r in all_recipes:
-        if r.check(state):
-            yield (r.name, r.effect(state), r.cost)
+#the hand-picked constants of make_heuristic, which tuner.py searches over: a priority material is worth priority
+#divided by its place in the priority list, a required tool is worth tool, and so is a goal item, and cobble after the
+#furnace and stone_pickaxe costs fringe
+HEURISTIC_WEIGHTS = {'priority': 30, 'tool': 1000, 'goal': 1000, 'fringe': 100}
+
+
+def make_heuristic(goal, priority_list, weights=None):
+    # Makes the heuristic function to prioritize the goal if it's the next move, from the goal's priority list (see
+    # make_priorities). The slots are looked up on the first call, once the layout is known. weights, if given,
+    # replaces some or all of HEURISTIC_WEIGHTS
+    table = None
+    weights = dict(HEURISTIC_WEIGHTS, **(weights or {}))
+    priority, tool = weights['priority'], weights['tool']
+    goal_weight, fringe_weight = weights['goal'], weights['fringe']
+
+    def make_table(layout):
+        index = layout.index
+        #(slot, weight) for priority materials, (slot, None) for the required tools, in priority list order
+        priorities = []
+        for item in priority_list:
+            if item in materials or item in resources:
+                priorities.append((index[item], priority/priority_list[item]))
+            else:
+                priorities.append((index[item], None))
+        fringe = (index["furnace"], index["stone_pickaxe"], index["cobble"])
+        goal_slots = [index[g] for g in goal.keys()]
+        return priorities, fringe, goal_slots
 
-def make_heuristic(goal):
-    # Makes the heuristic function to prioritize the goal if it's the next move
     def heuristic(currState, nextState):
+        nonlocal table
+        if table is None:
+            table = make_table(nextState.layout)
+        priorities, (furnace, stone_pickaxe, cobble), goal_slots = table
+        curr = currState.counts
+        nxt = nextState.counts
         value = 0
         # Implement your heuristic here!
         #search through the priority list
-        for item in priority_list:
+        for slot, weight in priorities:
             #if the proposed action results in the creation of a priority item, bump it up in the queue relative to how
             #close it is to the goal
-            if item in materials or item in resources:
-                if nextState[item] > currState[item] and nextState[item]:
-                    value -= (30/priority_list[item])
+            if weight is not None:
+                if nxt[slot] > curr[slot] and nxt[slot]:
+                    value -= weight
             #Favor actions that result in a required tool, and favor all the sub_actions
             else:
-                if nextState[item] == 1 or currState[item] == 1:
-                    value -= 1000
+                if nxt[slot] == 1 or curr[slot] == 1:
+                    value -= tool
         #Fringe case: The algorithm like to collect a cobble after making a furnace instead of coal. We tell it to knock
         #that off
-        if currState["furnace"] == 1 and currState["stone_pickaxe"] == 1 and nextState["cobble"] > currState["cobble"]:
-            value += 100
+        if curr[furnace] == 1 and curr[stone_pickaxe] == 1 and nxt[cobble] > curr[cobble]:
+            value += fringe_weight
         #if the proposed action results in fulfilling part of the goal, favor that and all its children's actions
-        for g in goal.keys():
-            if nextState[g] > currState[g] or currState[g] > 0:
-                value -= 1000
+        for slot in goal_slots:
+            if nxt[slot] > curr[slot] or curr[slot] > 0:
+                value -= goal_weight
 
         return value
     
     return heuristic
 
-def search(graph, state, is_goal, limit, heuristic, goals):
+def cheapest_units(table, rows, stock=()):
+    # Works out the cheapest cost of one unit of each item using only the given recipe rows of a RecipeTable, and
+    # returns (costs, makers) where makers[slot] is the row that achieves it. Items in stock that can't be made cost
+    # nothing, and anything unreachable is left at infinity with no maker
+    consumed = [[(slot, amount) for slot, amount in enumerate(table.consumes[row].tolist()) if amount] for row in rows]
+    produced = [[(slot, amount) for slot, amount in enumerate(table.produces[row].tolist()) if amount] for row in rows]
+    costs = [float('inf')] * len(table.layout.items)
+    makers = [None] * len(table.layout.items)
+    for slot in stock:
+        costs[slot] = 0.0
+    #Bellman-Ford style relaxation, capped in case a recipe cycle multiplies its inputs
+    for _ in range(len(costs) * len(rows) + 1):
+        changed = False
+        for row, inputs, outputs in zip(rows, consumed, produced):
+            cost = table.costs[row] + sum(costs[slot] * amount for slot, amount in inputs)
+            if cost == float('inf'):
+                continue
+            #split a recipe's cost evenly between its products so every recipe's dual constraint holds
+            for slot, amount in outputs:
+                value = cost / (amount * len(outputs))
+                if value < costs[slot] - 1e-9:
+                    costs[slot] = value
+                    makers[slot] = row
+                    changed = True
+        if not changed:
+            break
+    return costs, makers
+
+def make_relaxed_heuristic(goal, table):
+    # Makes an admissible heuristic from the recipe graph, with no hand-picked weights. For a set of tools the plan
+    # could end up holding, only the recipes needing those tools can fire, and the cheapest cost of one unit of each
+    # item under those recipes is a feasible dual solution of the LP relaxation over recipe counts. So the unit costs
+    # of the missing goal items and tools, less the unit costs of what is already held, is a lower bound on the
+    # remaining cost. The heuristic is the smallest of those bounds over every tool set the state can still grow into.
+    # Unit costs are worked out once per tool set and the surviving bounds once per set of held tools, so a call is
+    # only a few dot products against the state's counts.
+    items = table.layout.items
+    tool_bits = [(1 << bit, slot) for bit, slot in enumerate(table.tools)]
+    row_masks = [sum(1 << table.tools.index(slot) for slot in required) for required in table.required]
+    #tools are expected to still be in the inventory at the end, unless some recipe uses them up
+    kept_tools = [slot for slot in table.tools if not table.consumes[:, slot].any()]
+    goal_counts = [0] * len(items)
+    for item, amount in goal.items():
+        goal_counts[table.layout.index[item]] = amount
+    #a goal item nothing consumes can only grow in steps of what its recipes make, so the amount still to make rounds
+    #up to a whole number of batches (e.g. 20 rails means 32 made). Those items are weighed per state instead
+    batches = []
+    for slot, amount in enumerate(goal_counts):
+        made = set(table.produces[:, slot].tolist()) - {0}
+        if amount and made and not table.consumes[:, slot].any():
+            batches.append((slot, reduce(gcd, made)))
+            goal_counts[slot] = 0
+    batch_slots = set(slot for slot, batch in batches)
+    goal_slots = [table.layout.index[item] for item in goal]
+    #plan costs are whole numbers when every Time is, so the bound can be rounded up
+    whole_costs = all(float(cost).is_integer() for cost in table.costs)
+    unit_cost_cache = {}
+    bound_cache = {}
+    hidden_cache = {}
+
+    def unit_costs(mask, stock):
+        # cheapest cost of one unit of each item using recipes whose tools are all in mask
+        key = (mask, stock)
+        if key not in unit_cost_cache:
+            rows = [row for row, row_mask in enumerate(row_masks) if row_mask & mask == row_mask]
+            unit_cost_cache[key] = cheapest_units(table, rows, stock)[0]
+        return unit_cost_cache[key]
+
+    def bounds(mask, extra):
+        # (constant, weights) for each tool set containing mask, where the bound for a state is
+        # constant - weights . counts. extra is the held items that can't be made with the tools in mask
+        key = (mask, extra)
+        if key not in bound_cache:
+            found = []
+            for superset in range(1 << len(tool_bits)):
+                if superset & mask != mask:
+                    continue
+                costs = unit_costs(superset, ())
+                stock = tuple(slot for slot in extra if costs[slot] == float('inf'))
+                if stock:
+                    costs = unit_costs(superset, stock)
+                needed = list(goal_counts)
+                for bit, slot in tool_bits:
+                    if bit & superset and slot in kept_tools and slot not in batch_slots:
+                        needed[slot] = max(needed[slot], 1)
+                if any(costs[slot] == float('inf') for slot, amount in enumerate(needed)
+                       if amount or slot in goal_slots):
+                    continue
+                weights = tuple(0.0 if cost == float('inf') else cost for cost in costs)
+                found.append((sum(w * n for w, n in zip(weights, needed)), weights))
+            #drop bounds that another bound is never above. Batched goal items count as negative amounts, so there
+            #the other bound's weight has to be the smaller one
+            found.sort()
+            kept = []
+            for constant, weights in found:
+                if not any(all(a <= b if slot in batch_slots else a >= b
+                               for slot, (a, b) in enumerate(zip(other, weights)))
+                           for _, other in kept):
+                    kept.append((constant, weights))
+            bound_cache[key] = kept
+        return bound_cache[key]
 
-    start_time = time()
+    def heuristic(currState, nextState):
+        counts = nextState.counts
+        mask = 0
+        for bit, slot in tool_bits:
+            if counts[slot]:
+                mask |= bit
+        if mask not in hidden_cache:
+            costs = unit_costs(mask, ())
+            hidden_cache[mask] = [slot for slot in range(len(items)) if costs[slot] == float('inf')]
+        extra = tuple(slot for slot in hidden_cache[mask] if counts[slot])
+        candidates = bounds(mask, extra)
+        if not candidates:
+            return float('inf')
+        if batches:
+            counts = list(counts)
+            for slot, batch in batches:
+                missing = goal[items[slot]] - counts[slot]
+                counts[slot] = -batch * ceil(missing / batch) if missing > 0 else 0
+        value = min(constant - sum(map(mul, weights, counts)) for constant, weights in candidates)
+        if value <= 0:
+            return 0
+        return ceil(value - 1e-9) if whole_costs else value
 
-    #Figure out which items will be relevant for the goal
-    for goal in goals:
-        make_priority_list(goal, 0)
+    return heuristic
+
+def make_pruner(state, goals, consume_limit):
+    # Makes the check search runs on every successor: prune(currentState, nextState) is the reason a path isn't worth
+    # considering ('consume limit', 'wood cap', 'tool duplicate' or 'goal excess'), or None to keep it. The pruning
+    # rules are turned into slot lists once, instead of looping over every item and tool for each successor. With
+    # consume_limit None, the graph does its own pruning (RecipeTable.with_limits) and nothing is pruned here
+    if consume_limit is None:
+        return lambda currentState, nextState: None
+    index = state.layout.index
+    limit_slots = [(index[item], amount) for item, amount in consume_limit.items()]
+    capped_slots = [slot for item, slot in index.items() if item not in consume_limit and item not in goals]
+    tool_slots = [index[tool] for tool in tools if tool in index]
+    goal_slots = [(index[item], amount) for item, amount in goals.items()]
+
+    def prune(currentState, nextState):
+        curr = currentState.counts
+        nxt = nextState.counts
+        #if we end up making more of any item than we'll ever need, ignore this path
+        for slot, amount in limit_slots:
+            if curr[slot] >= amount and nxt[slot] > curr[slot]:
+                return 'consume limit'
+        #if we end up making more than an arbitrary amount of wood, ignore this path
+        for slot in capped_slots:
+            if nxt[slot] > 8:
+                return 'wood cap'
+        #if we end up making more than one of any tool, ignore this path
+        for slot in tool_slots:
+            if nxt[slot] > 1:
+                return 'tool duplicate'
+        #if we end up making more of a goal item than we need, ignore this path
+        for slot, amount in goal_slots:
+            if nxt[slot] > curr[slot] and curr[slot] >= amount:
+                return 'goal excess'
+        return None
+
+    return prune
+
+class Dominance(object):
+    """ Remembers the states a search has expanded, to tell when a new state is dominated: an expanded state holding
+        the same tools has at least as much of every item and was reached at no greater cost, so anything the new
+        state can go on to do, that state could do for no more. States are grouped by the tools they hold, and each
+        group is kept as one matrix, so a state is checked against its whole group with a single comparison.
+    """
+
+    def __init__(self, layout, tool_slots):
+        self.tool_slots = list(tool_slots)
+        self.groups = {}            #tools held -> [counts matrix, costs, number of rows used]
+
+    def key(self, counts):
+        return tuple(counts[slot] for slot in self.tool_slots)
+
+    def add(self, state, cost):
+        group = self.groups.get(self.key(state.counts))
+        if group is None:
+            group = self.groups[self.key(state.counts)] = [np.zeros((16, len(state.counts)), dtype=np.int64),
+                                                           np.zeros(16), 0]
+        counts, costs, used = group
+        if used == len(costs):
+            #double the room whenever the group fills up
+            counts = group[0] = np.concatenate([counts, np.zeros_like(counts)])
+            costs = group[1] = np.concatenate([costs, np.zeros_like(costs)])
+        counts[used] = state.counts
+        costs[used] = cost
+        group[2] = used + 1
+
+    def dominated(self, state, cost):
+        group = self.groups.get(self.key(state.counts))
+        if group is None:
+            return False
+        counts, costs, used = group
+        return bool(((counts[:used] >= state.counts).all(axis=1) & (costs[:used] <= cost)).any())
+
+def search(graph, state, is_goal, limit, heuristic, goals, consume_limit, stats=None, probe=None, dominance=None):
+    # stats, if given, is a dict that gets the number of states visited under 'states', found or not. probe, if
+    # given, is an instrument.Probe that counts and times what the search does. dominance, if given, is a Dominance
+    # that successors are checked against before they are queued
+
+    start_time = time()
+    if probe is not None:
+        graph = probe.wrap_graph(graph)
+        heuristic = probe.wrap_heuristic(heuristic)
 
     # Implement your search here! Use your heuristic here!
     # When you find a path to the goal return a list of tuples [(state, action)]
     # representing the path. Each element (tuple) of the list represents a state
     # in the path and the action that took you to this state
+    prune = make_pruner(state, goals, consume_limit)
+
     in_game_time=0
     state_count = 0         #tracks how many states we traversed in the search
     distances = {}          #tracks the cost so far of a path for each node
@@ -208,71 +680,293 @@ def search(graph, state, is_goal, limit, heuristic, goals):
     parentState[state]=None #tracks parent nodes for path building
     distances[state] = 0
     queue.append((0, state, 0, 0))
-    while time() - start_time < limit:
+    if probe is not None:
+        probe.timers['setup'] += time() - start_time
+    while queue and time() - start_time < limit:
         state_count += 1
         #Dequeue
         priority, currentState, turn, game_time = heappop(queue)
+        if probe is not None:
+            probe.expanded(len(queue))
         #update cost
         in_game_time += game_time
         curr_dist = distances[currentState]
         #if we're at the goal, stop and print time data, then return the path
         if is_goal(currentState):
-            print ("Compute Time: " + str(time()))
+            print ("Compute Time: " + str(time() - start_time))
             print ("Game Time: {cost = " + str(distances[currentState]) + "} {len = " + str(turn) + "}")
             print ("States Visited: " + str(state_count))
+            if stats is not None:
+                stats['states'] = state_count
+            found_time = time()
             path = []
             path.append(( currentState, "End of Path") )
             while parentState[currentState] != None:
                 path.insert(0,parentState[currentState])
                 currentState = parentState[currentState][0]
+            if probe is not None:
+                probe.timers['search'] += found_time - start_time
+                probe.timers['path'] += time() - found_time
             return path
+        if dominance is not None:
+            dominance.add(currentState, curr_dist)
         #get adjacent states
         for i in graph(currentState):
-            #assume we want to go down this path
-            move = True
             name, nextState, cost = i
             if not name:
                 break
             #check the properties of the resulting state
-            for material in nextState.keys():
-                #if we end up making more of any item than we'll ever need, ignore this path
-                if material in consume_limit:
-                    if currentState[material] >= consume_limit[material] and nextState[material] > currentState[material]:
-                        move = False
-                        break
-                #if we end up making more than an arbitrary amount of wood, ignore this path
-                elif nextState[material] > 8 and material not in goals:
-                    move = False
-                    break
-                #if we end up making more than one of any tool, ignore this path
-                for tool in tools:
-                    if tool in nextState.keys() and nextState[tool] > 1:
-                        move = False
-                        break
-                #if we end up making more of a goal item than we need, ignore this path
-                if material in goals:
-                    if nextState[material] > currentState[material] and currentState[material] >= goals[material]:
-                        move = False
-                        break
+            reason = prune(currentState, nextState)
             #if this is a path worth considering, add it to the queue
-            if move:
+            if reason is None:
                 pathcost = curr_dist + cost
                 if nextState not in distances or pathcost < distances[nextState]:
+                    if dominance is not None and dominance.dominated(nextState, pathcost):
+                        if probe is not None:
+                            probe.count('pruned: dominated')
+                        continue
                     distances[nextState] = pathcost
                     parentState[nextState] = (currentState, name)
                     adjusted_cost = pathcost + heuristic(currentState, nextState)
                     heappush(queue, (adjusted_cost, nextState, turn + 1, cost))
-        print ("")
+                elif probe is not None:
+                    probe.count('duplicates')
+            elif probe is not None:
+                probe.count('pruned: ' + reason)
 
 
     # Failed to find a path
+    if stats is not None:
+        stats['states'] = state_count
+    if probe is not None:
+        probe.timers['search'] += time() - start_time
     print(time() - start_time, 'seconds.')
     print("Failed to find a path from", state, 'within time limit.')
     return None
 
+def anytime_search(graph, state, is_goal, limit, heuristic, goals, consume_limit, weights=(5, 3, 2, 1.5, 1.2, 1),
+                   stats=None, probe=None):
+    # Anytime repairing A* (ARA*). The first pass runs with a large heuristic weight so a plan comes back almost
+    # immediately, and each later pass lowers the weight and tightens the plan, keeping the open list, the costs
+    # and the parent links of the passes before it. States whose cost improves after they were expanded wait in
+    # incons until the next pass, instead of being expanded again in this one.
+    # Returns (path, bound) for the best plan found before the time limit, where the plan costs at most bound times
+    # the optimal cost. The bound only holds for an admissible heuristic, e.g. make_relaxed_heuristic. (None, None)
+    # if no plan was found. stats and probe work as in search.
+    start_time = time()
+    if probe is not None:
+        graph = probe.wrap_graph(graph)
+        heuristic = probe.wrap_heuristic(heuristic)
+
+    prune = make_pruner(state, goals, consume_limit)
+
+    state_count = 0
+    distances = {state: 0}
+    parentState = {state: None}
+    estimates = {state: heuristic(state, state)}    #heuristic value of each state, worked out once
+    best = None                                     #cheapest goal state found so far
+    queue = [(weights[0] * estimates[state], state)]
+    incons = set()
+    bound = None
+
+    def lower_bound():
+        #no plan can be cheaper than the smallest unweighted f among the states still waiting to be expanded
+        waiting = [s for f, s in queue] + list(incons)
+        return min([distances[s] + estimates[s] for s in waiting] or [float('inf')])
+
+    for weight in weights:
+        closed = set()
+        while queue and time() - start_time < limit:
+            priority, currentState = queue[0]
+            #stop once no state in the queue can lead to a cheaper plan at this weight
+            if best is not None and priority >= distances[best]:
+                break
+            heappop(queue)
+            if currentState in closed or priority != distances[currentState] + weight * estimates[currentState]:
+                continue
+            closed.add(currentState)
+            state_count += 1
+            if probe is not None:
+                probe.expanded(len(queue))
+            if is_goal(currentState):
+                if best is None or distances[currentState] < distances[best]:
+                    best = currentState
+                continue
+            curr_dist = distances[currentState]
+            for name, nextState, cost in graph(currentState):
+                reason = prune(currentState, nextState)
+                if reason is not None:
+                    if probe is not None:
+                        probe.count('pruned: ' + reason)
+                    continue
+                pathcost = curr_dist + cost
+                if nextState not in distances or pathcost < distances[nextState]:
+                    distances[nextState] = pathcost
+                    parentState[nextState] = (currentState, name)
+                    if nextState not in estimates:
+                        estimates[nextState] = heuristic(currentState, nextState)
+                    if nextState in closed:
+                        incons.add(nextState)
+                    else:
+                        heappush(queue, (pathcost + weight * estimates[nextState], nextState))
+                elif probe is not None:
+                    probe.count('duplicates')
+        out_of_time = time() - start_time >= limit
+        if best is not None:
+            floor = lower_bound()
+            bound = min(weight, distances[best] / floor) if floor > 0 else weight
+            bound = max(bound, 1.0)
+            print("Weight " + str(weight) + ": {cost = " + str(distances[best]) + "} {bound = " + str(round(bound, 3)) +
+                  "} {states = " + str(state_count) + "} {time = " + str(round(time() - start_time, 3)) + "}")
+        if out_of_time:
+            break
+        #carry everything still waiting over to the next pass, keyed with the next weight
+        waiting = set(s for f, s in queue) | incons
+        incons = set()
+        queue = []
+        next_weight = weights[min(weights.index(weight) + 1, len(weights) - 1)]
+        for s in waiting:
+            heappush(queue, (distances[s] + next_weight * estimates[s], s))
+
+    if stats is not None:
+        stats['states'] = state_count
+    if probe is not None:
+        probe.timers['search'] += time() - start_time
+    if best is None:
+        print(time() - start_time, 'seconds.')
+        print("Failed to find a path from", state, 'within time limit.')
+        return None, None
+    path = [(best, "End of Path")]
+    currentState = best
+    while parentState[currentState] != None:
+        path.insert(0, parentState[currentState])
+        currentState = parentState[currentState][0]
+    return path, bound
+
+def bounded_search(graph, state, is_goal, limit, heuristic, goals, consume_limit, node_budget=100000, stats=None,
+                   probe=None):
+    # Memory-bounded alternative to search: IDA* with a transposition table. Each pass is a depth-first search that
+    # skips any successor whose f = cost + heuristic is over the threshold, and the next pass raises the threshold to
+    # the smallest f that was skipped. Only the current path is kept, plus the table, which records for each state
+    # the cost it was reached at in the current pass (so it isn't searched twice at no lower cost) and a learned
+    # heuristic value: the smallest f skipped below it, less its cost. The learned values stop later passes from
+    # walking back into subtrees that can't fit under their threshold.
+    # The table holds at most node_budget states. Once it is full, the least recently recorded state is dropped to
+    # make room, which costs time (that state may be searched again) but never memory. With an admissible heuristic
+    # the first plan found is optimal. Returns a [(state, action)] path or None. stats and probe work as in search.
+    start_time = time()
+    if probe is not None:
+        graph = probe.wrap_graph(graph)
+        heuristic = probe.wrap_heuristic(heuristic)
+
+    prune = make_pruner(state, goals, consume_limit)
+    table = {}              #transposition table: state -> [cost it was reached at, pass, learned heuristic value]
+
+    def estimate(currentState, nextState):
+        value = heuristic(currentState, nextState)
+        entry = table.get(nextState)
+        if entry is not None and entry[2] > value:
+            return entry[2]
+        return value
+
+    def children(currentState, curr_dist):
+        #successors worth considering, cheapest f first
+        found = []
+        for name, nextState, cost in graph(currentState):
+            reason = prune(currentState, nextState)
+            if reason is None:
+                pathcost = curr_dist + cost
+                found.append((pathcost + estimate(currentState, nextState), pathcost, nextState, name))
+            elif probe is not None:
+                probe.count('pruned: ' + reason)
+        found.sort()
+        return iter(found)
+
+    def record(nextState, pathcost, learned):
+        #entries are kept in least recently recorded order, and the oldest makes room once the table is full
+        entry = table.pop(nextState, None)
+        if entry is not None:
+            entry[0], entry[1] = pathcost, passes
+            entry[2] = max(entry[2], learned)
+        else:
+            if len(table) >= node_budget:
+                del table[next(iter(table))]
+            entry = [pathcost, passes, learned]
+        table[nextState] = entry
+
+    if is_goal(state):
+        return [(state, "End of Path")]
+    state_count = 0
+    threshold = heuristic(state, state)
+    passes = 0
+    while time() - start_time < limit:
+        #each frame is [state, cost so far, remaining children, smallest f skipped below it]
+        stack = [[state, 0, children(state, 0), float('inf')]]
+        actions = []
+        on_path = set([state])
+        while stack and time() - start_time < limit:
+            frame = stack[-1]
+            currentState, curr_dist, kids = frame[0], frame[1], frame[2]
+            deeper = False
+            for f, pathcost, nextState, name in kids:
+                if f > threshold:
+                    #children come cheapest first, so the rest are over the threshold too
+                    frame[3] = min(frame[3], f)
+                    break
+                if nextState in on_path:
+                    continue
+                entry = table.get(nextState)
+                if entry is not None and entry[1] == passes and entry[0] <= pathcost:
+                    if probe is not None:
+                        probe.count('duplicates')
+                    continue
+                state_count += 1
+                if probe is not None:
+                    probe.expanded(len(stack))
+                actions.append(name)
+                if is_goal(nextState):
+                    print("Compute Time: " + str(time() - start_time))
+                    print("Game Time: {cost = " + str(pathcost) + "} {len = " + str(len(actions)) + "}")
+                    print("States Visited: " + str(state_count))
+                    if stats is not None:
+                        stats['states'] = state_count
+                    if probe is not None:
+                        probe.timers['search'] += time() - start_time
+                    path = [(frame[0], action) for frame, action in zip(stack, actions)]
+                    path.append((nextState, "End of Path"))
+                    return path
+                record(nextState, pathcost, 0)
+                stack.append([nextState, pathcost, children(nextState, pathcost), float('inf')])
+                on_path.add(nextState)
+                deeper = True
+                break
+            if not deeper:
+                #every child is done or over the threshold: learn from it and back up
+                stack.pop()
+                on_path.discard(currentState)
+                if actions:
+                    actions.pop()
+                if frame[3] < float('inf'):
+                    record(currentState, curr_dist, frame[3] - curr_dist)
+                if stack:
+                    stack[-1][3] = min(stack[-1][3], frame[3])
+        if not stack:
+            if frame[3] == float('inf'):
+                break
+            threshold = frame[3]
+        passes += 1
+
+    if stats is not None:
+        stats['states'] = state_count
+    if probe is not None:
+        probe.timers['search'] += time() - start_time
+    print(time() - start_time, 'seconds.')
+    print("Failed to find a path from", state, 'within the time limit or without a path.')
+    return None
+
 if __name__ == '__main__':
-    with open('Crafting.json') as f:
-        Crafting = json.load(f)
+    from loader import load_crafting
+    Crafting = load_crafting('Crafting.json')
 
     # # List of items that can be in your inventory:
     # print('All items:', Crafting['Items'])
@@ -286,34 +980,34 @@ if __name__ == '__main__':
     # # Dict of crafting recipes (each is a dict):
     # print('Example recipe:','craft stone_pickaxe at bench ->',Crafting['Recipes']['craft stone_pickaxe at bench'])
 
-    # Build rules
-    all_recipes = []
-    consume_limit = {}          #tracks the maximum amount of any item other than wood needed for any recipe
-    priority_list = {}          #determines which items we'll want to make to reach the goal
-    rules = []                  #gathers the rules for making the priority list
-    for name, rule in Crafting['Recipes'].items():
-        rules.append(rule)
-        checker = make_checker(rule)
-        effector = make_effector(rule)
-        recipe = Recipe(name, checker, effector, rule['Time'])
-        all_recipes.append(recipe)
-
-    # Create a function which checks for the goal
-    is_goal = make_goal_checker(Crafting['Goal'])
-
-    # Initialize first state from initial inventory
-    state = State({key: 0 for key in Crafting['Items']})
-
-    state.update(Crafting['Initial'])
-
-    # Makes heuristic
-    heuristic = make_heuristic(Crafting['Goal'])
-
-    # Search for a solution
-    resulting_plan = search(graph, state, is_goal, 30, heuristic, Crafting['Goal'])
+    # Compile the recipes once. The planner holds the layout, the recipe table and the consume limits, and folds the
+    # recurring runs of recipes for each goal into macro-actions it searches over. make_relaxed_heuristic is
+    # admissible (heuristic='relaxed'), but it expands more states than the priority list heuristic. Even with it the
+    # plan is only optimal with macros=False: the macros leave out some of the primitive gathering recipes, so the
+    # cheapest plan over them can cost more than the cheapest plan over the recipes
+    from planner import Planner
+    planner = Planner.from_crafting(Crafting, heuristic='priority', macros=True, skip_dominated=True)
+
+    # An optional argument names a trace file, e.g. python craft_planner.py trace.jsonl. The planner then counts and
+    # times what it does, writes samples of the open list and memory there, and a summary is printed at the end
+    probe = None
+    if len(sys.argv) > 1:
+        from instrument import Probe
+        probe = Probe(trace=sys.argv[1])
+
+    def solve(state, goal):
+        return planner.plan(state, goal, 30, probe=probe)
+
+    # Plans are cached next to this file, so solving the same problem again skips the search. The initial state is
+    # built from Crafting['Initial'] on a cache miss
+    cache = PlanCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.plan_cache'))
+    resulting_plan = cached_search(cache, Crafting, planner.layout, solve)
 
     if resulting_plan:
         # Print resulting plan
         for state, action in resulting_plan:
             print('\t',state)
             print(action)
+    if probe is not None:
+        probe.report()
+        print(probe)
@@ -1,4 +1,3 @@
-import json
 from collections import namedtuple, defaultdict, OrderedDict
 from timeit import default_timer as time
 from heapq import heappop, heappush
@@ -119,83 +118,114 @@ def graph(state):
         if r.check(state):
             yield (r.name, r.effect(state), r.cost)
 
-def make_heuristic(goal):
-    # Makes the heuristic function to prioritize the goal if it's the next move
-    
+#the constants of make_heuristic, each picked by hand for the goal its branch is for, which tuner.py searches over.
+#They are taken off a state's priority when it has what the name says (the ingot and rail ones for each one held)
+WEIGHTS = {
+    'furnace': 90,
+    'ore_for_ingots': 10,
+    'two_ingots': 10,
+    'three_ingots': 20,
+    'iron_pickaxe': 200,
+    'last_ore_smelted': 6000,
+    'ingot': 300,
+    'ingot_before_pickaxe': 500,
+    'third_ingot': 5000000000,
+    'pickaxe_stick': 5000,
+    'rail_iron_pickaxe': 15000,
+    'six_ingots': 4000,
+    'cart': 7000,
+    'cart_iron_pickaxe': 4000,
+    'rail_stick': 3000,
+    'rail': 5000,
+    'goal': 1000000,
+}
+
+def make_heuristic(goal, weights=None):
+    # Makes the heuristic function to prioritize the goal if it's the next move. weights, if given, replaces some or
+    # all of WEIGHTS
+    #checks the goal itself, so the heuristic doesn't depend on a global is_goal
+    reached = make_goal_checker(goal)
+    w = dict(WEIGHTS, **(weights or {}))
+
     def heuristic(currstate, state):
         # Implement your heuristic here!
         reduction=0
         if "iron_pickaxe" in goal.keys() and state["iron_pickaxe"]<goal["iron_pickaxe"]:
             if state["furnace"]>0:
-                reduction-=90
+                reduction-=w['furnace']
             if state["ore"]>1 and state["ingot"]<2:
-                reduction-=10
+                reduction-=w['ore_for_ingots']
             if state["ingot"]>1:
-                reduction-=10
+                reduction-=w['two_ingots']
             if state["ingot"]>2:
-                reduction-=20
+                reduction-=w['three_ingots']
             if state["iron_pickaxe"]>0:
-                reduction-= state["iron_pickaxe"]*200
+                reduction-= state["iron_pickaxe"]*w['iron_pickaxe']
         if "cart" in goal.keys() and "rail" not in goal.keys():
             if state["furnace"]>0:
-                reduction-=90
+                reduction-=w['furnace']
             if currstate["ore"]==1 and state["ore"]==0 and state["ingot"]>1:
-                reduction-=6000
+                reduction-=w['last_ore_smelted']
             if state["ore"]>0 and state["ingot"]<6:
-                reduction-=state["ingot"]*300
+                reduction-=state["ingot"]*w['ingot']
             #if state["ingot"]>1:
              #   reduction-= state["ingot"]*100
         if "cart" in goal.keys() and "rail" in goal.keys():
             if state["furnace"]>0:
-                reduction-=90
+                reduction-=w['furnace']
             if goal["rail"]>16:
                 if currstate["iron_pickaxe"]==0:
 
                     if state["ore"]>1 or state["coal"]>1:
                         return 0
                     if state["ingot"]>currstate["ingot"]:
-                        reduction-=state["ingot"]*500
+                        reduction-=state["ingot"]*w['ingot_before_pickaxe']
                     if currstate["ingot"]==2 and state["ingot"]==3:
-                        reduction-=5000000000
+                        reduction-=w['third_ingot']
                     if currstate["ingot"]==3:
                         if state["stick"]>0:
-                            reduction-=5000
+                            reduction-=w['pickaxe_stick']
                 if currstate["ingot"]==3 and currstate["stick"]==1 and state["iron_pickaxe"]==0:
                     return 0
                 if state["iron_pickaxe"]>0:
-                    reduction-=15000
+                    reduction-=w['rail_iron_pickaxe']
                 if state["cobble"]>0 and state["iron_pickaxe"]>0:
                     return 0
                     
             if state["ore"]==2 and state["ingot"]==0:
                 return 0
             if currstate["ore"]==1 and state["ore"]==0 and state["ingot"]>1:
-                reduction-=6000
+                reduction-=w['last_ore_smelted']
             if state["ingot"]==6 and state["ore"]==0 and state["coal"]==0:
-                reduction-=4000
+                reduction-=w['six_ingots']
             if state["ore"]>0 and state["ingot"]<7:
-                reduction-=state["ingot"]*300
+                reduction-=state["ingot"]*w['ingot']
             if state["cart"]==1:
-                reduction-=7000
+                reduction-=w['cart']
                 if goal["rail"]>16:
                     if state["iron_pickaxe"]>0:
-                        reduction-=4000
+                        reduction-=w['cart_iron_pickaxe']
                 if state["cobble"]>0:
                     return 10
                 if currstate["ingot"]==6 and state["stick"]==1:
-                    reduction-=3000
+                    reduction-=w['rail_stick']
                 if state["rail"]>0:
-                    reduction-=state["rail"]*5000
-        if is_goal(state):
-            reduction-=1000000
+                    reduction-=state["rail"]*w['rail']
+        if reached(state):
+            reduction-=w['goal']
         return reduction
     
     return heuristic
         
 
-def search(graph, state, is_goal, limit, heuristic):
+def search(graph, state, is_goal, limit, heuristic, stats=None, probe=None):
+    # stats, if given, is a dict that gets the number of states visited under 'states', found or not. probe, if
+    # given, is an instrument.Probe that counts and times what the search does
 
     start_time = time()
+    if probe is not None:
+        graph = probe.wrap_graph(graph, len(all_recipes))
+        heuristic = probe.wrap_heuristic(heuristic)
 
     # Implement your search here! Use your heuristic here!
     # When you find a path to the goal return a list of tuples [(state, action)]
@@ -219,13 +249,16 @@ def search(graph, state, is_goal, limit, heuristic):
             in_game_time+=game_time
             curr_dist=distances[currentState]
             stateCount+=1
-            print(priority)
-            print(currentState)
-            print("turn:", turn)
+            if probe is not None:
+                probe.expanded(len(queue))
             if is_goal(currentState):
-                print ("Compute Time: " + str(time()))
+                print ("Compute Time: " + str(time() - start_time))
                 print ("States visited:", stateCount)
                 print ("Game Time: {cost = " + str(distances[currentState]) + "} {len = " + str(turn) + "}")
+                if stats is not None:
+                    stats['states'] = stateCount
+                if probe is not None:
+                    probe.timers['search'] += time() - start_time
                 path = []
                 path.append(( currentState, "End of Path") )
                 while parentState[currentState] != None:
@@ -234,34 +267,41 @@ def search(graph, state, is_goal, limit, heuristic):
                 return path
             #get adjacent states
             for i in graph(currentState):
-                move=True
+                reason=None
                 name, nextState, cost = i
                 if not name:
                     break
                 for material in nextState.keys():
                     if nextState[material]>40:
-                        move=False
+                        reason='item cap'
                     for tool in tools:
                         if tool in nextState.keys() and nextState[tool]>1:
-                            move=False
-                if move:
+                            reason='tool duplicate'
+                if reason is None:
                     pathcost=curr_dist+cost
                     if nextState not in distances or pathcost<distances[nextState]:
                         distances[nextState]=pathcost
                         parentState[nextState]=(currentState, name)
                         adjusted_cost = pathcost + heuristic(currentState, nextState)
                         heappush(queue, (adjusted_cost, nextState, turn+1, cost))
-            print ("")
+                    elif probe is not None:
+                        probe.count('duplicates')
+                elif probe is not None:
+                    probe.count('pruned: ' + reason)
 
 
     # Failed to find a path
+    if stats is not None:
+        stats['states'] = stateCount
+    if probe is not None:
+        probe.timers['search'] += time() - start_time
     print(time() - start_time, 'seconds.')
     print("Failed to find a path from", state, 'within time limit.')
     return None
 
 if __name__ == '__main__':
-    with open('Crafting.json') as f:
-        Crafting = json.load(f)
+    from loader import load_crafting
+    Crafting = load_crafting('Crafting.json')
 
     # # List of items that can be in your inventory:
     # print('All items:', Crafting['Items'])
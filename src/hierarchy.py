@@ -0,0 +1,277 @@
+from collections import namedtuple
+from math import ceil
+from threading import Lock
+from timeit import default_timer as time
+
+import numpy as np
+
+from craft_planner import make_priorities, resources
+from regression import replay
+from simulator import Simulator
+
+# Plans a large goal as a row of small ones. make_priorities already breaks a goal down into the ingredients and tools
+# it takes, and here that breakdown becomes explicit subgoals, planned one after another from where the last one left
+# off:
+#   tool    have a tool the goal's recipes need (bench, furnace, stone_pickaxe, iron_pickaxe...), cheapest tools first
+#   stock   have so many more of an ingredient the goal's own recipes consume (ingot, stick, plank), at most CHUNK at a
+#           time, so "20 ingots" is three searches, two of them the same
+#   goal    the goal itself, by then only the last few crafts
+# Each subgoal only has to keep what the ones before it made (its target is theirs plus its own), and is planned with
+# a short search. Subplans are kept in a SubplanLibrary, by the subgoal and the inventory of the items that could go
+# into it, so a subgoal met again from the same inventory (the next chunk of ingots, the next problem with the same
+# tools) is replayed instead of searched. The subplans, laid end to end, then get a short local optimization pass
+# (see improve), since each was planned without knowing what the next would need.
+#
+# The plan is rarely the cheapest there is, but each search is small: where one search over the whole goal has to
+# sort out every tool and ingredient at once, each subgoal here only has one of them left to sort out.
+
+#the most of an ingredient one subgoal asks for
+CHUNK = 8
+#seconds allowed for each subgoal's search. The last subgoal, the goal itself, gets whatever is left
+SUBGOAL_DEADLINE = 2
+#rounds of improve, each dropping or swapping out one step
+IMPROVE_ROUNDS = 32
+
+#kind is 'tool', 'stock' or 'goal', and items the ((item, amount), ...) it asks for, amounts on top of what's held
+#for a stock
+Subgoal = namedtuple('Subgoal', ['kind', 'items'])
+
+
+def describe(subgoal):
+    if subgoal.kind == 'tool':
+        return 'have ' + subgoal.items[0][0]
+    if subgoal.kind == 'stock':
+        return 'have %d more %s' % (subgoal.items[0][1], subgoal.items[0][0])
+    return 'goal ' + ', '.join('%s %d' % item for item in subgoal.items)
+
+
+def producer(item, recipes):
+    # The recipe make_priority_list breaks an item down by: the first one that produces it
+    for rule in recipes.values():
+        if item in rule['Produces']:
+            return rule
+    return None
+
+
+def tool_ranks(recipes):
+    # How deep in the tool chain each item is: 0 for what can be made with no tools, and one more than the deepest
+    # tool a recipe requires otherwise, by the recipe that keeps it lowest
+    ranks = {}
+    changed = True
+    while changed:
+        changed = False
+        for rule in recipes.values():
+            needs = list(rule.get('Consumes', {})) + list(rule.get('Requires', {}))
+            if not all(item in ranks for item in needs):
+                continue
+            rank = max([ranks[item] for item in rule.get('Consumes', {})] +
+                       [ranks[tool] + 1 for tool in rule.get('Requires', {})] + [0])
+            for item in rule['Produces']:
+                if rank < ranks.get(item, float('inf')):
+                    ranks[item] = rank
+                    changed = True
+    return ranks
+
+
+def closure(items, recipes):
+    # Every item that could go into making any of items, by any recipe: their ingredients and tools, theirs, and so on
+    found = set()
+    waiting = list(items)
+    while waiting:
+        item = waiting.pop()
+        for rule in recipes.values():
+            if item in rule['Produces']:
+                for other in list(rule.get('Consumes', {})) + list(rule.get('Requires', {})):
+                    if other not in found:
+                        found.add(other)
+                        waiting.append(other)
+    return found
+
+
+def decompose(goal, recipes, initial):
+    # The subgoals of a goal from the initial inventory (dicts of item amounts), in the order they are planned
+    ranks = tool_ranks(recipes)
+    tools = set(tool for rule in recipes.values() for tool in rule.get('Requires', {}))
+    priorities = make_priorities(goal, list(recipes.values()))
+    subgoals = []
+    wanted = [item for item, priority in priorities.items() if priority is True and not initial.get(item)]
+    for tool in sorted(wanted, key=lambda tool: (ranks.get(tool, float('inf')), tool)):
+        subgoals.append(Subgoal('tool', ((tool, 1),)))
+    #what the goal's own recipes consume, for as many firings as the goal takes
+    demand = {}
+    for item, amount in goal.items():
+        rule = producer(item, recipes)
+        missing = amount - initial.get(item, 0)
+        if rule is None or missing <= 0:
+            continue
+        firings = int(ceil(missing / float(rule['Produces'][item])))
+        for ingredient, each in rule.get('Consumes', {}).items():
+            demand[ingredient] = demand.get(ingredient, 0) + firings * each
+    #the costliest ingredients first, so the cheap ones made last aren't used up making them
+    for item in sorted(demand, key=lambda item: (-ranks.get(item, 0), item)):
+        if item in tools or item in resources:
+            continue
+        amount = demand[item] - initial.get(item, 0)
+        while amount > 0:
+            subgoals.append(Subgoal('stock', ((item, min(amount, CHUNK)),)))
+            amount -= CHUNK
+    #a goal item made straight from resources has no stock to break it down by, so it is its own stock, but for the
+    #last chunk, which the goal subgoal makes
+    for item in sorted(goal):
+        rule = producer(item, recipes)
+        if item in tools or rule is None or not all(other in resources for other in rule.get('Consumes', {})):
+            continue
+        amount = goal[item] - initial.get(item, 0) - CHUNK
+        while amount > 0:
+            subgoals.append(Subgoal('stock', ((item, min(amount, CHUNK)),)))
+            amount -= CHUNK
+    subgoals.append(Subgoal('goal', tuple(sorted(goal.items()))))
+    return subgoals
+
+
+class SubplanLibrary(object):
+    """ Subplans found for subgoals, as lists of action names, by (subgoal, relevant inventory): the subgoal, and the
+        amounts held of every item that could go into it (see closure). Holds at most size subplans, dropping the
+        oldest first, and can be shared between threads.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.subplans = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.subplans.get(key)
+
+    def put(self, key, subplan):
+        with self.lock:
+            if key not in self.subplans and len(self.subplans) >= self.size:
+                del self.subplans[next(iter(self.subplans))]
+            self.subplans[key] = list(subplan)
+
+
+_libraries = {}             #(CompiledRecipes, options) -> SubplanLibrary
+_libraries_lock = Lock()
+
+
+def subplan_library(compiled, options):
+    # The shared SubplanLibrary for a recipe set and the options its subgoals are planned with (a hashable tuple)
+    with _libraries_lock:
+        library = _libraries.get((compiled, options))
+        if library is None:
+            library = _libraries[(compiled, options)] = SubplanLibrary()
+    return library
+
+
+def improve(simulator, rows, initial, goal, rounds=IMPROVE_ROUNDS):
+    # A local optimization pass over a plan (an array of table rows). Each round replays, in one run_many, the plan
+    # with each step left out and with each step swapped for a cheaper recipe making the same, and keeps the change
+    # that saves the most while still reaching the goal. Returns the rows and the number of changes kept
+    table = simulator.table
+    costs = simulator.costs
+    cheaper = [[other for other in range(len(costs))
+                if costs[other] < costs[row] and (table.produces[other] == table.produces[row]).all()]
+               for row in range(len(costs))]
+    rows = np.asarray(rows, dtype=np.int64)
+    changes = 0
+    for _ in range(rounds):
+        candidates = []
+        savings = []
+        for step, row in enumerate(rows.tolist()):
+            candidates.append(np.delete(rows, step))
+            savings.append(costs[row])
+            for other in cheaper[row]:
+                swapped = rows.copy()
+                swapped[step] = other
+                candidates.append(swapped)
+                savings.append(costs[row] - costs[other])
+        if not candidates:
+            break
+        outcomes = simulator.run_many(candidates, initial, goal)
+        kept = [index for index, outcome in enumerate(outcomes) if outcome.goal_met]
+        if not kept:
+            break
+        rows = candidates[max(kept, key=lambda index: savings[index])]
+        changes += 1
+    return rows, changes
+
+
+def hierarchical_plan(planner, state, goal, deadline=30, library=None, subgoal_deadline=SUBGOAL_DEADLINE, stats=None,
+                      probe=None):
+    # Plans from state to goal subgoal by subgoal (see the top of this file), planning each with planner (an A*
+    # planner.Planner) and reusing the subplans in library, if given. Returns a [(state, action)] plan over the
+    # primitive recipes, or None if the goal itself couldn't be planned in time. stats, if given, gets the states
+    # visited by all the searches under 'states', the number of subgoals under 'subgoals', how many of them were
+    # replayed from the library under 'reused', and how many changes improve made under 'improved'
+    start_time = time()
+    compiled = planner.compiled
+    recipes = compiled.recipes
+    simulator = Simulator(compiled.table)
+    initial = dict(item for item in state.items() if item[1])
+    subgoals = decompose(goal, recipes, initial)
+    found = {'states': 0, 'subgoals': len(subgoals), 'reused': 0, 'improved': 0}
+    rows = []
+    current = state
+    target = {}
+    for subgoal in subgoals:
+        if subgoal.kind == 'goal':
+            wanted = dict(goal)
+            limit = deadline - (time() - start_time)
+        else:
+            item, amount = subgoal.items[0]
+            wanted = dict(target)
+            wanted[item] = max(wanted.get(item, 0), 1) if subgoal.kind == 'tool' else current[item] + amount
+            limit = min(subgoal_deadline, deadline - (time() - start_time))
+        inventory = dict(item for item in current.items() if item[1])
+        key = (subgoal, tuple((item, current[item]) for item in sorted(closure(dict(subgoal.items), recipes))))
+        subplan = library.get(key) if library is not None else None
+        if subplan is not None and simulator.run(subplan, inventory, wanted).goal_met:
+            found['reused'] += 1
+        else:
+            sub = {}
+            plan = planner.plan(current, wanted, limit, stats=sub, probe=probe)
+            found['states'] += sub.get('states') or 0
+            if plan is None:
+                if subgoal.kind == 'goal':
+                    if stats is not None:
+                        stats.update(found)
+                    return None
+                #left to the subgoals after it, which have the time for it
+                continue
+            subplan = [action for current_state, action in plan[:-1]]
+            if library is not None:
+                library.put(key, subplan)
+        target = wanted
+        subplan_rows = simulator.rows(subplan)
+        rows.extend(subplan_rows.tolist())
+        current = current.with_counts(tuple(simulator.trajectory(subplan_rows, inventory)[-1].tolist()))
+
+    rows, found['improved'] = improve(simulator, rows, initial, goal)
+    plan = replay(compiled.table, state, rows.tolist())
+    if stats is not None:
+        stats.update(found)
+    print("Compute Time: " + str(time() - start_time))
+    print("Game Time: {cost = " + str(sum(simulator.costs[rows])) + "}")
+    print("States Visited: " + str(found['states']))
+    return plan
+
+
+if __name__ == '__main__':
+    from loader import load_crafting
+    from planner import Planner
+    Crafting = load_crafting('Crafting.json')
+
+    # Breaks the problem down into subgoals, then plans it twice: the second time every subgoal is in the library
+    initial = Crafting['Initial']
+    for subgoal in decompose(Crafting['Goal'], Crafting['Recipes'], initial):
+        print(describe(subgoal))
+    planner = Planner.from_crafting(Crafting, search='hierarchical')
+    for attempt in range(2):
+        stats = {}
+        resulting_plan = planner.plan(initial, Crafting['Goal'], 30, stats=stats)
+        print(stats)
+    if resulting_plan:
+        for state, action in resulting_plan:
+            print('\t', state)
+            print(action)
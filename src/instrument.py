@@ -0,0 +1,99 @@
+import json
+import resource
+from collections import defaultdict
+from contextlib import contextmanager
+from timeit import default_timer as time
+
+
+class Probe(object):
+    """ Collects what a search does, for finding out where the time of a slow goal goes. The searches, the pruner and
+        Planner.plan take an optional probe; without one they skip every bit of this, so a search that isn't being
+        looked at only pays an `is not None` check per expansion.
+
+        counters    expanded states, check/effect/heuristic calls, pruned successors by reason ('pruned: tool
+                    duplicate', ...) and duplicate hits (a successor already reached at no greater cost)
+        timers      seconds spent in each phase ('setup', 'search', 'path', 'successors', 'heuristic', ...)
+        samples     every sample_every expansions: (expansions, seconds, open list size, peak memory in KB)
+
+        Every sample and the final report are also passed to callback(event, data), if given, and written as a JSON
+        line to trace, a file name or an open file, if given.
+    """
+
+    def __init__(self, sample_every=1000, callback=None, trace=None):
+        self.sample_every = sample_every
+        self.callback = callback
+        self.trace = open(trace, 'w') if isinstance(trace, str) else trace
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+        self.samples = []
+        self.start_time = time()
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    @contextmanager
+    def timer(self, phase):
+        start_time = time()
+        try:
+            yield
+        finally:
+            self.timers[phase] += time() - start_time
+
+    def expanded(self, open_size):
+        # Called once per expanded state, with the size of the open list. Takes a sample every sample_every calls
+        self.counters['expanded'] += 1
+        if self.counters['expanded'] % self.sample_every == 0:
+            sample = (self.counters['expanded'], time() - self.start_time, open_size,
+                      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+            self.samples.append(sample)
+            self.event('sample', {'expanded': sample[0], 'time': sample[1], 'open': sample[2], 'peak_kb': sample[3]})
+
+    def wrap_graph(self, graph, checks=None):
+        # graph, counting its time, the recipe checks it makes (checks per call) and the successors it makes
+        # (effects). A RecipeTable's successors checks every recipe in the table once per call
+        if checks is None:
+            checks = len(getattr(getattr(graph, '__self__', None), 'names', ()))
+        counters = self.counters
+        timers = self.timers
+
+        def counted(state):
+            start_time = time()
+            successors = list(graph(state))
+            timers['successors'] += time() - start_time
+            counters['checks'] += checks
+            counters['effects'] += len(successors)
+            return successors
+
+        return counted
+
+    def wrap_heuristic(self, heuristic):
+        counters = self.counters
+        timers = self.timers
+
+        def counted(currState, nextState):
+            start_time = time()
+            value = heuristic(currState, nextState)
+            timers['heuristic'] += time() - start_time
+            counters['heuristic calls'] += 1
+            return value
+
+        return counted
+
+    def event(self, name, data):
+        if self.callback is not None:
+            self.callback(name, data)
+        if self.trace is not None:
+            self.trace.write(json.dumps(dict(data, event=name)) + '\n')
+
+    def report(self):
+        # Everything collected so far as a dict, which is also sent out as a 'report' event
+        data = {'counters': dict(self.counters), 'timers': dict(self.timers), 'samples': list(self.samples)}
+        self.event('report', data)
+        if self.trace is not None:
+            self.trace.flush()
+        return data
+
+    def __str__(self):
+        lines = [name + ': ' + str(value) for name, value in sorted(self.counters.items())]
+        lines += [phase + ': ' + str(round(seconds, 4)) + ' s' for phase, seconds in sorted(self.timers.items())]
+        return '\n'.join(lines)
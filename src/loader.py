@@ -0,0 +1,218 @@
+import json
+import os
+import pickle
+from hashlib import sha256
+
+# Loads a crafting file (Crafting.json), checks it, and compiles it for the planner, keeping the compiled form on disk
+# so that the next start with the same file skips all of that.
+#
+# A file is checked for everything the planner would otherwise trip over halfway into a search: unresolved merge
+# conflicts, JSON errors (reported with their line and column), keys given twice in one object (json.load would
+# quietly keep the last one), unknown keys, items that aren't in Items, and amounts and Times that aren't numbers of
+# the right kind. Every problem found is reported at once, in a CraftingError.
+#
+# The compiled form is the Layout and the two RecipeTables planner.CompiledRecipes is built around. They are pickled
+# along with the checked file into a bundle named by a hash of the file's bytes and of craft_planner.py, where those
+# classes are defined, so a file that changes in any way just gets a new bundle, and so does every file once the
+# planner's code changes (an old bundle might otherwise unpickle into objects the new code can't use). On a warm start
+# load_crafting reads the file, hashes it, and unpickles the bundle.
+
+BUNDLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.recipe_cache')
+#part of every bundle's name, so bundles written by an older version of this file are never read
+BUNDLE_VERSION = 1
+
+TOP_KEYS = ('Initial', 'Goal', 'Items', 'Recipes')
+RULE_KEYS = ('Produces', 'Consumes', 'Requires', 'Time')
+CONFLICT_MARKERS = ('<<<<<<<', '=======', '>>>>>>>')
+
+
+class CraftingError(ValueError):
+    """ A crafting file that can't be planned with. problems holds a message for each thing wrong with it. """
+
+    def __init__(self, path, problems):
+        self.path = path
+        self.problems = list(problems)
+        ValueError.__init__(self, path + ':\n' + '\n'.join('\t' + problem for problem in self.problems))
+
+
+def find_crafting(path='Crafting.json'):
+    # The crafting file at path, or failing that the one in the same directory whose name only differs in case (the
+    # mains open Crafting.json, the file shipped is crafting.json)
+    if os.path.exists(path):
+        return path
+    directory, name = os.path.split(path)
+    if os.path.isdir(directory or '.'):
+        for other in sorted(os.listdir(directory or '.')):
+            if other.lower() == name.lower():
+                return os.path.join(directory, other)
+    raise CraftingError(path, ['no such file'])
+
+
+def parse(text, path):
+    # The crafting file's JSON, or a CraftingError saying why it isn't valid JSON
+    problems = []
+    for number, line in enumerate(text.splitlines(), 1):
+        if line.startswith(CONFLICT_MARKERS):
+            problems.append('line %d: unresolved merge conflict (%s)' % (number, line.strip()))
+    if problems:
+        raise CraftingError(path, problems)
+
+    def pairs(items):
+        #an object giving a key twice is an error, not a silent overwrite
+        found = {}
+        for key, value in items:
+            if key in found:
+                problems.append('%r is given more than once' % key)
+            found[key] = value
+        return found
+
+    try:
+        Crafting = json.loads(text, object_pairs_hook=pairs)
+    except ValueError as e:
+        #json.JSONDecodeError has the position, other ValueErrors don't
+        if hasattr(e, 'lineno'):
+            raise CraftingError(path, ['line %d column %d: %s' % (e.lineno, e.colno, e.msg)])
+        raise CraftingError(path, [str(e)])
+    if problems:
+        raise CraftingError(path, problems)
+    return Crafting
+
+
+def is_count(value):
+    #bools are ints to Python, but true is not an amount
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def validate(Crafting):
+    # Every problem with a parsed crafting file that would stop it being planned, as a list of messages
+    if not isinstance(Crafting, dict):
+        return ['the file should hold an object with ' + ', '.join(TOP_KEYS)]
+    problems = []
+    for key in Crafting:
+        if key not in TOP_KEYS:
+            problems.append('unknown key %r (expected %s)' % (key, ', '.join(TOP_KEYS)))
+    for key in TOP_KEYS:
+        if key not in Crafting:
+            problems.append('missing ' + key)
+    items = Crafting.get('Items', [])
+    if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+        problems.append('Items should be a list of item names')
+        items = []
+    for item in sorted(set(item for item in items if items.count(item) > 1)):
+        problems.append('Items lists %r more than once' % item)
+    known = set(items)
+
+    def check_amounts(where, amounts, allowed, kind):
+        if not isinstance(amounts, dict):
+            problems.append(where + ' should be an object of item amounts')
+            return
+        for item, amount in amounts.items():
+            if item not in known:
+                problems.append('%s: %r is not in Items' % (where, item))
+            elif not allowed(amount):
+                problems.append('%s: %r should be %s, not %r' % (where, item, kind, amount))
+
+    for key in ('Initial', 'Goal'):
+        if key in Crafting:
+            check_amounts(key, Crafting[key], is_count, 'a whole number of at least 0')
+    recipes = Crafting.get('Recipes', {})
+    if not isinstance(recipes, dict):
+        problems.append('Recipes should be an object of recipes by name')
+        recipes = {}
+    for name, rule in recipes.items():
+        where = 'recipe %r' % name
+        if not isinstance(rule, dict):
+            problems.append(where + ' should be an object')
+            continue
+        for key in rule:
+            if key not in RULE_KEYS:
+                problems.append('%s: unknown key %r (expected %s)' % (where, key, ', '.join(RULE_KEYS)))
+        if not rule.get('Produces'):
+            problems.append(where + ' produces nothing')
+        else:
+            check_amounts(where + ' Produces', rule['Produces'], lambda amount: is_count(amount) and amount > 0,
+                          'a whole number above 0')
+        if 'Consumes' in rule:
+            check_amounts(where + ' Consumes', rule['Consumes'], lambda amount: is_count(amount) and amount > 0,
+                          'a whole number above 0')
+        if 'Requires' in rule:
+            check_amounts(where + ' Requires', rule['Requires'],
+                          lambda amount: amount is True or (is_count(amount) and amount > 0), 'true or a count')
+        time = rule.get('Time')
+        if isinstance(time, bool) or not isinstance(time, (int, float)) or time < 0:
+            problems.append('%s: Time should be a number of at least 0, not %r' % (where, time))
+    return problems
+
+
+def code_hash():
+    # A hash of the source of the module the bundled objects are pickled from
+    import craft_planner
+    with open(craft_planner.__file__, 'rb') as f:
+        return sha256(f.read()).hexdigest()
+
+
+def bundle_path(data, directory=BUNDLE_DIR):
+    key = sha256(data + code_hash().encode('ascii')).hexdigest()[:20]
+    return os.path.join(directory, key + '-v' + str(BUNDLE_VERSION) + '.pickle')
+
+
+def load_bundle(path):
+    #a bundle that can't be read is rebuilt, whatever is wrong with it
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError):
+        return None
+
+
+def save_bundle(path, bundle):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    #write under a temporary name first, so another process never reads half a bundle
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(bundle, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_crafting(path='Crafting.json', directory=BUNDLE_DIR):
+    # Loads and checks a crafting file (see find_crafting for the file name), and makes sure planner.compile_recipes
+    # has its compiled recipes. Returns the Crafting dict, or raises a CraftingError. With directory None, nothing is
+    # read from or written to disk but the file itself
+    from planner import compile_recipes
+    path = find_crafting(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    cached = bundle_path(data, directory) if directory else None
+    bundle = load_bundle(cached) if cached and os.path.exists(cached) else None
+    if bundle is not None:
+        Crafting = bundle['Crafting']
+        compile_recipes(Crafting['Items'], Crafting['Recipes'], bundle['tables'])
+        return Crafting
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise CraftingError(path, ['not UTF-8 text: ' + str(e)])
+    Crafting = parse(text, path)
+    problems = validate(Crafting)
+    if problems:
+        raise CraftingError(path, problems)
+    compiled = compile_recipes(Crafting['Items'], Crafting['Recipes'])
+    if cached:
+        save_bundle(cached, {'Crafting': Crafting, 'tables': compiled.tables()})
+    return Crafting
+
+
+if __name__ == '__main__':
+    # Checks crafting files and compiles their bundles, e.g. python loader.py crafting.json
+    import sys
+    failed = False
+    for path in sys.argv[1:] or ['Crafting.json']:
+        try:
+            Crafting = load_crafting(path)
+        except CraftingError as e:
+            print(e)
+            failed = True
+            continue
+        print('%s: %d items, %d recipes' % (path, len(Crafting['Items']), len(Crafting['Recipes'])))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,144 @@
+from itertools import product
+from math import ceil
+
+
+def combine(recipes, steps):
+    # Folds a run of recipes into a single rule in the Crafting['Recipes'] format. Consumes is the stock the run needs
+    # up front for every step to be valid, Produces is what is left of each item afterwards on top of that stock, and
+    # Time is the total Time of the steps
+    balance = {}
+    consumes = {}
+    requires = {}
+    time = 0
+    for name in steps:
+        rule = recipes[name]
+        time += rule['Time']
+        requires.update(rule.get('Requires', {}))
+        for item, amount in rule.get('Consumes', {}).items():
+            balance[item] = balance.get(item, 0) - amount
+            consumes[item] = max(consumes.get(item, 0), -balance[item])
+        for item, amount in rule['Produces'].items():
+            balance[item] = balance.get(item, 0) + amount
+    macro = {'Produces': {}, 'Time': time}
+    for item, amount in balance.items():
+        if amount + consumes.get(item, 0) > 0:
+            macro['Produces'][item] = amount + consumes.get(item, 0)
+    if any(consumes.values()):
+        macro['Consumes'] = {item: amount for item, amount in consumes.items() if amount}
+    if requires:
+        macro['Requires'] = requires
+    return macro
+
+
+def demands(recipes, goal):
+    # The most of each item a plan for the goal might need at once: the goal amount, or what one recipe consumes
+    # times how often that recipe is repeated to cover the demand for its own product
+    demand = dict(goal)
+    for rule in recipes.values():
+        for item, amount in rule.get('Consumes', {}).items():
+            demand[item] = max(demand.get(item, 0), amount)
+    #push the demand down the recipe tree, once per level it could possibly have
+    for _ in range(len(recipes)):
+        changed = False
+        for rule in recipes.values():
+            repeats = max(ceil(demand.get(item, 0) / amount) for item, amount in rule['Produces'].items())
+            for item, amount in rule.get('Consumes', {}).items():
+                if amount * repeats > demand.get(item, 0):
+                    demand[item] = amount * repeats
+                    changed = True
+        if not changed:
+            break
+    return demand
+
+
+def compile_macros(recipes, goal, max_chains=16, held=()):
+    # Derives macro-actions from the recipes, returns (rules, steps). rules holds every primitive recipe and every
+    # macro in the Crafting['Recipes'] format, and steps maps each name to the primitive recipes it stands for. held
+    # is the items the plan starts out with some of.
+    #   - chains: a crafting recipe together with the gathering needed for its ingredients, e.g. punch for wood and
+    #     craft plank, or mining the ore and coal for one smelt
+    #   - repeats: a primitive or chain fired n times, where n runs through powers of two up to the most the goal
+    #     could need, e.g. "smelt n ingots"
+    # Tools are never repeated or chained, since a plan only makes each of them once.
+    tools = set(tool for rule in recipes.values() for tool in rule.get('Requires', {}))
+    gatherers = {}
+    for name, rule in recipes.items():
+        if 'Consumes' not in rule:
+            for item in rule['Produces']:
+                gatherers.setdefault(item, []).append(name)
+
+    runs = {name: [name] for name in recipes}
+    for name, rule in recipes.items():
+        if 'Consumes' not in rule or tools & set(rule['Produces']):
+            continue
+        ingredients = list(rule['Consumes'].items())
+        if not all(item in gatherers for item, amount in ingredients):
+            continue
+        for choice in list(product(*[gatherers[item] for item, amount in ingredients]))[:max_chains]:
+            steps = []
+            for (item, amount), gatherer in zip(ingredients, choice):
+                steps += [gatherer] * ceil(amount / recipes[gatherer]['Produces'][item])
+            runs[' + '.join(list(choice) + [name])] = steps + [name]
+
+    #a gathering recipe whose product only ever feeds chained recipes is left to the chains, so the search never
+    #stops on loose wood, coal or ore between them
+    chained = set(step for name, run in runs.items() if name not in recipes for step in run)
+    covered = set()
+    for item, names in gatherers.items():
+        consumers = [name for name, rule in recipes.items() if item in rule.get('Consumes', {})]
+        if item not in goal and consumers and all(any(run[-1] == name for key, run in runs.items()
+                                                      if key not in recipes)
+                                                  for name in consumers):
+            covered.update(name for name in names if name in chained)
+    #but a chain is no use for ingredients already held: with ore to hand one smelt only needs coal mined, so the
+    #gatherers of what goes with a held ingredient are kept, or the plan would pay to gather the held stock all over
+    #again. With every ingredient held, any of them may run short first, so all their gatherers are kept
+    held = set(held)
+    for name, run in runs.items():
+        ingredients = set(recipes[run[-1]].get('Consumes', {}))
+        if name not in recipes and held & ingredients:
+            missing = ingredients - held or ingredients
+            covered.difference_update(step for step in run[:-1] if missing & set(recipes[step]['Produces']))
+
+    demand = demands(recipes, goal)
+    rules = dict((name, rule) for name, rule in recipes.items() if name not in covered)
+    steps = dict((name, [name]) for name in rules)
+    for name, run in runs.items():
+        if name in covered:
+            continue
+        rule = combine(recipes, run)
+        if name not in recipes:
+            rules[name] = rule
+            steps[name] = run
+        if tools & set(rule['Produces']):
+            continue
+        most = max(ceil(demand.get(item, 0) / amount) for item, amount in rule['Produces'].items())
+        size = 2
+        while size <= most:
+            rules['%s x%d' % (name, size)] = combine(recipes, run * size)
+            steps['%s x%d' % (name, size)] = run * size
+            size *= 2
+        if most > 2 and most & (most - 1):
+            rules['%s x%d' % (name, most)] = combine(recipes, run * most)
+            steps['%s x%d' % (name, most)] = run * most
+    return rules, steps
+
+
+def expand_plan(plan, steps, recipes):
+    # Turns a [(state, action)] plan over macros back into one over the primitive recipes, replaying each macro's
+    # steps from the state it was taken in
+    expanded = []
+    for state, action in plan:
+        if action not in steps:
+            expanded.append((state, action))
+            continue
+        for name in steps[action]:
+            expanded.append((state, name))
+            counts = list(state.counts)
+            rule = recipes[name]
+            for item, amount in rule['Produces'].items():
+                counts[state.layout.index[item]] += amount
+            for item, amount in rule.get('Consumes', {}).items():
+                counts[state.layout.index[item]] -= amount
+            state = state.with_counts(tuple(counts))
+    return expanded
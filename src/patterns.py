@@ -0,0 +1,208 @@
+import os
+from threading import Lock
+
+import numpy as np
+
+from craft_planner import cheapest_units
+from plan_cache import canonical_hash
+
+# A pattern database for the tool chain. Every goal past the first few items needs the same run of tools (bench,
+# wooden_pickaxe, stone_pickaxe, furnace, iron_pickaxe), and the searches work that run out again for every goal. The
+# database solves it once per recipe set, for every set of tools a state can hold and every set of tools a goal can
+# need, and keeps the costs on disk.
+#
+# The abstract problem only sees which tools are held. Making a tool costs its recipe's Time plus what its
+# ingredients cost with the tools held at the time: the cheapest cost of one unit of each item with those tools (see
+# cheapest_units) is a lower bound on making it then, and tools made later only make things cheaper. Items held at
+# the start of a search may also save the tools it would take to make them (3 ingots held save the furnace), so for a
+# start state holding any, the costs are worked out again with those items costing nothing (in memory, as they are
+# only good for that stock). Anything else a state holds was made along the way, with the tools it still holds, so it
+# can only save what it would have cost at most; that is taken off, and the lookup never overestimates.
+#
+# costs[held, needed] is the cheapest cost of going from the tool set held to one holding every tool in needed, with
+# tool sets as bit masks over tools. The tables are stored as .npy files named by a hash of the Items and Recipes, and
+# memory-mapped when loaded, so a process that plans for one goal only reads the rows it looks up.
+
+PATTERN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.pattern_db')
+#how many start stocks a PatternDatabase keeps costs for, dropping the oldest first
+MAX_STOCKS = 64
+
+
+def necessary_tools(table, held=()):
+    # For each slot, the bit mask (over table.tools) of the tools every way of making that item needs: the tools its
+    # recipe requires, and those needed for its ingredients and the tools it requires, for every recipe that makes it.
+    # Items in held are taken as already there and need nothing
+    tools = table.tools
+    everything = (1 << len(tools)) - 1
+    needs = [0 if slot in held or not table.produces[:, slot].any() else everything
+             for slot in range(len(table.layout.items))]
+    consumed = [[slot for slot, amount in enumerate(row) if amount] for row in table.consumes.tolist()]
+    changed = True
+    while changed:
+        changed = False
+        for slot in range(len(needs)):
+            if not needs[slot]:
+                continue
+            need = everything
+            for row in np.flatnonzero(table.produces[:, slot]).tolist():
+                row_need = 0
+                for tool in table.required[row]:
+                    row_need |= (1 << tools.index(tool)) | needs[tool]
+                for item in consumed[row]:
+                    row_need |= needs[item]
+                need &= row_need
+            if need != needs[slot]:
+                needs[slot] = need
+                changed = True
+    return needs
+
+
+def build_costs(table, stock=()):
+    # (costs, values): the costs table over every pair of tool sets, and the most one unit of each item can cost
+    # with any set of tools (0 for tools, which the tool sets already count). Items in stock (slots) are taken as
+    # already there, so their units cost nothing
+    tools = table.tools
+    sets = 1 << len(tools)
+    row_masks = [sum(1 << tools.index(slot) for slot in required) for required in table.required]
+    units = [cheapest_units(table, [row for row, row_mask in enumerate(row_masks) if row_mask & mask == row_mask],
+                            stock)[0]
+             for mask in range(sets)]
+    consumed = [[(slot, amount) for slot, amount in enumerate(row) if amount] for row in table.consumes.tolist()]
+    makes = [sum(1 << tools.index(slot) for slot in made if slot in tools) for made in table.made]
+    #steps[mask] holds (tools made, cost) for each recipe that makes a tool with the tools in mask
+    steps = []
+    for mask in range(sets):
+        found = {}
+        for row, made in enumerate(makes):
+            if not made & ~mask or row_masks[row] & mask != row_masks[row]:
+                continue
+            cost = table.costs[row] + sum(units[mask][slot] * amount for slot, amount in consumed[row])
+            if cost < found.get(made, float('inf')):
+                found[made] = cost
+        steps.append(list(found.items()))
+    #costs[:, mask] for every held set at once. Tools are only ever added, so the masks reachable from any held set
+    #come in increasing order
+    costs = np.full((sets, sets), np.inf)
+    costs[np.arange(sets), np.arange(sets)] = 0
+    for mask in range(sets):
+        for made, cost in steps[mask]:
+            np.minimum(costs[:, mask | made], costs[:, mask] + cost, out=costs[:, mask | made])
+    #a goal needing some tools is met by any tool set holding them
+    masks = np.arange(sets)
+    for bit in range(len(tools)):
+        costs = np.minimum(costs, costs[:, masks | (1 << bit)])
+    values = np.zeros(len(table.layout.items))
+    for slot in range(len(values)):
+        if slot not in tools:
+            finite = [unit[slot] for unit in units if unit[slot] != float('inf')]
+            values[slot] = max(finite) if finite else 0
+    return costs.astype(np.float32), values
+
+
+def table_key(table):
+    # A hash of everything about a recipe table the costs depend on
+    return canonical_hash({'Items': list(table.layout.items), 'Times': table.costs,
+                           'Matrices': [table.consumes.tolist(), table.minimums.tolist(), table.produces.tolist()]})
+
+
+class PatternDatabase(object):
+    """ The tool chain costs of one recipe set (see the top of this file), built on first use and kept in directory.
+        heuristic(goal, state) gives an admissible heuristic for search from the lookups.
+    """
+
+    def __init__(self, table, directory=PATTERN_DIR):
+        self.table = table
+        self.directory = directory
+        self.costs, self.values = self.load(table_key(table))
+        self.stocks = {}            #slots held at the start -> (costs, values)
+        self.lock = Lock()
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key + '-costs.npy'), os.path.join(self.directory, key + '-values.npy')
+
+    def load(self, key):
+        # The stored tables for key, memory-mapped, or newly built and stored if they aren't there or don't fit
+        sets = 1 << len(self.table.tools)
+        if self.directory:
+            costs_path, values_path = self._paths(key)
+            try:
+                costs = np.load(costs_path, mmap_mode='r')
+                values = np.load(values_path, mmap_mode='r')
+                if costs.shape == (sets, sets) and values.shape == (len(self.table.layout.items),):
+                    return costs, values
+            except (IOError, ValueError):
+                pass
+        costs, values = build_costs(self.table)
+        if self.directory:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            #write under a temporary name first, so another process never maps half a file
+            for path, array in zip(self._paths(key), (costs, values)):
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, array)
+                os.replace(path + '.tmp', path)
+        return costs, values
+
+    def tables(self, state):
+        # (costs, values) for a search starting from state: the stored ones, or if it holds items some recipe
+        # consumes, ones with those items costing nothing, built on first use
+        table = self.table
+        stock = tuple(slot for slot, count in enumerate(state.counts)
+                      if count and slot not in table.tools and table.consumes[:, slot].any())
+        if not stock:
+            return self.costs, self.values
+        with self.lock:
+            found = self.stocks.get(stock)
+        if found is None:
+            found = build_costs(table, stock)
+            with self.lock:
+                if stock not in self.stocks and len(self.stocks) >= MAX_STOCKS:
+                    del self.stocks[next(iter(self.stocks))]
+                found = self.stocks.setdefault(stock, found)
+        return found
+
+    def heuristic(self, goal, state):
+        # heuristic(currState, nextState) for planning from state to goal: the stored cost of getting from the tools
+        # the next state holds to the tools the goal needs, less what the items it holds could save
+        table = self.table
+        tool_bits = [(1 << bit, slot) for bit, slot in enumerate(table.tools)]
+        needs = necessary_tools(table, [slot for slot, count in enumerate(state.counts) if count])
+        needed = 0
+        for item in goal:
+            slot = table.layout.index[item]
+            needed |= needs[slot]
+            if slot in table.tools:
+                needed |= 1 << table.tools.index(slot)
+        costs, values = self.tables(state)
+        rows = {}
+        values = [(slot, float(value)) for slot, value in enumerate(values.tolist()) if value]
+
+        def heuristic(currState, nextState):
+            counts = nextState.counts
+            held = 0
+            for bit, slot in tool_bits:
+                if counts[slot]:
+                    held |= bit
+            if held not in rows:
+                rows[held] = float(costs[held, needed])
+            value = rows[held]
+            for slot, unit in values:
+                if counts[slot]:
+                    value -= counts[slot] * unit
+            return value if value > 0 else 0
+
+        return heuristic
+
+
+_databases = {}
+_databases_lock = Lock()
+
+
+def pattern_database(table, directory=PATTERN_DIR):
+    # The shared PatternDatabase for a recipe table, loaded once per process
+    key = (table_key(table), directory)
+    with _databases_lock:
+        database = _databases.get(key)
+        if database is None:
+            database = _databases[key] = PatternDatabase(table, directory)
+    return database
@@ -0,0 +1,189 @@
+import json
+import os
+from collections import OrderedDict
+from hashlib import sha256
+
+
+def canonical_hash(data):
+    # Hashes any JSON data so that key order and whitespace don't matter
+    text = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return sha256(text.encode('utf-8')).hexdigest()[:20]
+
+
+def plan_cost(plan, recipes):
+    # Total Time of the actions in a [(state, action)] plan
+    return sum(recipes[action]['Time'] for state, action in plan[:-1])
+
+
+def dominates(inventory, goal):
+    #true if the inventory has at least the goal amount of every goal item
+    for item, amount in goal.items():
+        if inventory.get(item, 0) < amount:
+            return False
+    return True
+
+
+class PlanCache(object):
+    """ Caches plans keyed by a canonical hash of (Crafting['Recipes'], Crafting['Initial'], Crafting['Goal']). Plans
+        live in an in-memory LRU, and when a directory is given, also on disk as one JSON file per plan. The disk store
+        is trimmed back to max_bytes by dropping the least recently used files.
+
+        Plans are stored as [(inventory, action)] pairs, and turned back into [(state, action)] pairs with the Layout
+        passed to lookup. File names start with the recipe and initial inventory hashes, so every plan for the same
+        problem setup can be found for prefix reuse.
+    """
+
+    def __init__(self, directory=None, max_entries=128, max_bytes=16 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()     #key -> entry, least recently used first
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def keys(self, recipes, initial, goal):
+        #(setup, key) where setup is shared by every goal planned from the same recipes and initial inventory
+        setup = canonical_hash(recipes) + '-' + canonical_hash(initial)
+        return setup, setup + '-' + canonical_hash(goal)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _load(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.directory:
+            path = self._path(key)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (IOError, ValueError):
+                return None
+            #touch the file so eviction sees it as recently used
+            os.utime(path, None)
+            self._remember(key, entry)
+            return entry
+        return None
+
+    def _entries(self, setup):
+        #every cached entry for the same recipes and initial inventory, from memory and disk
+        keys = [key for key in self.memory if key.startswith(setup + '-')]
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.startswith(setup + '-') and name.endswith('.json') and name[:-5] not in keys:
+                    keys.append(name[:-5])
+        entries = []
+        for key in keys:
+            entry = self._load(key)
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    def put(self, recipes, initial, goal, plan):
+        setup, key = self.keys(recipes, initial, goal)
+        entry = {
+            'goal': goal,
+            'cost': plan_cost(plan, recipes),
+            'plan': [[{item: amount for item, amount in state.items() if amount}, action] for state, action in plan],
+        }
+        self._remember(key, entry)
+        if self.directory:
+            with open(self._path(key), 'w') as f:
+                json.dump(entry, f)
+            self._evict()
+
+    def _evict(self):
+        #drop the least recently used files until the store fits in max_bytes
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def get(self, recipes, initial, goal, layout):
+        # Returns a cached [(state, action)] plan for exactly this problem, or None
+        setup, key = self.keys(recipes, initial, goal)
+        entry = self._load(key)
+        if entry is None:
+            return None
+        return self._states(entry['plan'], layout)
+
+    def lookup(self, recipes, initial, goal, layout):
+        # Returns (plan, complete). An exact hit, or the cheapest prefix of a cached plan that passes through a state
+        # meeting the goal, is complete. Otherwise the most expensive cached plan whose goal is part of this goal is
+        # returned with complete=False, so it can be extended from its final state. (None, False) if nothing fits.
+        plan = self.get(recipes, initial, goal, layout)
+        if plan is not None:
+            return plan, True
+        setup, key = self.keys(recipes, initial, goal)
+        best_prefix = None
+        best_partial = None
+        for entry in self._entries(setup):
+            #walk the plan up to the first state that already meets the new goal
+            cost = 0
+            for step, (inventory, action) in enumerate(entry['plan']):
+                if dominates(inventory, goal):
+                    if best_prefix is None or cost < best_prefix[0]:
+                        best_prefix = (cost, entry['plan'][:step] + [[inventory, "End of Path"]])
+                    break
+                if action in recipes:
+                    cost += recipes[action]['Time']
+            else:
+                if dominates(goal, entry['goal']):
+                    if best_partial is None or entry['cost'] > best_partial[0]:
+                        best_partial = (entry['cost'], entry['plan'])
+        if best_prefix is not None:
+            plan = self._states(best_prefix[1], layout)
+            self.put(recipes, initial, goal, plan)
+            return plan, True
+        if best_partial is not None:
+            return self._states(best_partial[1], layout), False
+        return None, False
+
+    def _states(self, steps, layout):
+        return [(layout.state(inventory), action) for inventory, action in steps]
+
+
+def replays(recipes, layout, plan, initial, goal=None):
+    # True if a [(state, action)] plan can be carried out from initial, and with a goal, ends up meeting it (see
+    # simulator.py)
+    from craft_planner import RecipeTable
+    from simulator import Simulator
+    outcome = Simulator(RecipeTable(recipes, layout)).run(plan, initial, goal)
+    return outcome.goal_met if goal is not None else outcome.legal
+
+
+def cached_search(cache, Crafting, layout, solve):
+    # Puts the cache in front of a search. solve(state, goal) runs the search from the given state and returns a
+    # [(state, action)] plan or None. A cached plan that only covers part of the goal is extended from its final state.
+    recipes, initial, goal = Crafting['Recipes'], Crafting['Initial'], Crafting['Goal']
+    plan, complete = cache.lookup(recipes, initial, goal, layout)
+    if plan is not None and not replays(recipes, layout, plan, initial, goal if complete else None):
+        #a cached plan that doesn't replay (a stale or hand-edited file) is planned again instead of trusted
+        plan, complete = None, False
+    if complete:
+        return plan
+    if plan is not None:
+        rest = solve(plan[-1][0], goal)
+        if rest is not None:
+            plan = plan[:-1] + rest
+            cache.put(recipes, initial, goal, plan)
+            return plan
+    plan = solve(layout.state(initial), goal)
+    if plan is not None:
+        cache.put(recipes, initial, goal, plan)
+    return plan
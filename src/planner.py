@@ -0,0 +1,243 @@
+from copy import deepcopy
+from threading import Lock
+from timeit import default_timer as time
+
+from craft_planner import (Layout, Recipe, RecipeTable, State, Dominance, make_checker, make_effector,
+                           make_consume_limit, item_limits, make_priorities, make_goal_checker, make_heuristic,
+                           make_relaxed_heuristic, search, anytime_search, bounded_search)
+from bulk_planner import bulk_plan
+from hierarchy import hierarchical_plan, subplan_library
+from macros import compile_macros, expand_plan
+from patterns import pattern_database
+from plan_cache import canonical_hash
+from regression import regression_search
+
+
+class CompiledRecipes(object):
+    """ Everything built once from a recipe set: the Layout, the rules, the Recipe list, the compiled RecipeTable (with
+        and without dominated recipes) and the consume limits, plus the macro tables compiled for each goal so far.
+        None of it is changed once built (macro tables are only ever added, under the lock), so one copy is shared by
+        every Planner, and every thread, working on the same recipes. Use compile_recipes to get the shared copy.
+
+        tables, if given, is the (layout, table, pruned_table) of tables() built earlier for the same recipes, e.g.
+        from a bundle of loader.py, so they aren't built again.
+    """
+
+    def __init__(self, items, recipes, max_macro_tables=64, tables=None):
+        if tables is None:
+            layout = Layout(items)
+            tables = (layout, RecipeTable(recipes, layout), RecipeTable(recipes, layout, skip_dominated=True))
+        self.layout, self.table, self.pruned_table = tables
+        self.recipes = recipes
+        self.rules = list(recipes.values())
+        self.all_recipes = [Recipe(name, make_checker(rule, self.layout), make_effector(rule, self.layout),
+                                   rule['Time']) for name, rule in recipes.items()]
+        self.consume_limit = make_consume_limit(self.rules)
+        self.tools = set(tool for rule in self.rules for tool in rule.get('Requires', {}))
+        self.max_macro_tables = max_macro_tables
+        self.macro_tables = {}      #(goal, skip_dominated, held) -> (RecipeTable over the macros, macro steps)
+        self.lock = Lock()
+
+    def tables(self):
+        return self.layout, self.table, self.pruned_table
+
+    def macros(self, goal, skip_dominated, held=()):
+        # The macro table for a goal, starting out with some of each of the held items (see compile_macros), compiled
+        # on first use. Two threads may both compile one, only the first is kept
+        #held tools don't change the macros, so they don't get tables of their own
+        held = tuple(sorted(item for item in set(held) if item not in self.tools))
+        key = (tuple(sorted(goal.items())), bool(skip_dominated), held)
+        with self.lock:
+            compiled = self.macro_tables.get(key)
+        if compiled is None:
+            rules, steps = compile_macros(self.recipes, goal, held=held)
+            compiled = (RecipeTable(rules, self.layout, skip_dominated=skip_dominated), steps)
+            with self.lock:
+                if key not in self.macro_tables and len(self.macro_tables) >= self.max_macro_tables:
+                    del self.macro_tables[next(iter(self.macro_tables))]
+                compiled = self.macro_tables.setdefault(key, compiled)
+        return compiled
+
+
+_compiled = {}              #hash of (items, recipes) -> CompiledRecipes
+_compiled_lock = Lock()
+
+
+def compile_recipes(items, recipes, tables=None):
+    # The shared CompiledRecipes for a recipe set, built the first time the set is seen (from tables, if given, see
+    # CompiledRecipes). The recipes are copied, so changing the caller's dicts afterwards can't change plans made
+    # from them
+    key = canonical_hash({'Items': items, 'Recipes': recipes})
+    with _compiled_lock:
+        compiled = _compiled.get(key)
+        if compiled is None:
+            compiled = _compiled[key] = CompiledRecipes(list(items), deepcopy(recipes), tables=tables)
+    return compiled
+
+
+class Planner(object):
+    """ Plans crafting problems over one recipe set. The compiled recipes are shared with every other Planner on the
+        same recipes, and everything plan() builds for a problem (goal checker, priority list, heuristic, search
+        tables) is local to that call, so one Planner can plan many problems at once from several threads.
+
+        The options pick how to plan, as in portfolio.DEFAULT_CONFIGS: heuristic ('priority' is make_heuristic,
+        'hand_tuned' is the one from craft_planner_modified.py, 'relaxed' is make_relaxed_heuristic, 'pattern' is the
+        larger of make_relaxed_heuristic and the tool chain pattern database of patterns.py), a heuristic weight,
+        whether to search over macro-actions, whether to skip recipes dominated by a cheaper one, and a search
+        ('astar', 'anytime', 'bounded', 'regression', 'hierarchical', or 'bulk' for the bulk planner, which ignores
+        the rest). 'regression' searches backwards from the goal (see regression.py) with its own heuristic, so it
+        only takes the weight, macros and limits. 'hierarchical' breaks the goal down into subgoals and plans each
+        with a short A* search on the other options (see hierarchy.py), reusing the subplans of every Planner with
+        the same recipes and options.
+
+        With limits, successors are pruned by the recipe table against the goal's item_limits; without, by the
+        hand-picked rules of make_pruner. With dominance, A* also drops states dominated by one it has expanded
+        (see Dominance). On the stock recipes the item limits leave few dominated states, so it's off by default.
+        With incremental, successors come from RecipeTable.incremental_successors instead of RecipeTable.successors.
+        node_budget is the most states the 'bounded' search keeps in memory at once (see bounded_search).
+        heuristic_weights, if given, replaces the hand-picked constants of the 'priority' or 'hand_tuned' heuristic
+        (craft_planner.HEURISTIC_WEIGHTS or craft_planner_modified.WEIGHTS). If not, the weights tuner.py stored in
+        tuner.TUNED for the goal's family are used, where there are any; {} keeps the hand-picked ones.
+
+        To replan again and again while a plan is carried out, wrap a Planner in a replanner.Replanner.
+    """
+
+    def __init__(self, items, recipes, heuristic='priority', weight=1, macros=True, skip_dominated=True,
+                 search='astar', limits=True, dominance=False, incremental=True, heuristic_weights=None,
+                 node_budget=100000):
+        self.compiled = compile_recipes(items, recipes)
+        self.layout = self.compiled.layout
+        self.heuristic = heuristic
+        self.weight = weight
+        self.macros = macros
+        self.skip_dominated = skip_dominated
+        self.search = search
+        self.limits = limits
+        self.dominance = dominance
+        self.incremental = incremental
+        self.heuristic_weights = heuristic_weights
+        self.node_budget = node_budget
+        self.subgoals = None
+        if search == 'hierarchical':
+            options = dict(heuristic=heuristic, weight=weight, macros=macros, skip_dominated=skip_dominated,
+                           limits=limits, dominance=dominance, incremental=incremental,
+                           heuristic_weights=heuristic_weights, node_budget=node_budget)
+            self.subgoals = Planner(items, recipes, **options)
+            options['heuristic_weights'] = tuple(sorted((heuristic_weights or {}).items()))
+            self.library = subplan_library(self.compiled, tuple(sorted(options.items())))
+
+    @classmethod
+    def from_crafting(cls, Crafting, **options):
+        return cls(Crafting['Items'], Crafting['Recipes'], **options)
+
+    def tuned_weights(self, goal):
+        # The heuristic's weights for goal: the ones given, or else those tuner.py stored for the goal's family
+        if self.heuristic_weights is not None:
+            return self.heuristic_weights
+        from tuner import TUNED, load_tuned
+        return load_tuned(TUNED, self.heuristic, goal)
+
+    def make_heuristic(self, goal, state):
+        compiled = self.compiled
+        if self.heuristic == 'relaxed':
+            heuristic = make_relaxed_heuristic(goal, compiled.table)
+        elif self.heuristic == 'pattern':
+            #both are admissible, so the larger one is too
+            relaxed = make_relaxed_heuristic(goal, compiled.table)
+            lookup = pattern_database(compiled.table).heuristic(goal, state)
+            heuristic = lambda currState, nextState: max(relaxed(currState, nextState), lookup(currState, nextState))
+        elif self.heuristic == 'hand_tuned':
+            import craft_planner_modified
+            heuristic = craft_planner_modified.make_heuristic(goal, self.tuned_weights(goal))
+        else:
+            heuristic = make_heuristic(goal, make_priorities(goal, compiled.rules), self.tuned_weights(goal))
+        weight = self.weight
+        if weight != 1:
+            unweighted = heuristic
+            heuristic = lambda currState, nextState: weight * unweighted(currState, nextState)
+        return heuristic
+
+    def search_table(self, goal, state=None):
+        # (table, steps, consume_limit): the RecipeTable searched for goal from state (any state, if None), the macro
+        # steps of its rows (None if they are primitive recipes), and the consume limits the search prunes by (None if
+        # the table does it)
+        compiled = self.compiled
+        table = compiled.table
+        steps = None
+        if self.macros:
+            held = () if state is None else [item for item, amount in state.items() if amount]
+            table, steps = compiled.macros(goal, self.skip_dominated, held)
+        elif self.skip_dominated:
+            table = compiled.pruned_table
+        consume_limit = compiled.consume_limit
+        if self.limits:
+            #the table prunes, so the search doesn't have to
+            table = table.with_limits(item_limits(compiled.recipes, self.layout, goal))
+            consume_limit = None
+        return table, steps, consume_limit
+
+    def plan(self, initial, goal, deadline=30, stats=None, probe=None):
+        # Plans from initial (an inventory dict or a State on this planner's layout) to goal, giving up after deadline
+        # seconds. Returns a [(state, action)] plan over the primitive recipes, or None. stats, if given, is a dict
+        # that gets the number of states the search visited under 'states' (the bulk planner doesn't search states),
+        # and for the anytime search the bound under 'bound': the plan costs at most that many times the cheapest plan.
+        # That only holds for an admissible heuristic ('relaxed' or 'pattern', unweighted) over the primitive recipes
+        # (the cheapest plan over the macros can cost more), so otherwise, and without a plan, the bound is None.
+        # probe, if given, is an instrument.Probe that counts and times what the planner does
+        compiled = self.compiled
+        state = initial if isinstance(initial, State) else self.layout.state(initial)
+        if self.search == 'bulk':
+            if probe is None:
+                return bulk_plan(compiled.table, state, goal)
+            with probe.timer('bulk'):
+                return bulk_plan(compiled.table, state, goal)
+        if self.search == 'hierarchical':
+            return hierarchical_plan(self.subgoals, state, goal, deadline, self.library, stats=stats, probe=probe)
+        start_time = time()
+        table, steps, consume_limit = self.search_table(goal, state)
+        if self.search == 'regression':
+            if probe is not None:
+                probe.timers['prepare'] += time() - start_time
+            plan = regression_search(table, state, goal, deadline, self.weight, stats=stats, probe=probe)
+            return self.expand(plan, steps, probe)
+        graph = table.incremental_successors if self.incremental else table.successors
+        is_goal = make_goal_checker(goal, self.layout)
+        heuristic = self.make_heuristic(goal, state)
+        if probe is not None:
+            probe.timers['prepare'] += time() - start_time
+        options = {'stats': stats, 'probe': probe}
+        if self.search == 'anytime':
+            plan, bound = anytime_search(graph, state, is_goal, deadline, heuristic, goal, consume_limit, **options)
+            if stats is not None:
+                admissible = self.heuristic in ('relaxed', 'pattern') and self.weight <= 1 and not self.macros
+                stats['bound'] = bound if admissible else None
+        elif self.search == 'bounded':
+            plan = bounded_search(graph, state, is_goal, deadline, heuristic, goal, consume_limit, self.node_budget,
+                                  **options)
+        else:
+            if self.dominance:
+                options['dominance'] = Dominance(self.layout, compiled.table.tools)
+            plan = search(graph, state, is_goal, deadline, heuristic, goal, consume_limit, **options)
+        return self.expand(plan, steps, probe)
+
+    def expand(self, plan, steps, probe=None):
+        # The plan over the primitive recipes, if it was found over macros
+        if plan and steps:
+            if probe is None:
+                return expand_plan(plan, steps, self.compiled.recipes)
+            with probe.timer('expand'):
+                return expand_plan(plan, steps, self.compiled.recipes)
+        return plan
+
+
+if __name__ == '__main__':
+    from loader import load_crafting
+    Crafting = load_crafting('Crafting.json')
+
+    # Plans the problem with the default options
+    planner = Planner.from_crafting(Crafting)
+    resulting_plan = planner.plan(Crafting['Initial'], Crafting['Goal'], 30)
+    if resulting_plan:
+        for state, action in resulting_plan:
+            print('\t', state)
+            print(action)
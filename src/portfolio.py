@@ -0,0 +1,105 @@
+import os
+import sys
+from multiprocessing import Process, Queue
+from queue import Empty
+from timeit import default_timer as time
+
+import craft_planner
+from planner import Planner
+
+# Each configuration is a name and the options of a Planner: a heuristic ('priority' is make_heuristic, 'hand_tuned'
+# is the per-goal heuristic from craft_planner_modified.py, 'relaxed' is make_relaxed_heuristic, 'pattern' adds the
+# pattern database of patterns.py to it), a heuristic weight, whether to search over macro-actions, whether to skip
+# recipes dominated by a cheaper one, and a search ('astar', 'anytime', 'bounded', 'regression', 'hierarchical', or
+# 'bulk' for the bulk planner, which ignores the rest). A 'bounded' configuration can also set its node_budget.
+DEFAULT_CONFIGS = [
+    {'name': 'priority macros', 'heuristic': 'priority', 'weight': 1, 'macros': True, 'skip_dominated': True,
+     'search': 'astar'},
+    {'name': 'priority', 'heuristic': 'priority', 'weight': 1, 'macros': False, 'skip_dominated': False,
+     'search': 'astar'},
+    {'name': 'hand tuned', 'heuristic': 'hand_tuned', 'weight': 1, 'macros': False, 'skip_dominated': False,
+     'search': 'astar'},
+    {'name': 'relaxed anytime', 'heuristic': 'relaxed', 'weight': 1, 'macros': True, 'skip_dominated': True,
+     'search': 'anytime'},
+    {'name': 'relaxed weighted', 'heuristic': 'relaxed', 'weight': 2, 'macros': True, 'skip_dominated': True,
+     'search': 'astar'},
+    {'name': 'bulk', 'search': 'bulk'},
+]
+
+
+def run_config(Crafting, config, limit):
+    # Plans the problem with one configuration. Returns the plan as [(counts, action)] pairs, so it can be sent back
+    # between processes without the layout
+    options = dict((key, value) for key, value in config.items() if key != 'name')
+    planner = Planner.from_crafting(Crafting, **options)
+    plan = planner.plan(Crafting['Initial'], Crafting['Goal'], limit)
+    if not plan:
+        return None
+    return [(s.counts, action) for s, action in plan]
+
+
+def worker(Crafting, config, limit, results):
+    #the searches print as they go, which would only interleave between workers
+    sys.stdout = open(os.devnull, 'w')
+    start_time = time()
+    try:
+        plan = run_config(Crafting, config, limit)
+    except Exception as e:
+        results.put({'name': config['name'], 'plan': None, 'error': repr(e), 'time': time() - start_time})
+        return
+    results.put({'name': config['name'], 'plan': plan, 'time': time() - start_time})
+
+
+def portfolio_search(Crafting, configs=DEFAULT_CONFIGS, limit=30, first=True):
+    # Runs every configuration in its own process against the same problem. With first, the first plan to come back
+    # wins; otherwise the cheapest plan found within the limit does. Workers still running are terminated.
+    # Returns a dict with the winning configuration's name, its [(state, action)] plan, cost and time, or None
+    start_time = time()
+    results = Queue()
+    workers = [Process(target=worker, args=(Crafting, config, limit, results)) for config in configs]
+    for process in workers:
+        process.daemon = True
+        process.start()
+    best = None
+    finished = 0
+    while finished < len(workers):
+        remaining = limit - (time() - start_time)
+        if remaining <= 0:
+            break
+        try:
+            result = results.get(timeout=remaining)
+        except Empty:
+            break
+        finished += 1
+        if not result['plan']:
+            continue
+        result['cost'] = sum(Crafting['Recipes'][action]['Time'] for counts, action in result['plan'][:-1])
+        if best is None or result['cost'] < best['cost']:
+            best = result
+        if first:
+            break
+    for process in workers:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+    if best is not None:
+        layout = craft_planner.Layout(Crafting['Items'])
+        best['plan'] = [(craft_planner.State(layout, counts), action) for counts, action in best['plan']]
+    return best
+
+
+if __name__ == '__main__':
+    from loader import load_crafting
+    Crafting = load_crafting('Crafting.json')
+
+    start_time = time()
+    result = portfolio_search(Crafting, limit=30, first=True)
+    if result is None:
+        print("Failed to find a path within time limit.")
+    else:
+        print("Compute Time: " + str(time() - start_time))
+        print("Winner: " + result['name'])
+        print("Game Time: {cost = " + str(result['cost']) + "} {len = " + str(len(result['plan']) - 1) + "}")
+        for state, action in result['plan']:
+            print('\t', state)
+            print(action)
@@ -0,0 +1,344 @@
+from collections import namedtuple
+from heapq import heappop, heappush
+from functools import reduce
+from math import ceil, gcd
+from operator import gt, le
+from timeit import default_timer as time
+
+import numpy as np
+
+from craft_planner import State, Dominance, cheapest_units
+
+# Plans backwards from the goal. A regression state is a partial inventory: the least of each item that has to be held
+# at some point for the rest of the plan to work, starting from the goal itself. Stepping back over a recipe, the
+# inventory just before it has to meet the recipe's minimums and, once the recipe's delta is added, what was needed
+# after it:
+#   needed before = max(needed after - delta, minimums)
+# The search stops at the first need the initial inventory already covers, and the recipes it stepped over, read
+# forwards, are the plan. Only recipes that make an item the need asks for are stepped over (past what is held, for
+# items nothing uses up, see relevant_floors), so the search never wanders off into gathering nothing on the way to
+# the goal asks for.
+#
+# Tools are never used up, so no plan worth having makes the same tool twice: once a tool's recipe has been stepped
+# over, the tool is marked as made, and nothing earlier may need it or make it again. A need is also dropped when one
+# already expanded, with the same tools made, asks for no more of any item and was reached at no greater cost (the
+# Dominance of craft_planner.py, with the comparison turned around). Steps that forward search would prune by the
+# table's item limits are never stepped over (see need_bounds), and two steps that could go in either order are only
+# tried in one.
+
+#what Dominance is given for a need: its counts negated, followed by the bit mask of the tools made
+Need = namedtuple('Need', ['counts'])
+
+
+def once_tools(table, goal):
+    # Slots of the tools a plan makes at most once: those no recipe uses up, unless the goal asks for more than one
+    layout = table.layout
+    return [slot for slot in table.tools
+            if not table.consumes[:, slot].any() and goal.get(layout.items[slot], 0) <= 1]
+
+
+def regression_steps(table, goal):
+    # What stepping back over the rows of a table takes, built once per search: (tool_slots, made_by, makes,
+    # requires, regress). tool_slots are the once_tools, made_by[slot] the rows that make the item in slot, makes[row]
+    # and requires[row] bit masks over tool_slots of the tools row makes and needs, and regress(counts, row) the need
+    # before row given the need after it
+    tool_slots = once_tools(table, goal)
+    made_by = [[] for item in table.layout.items]
+    for row, made in enumerate(table.made):
+        for slot in made:
+            made_by[slot].append(row)
+    makes = [sum(1 << tool_slots.index(slot) for slot in made if slot in tool_slots) for made in table.made]
+    requires = [sum(1 << tool_slots.index(slot) for slot in required if slot in tool_slots)
+                for required in table.required]
+
+    #steps[row] holds (slot, delta, minimum) for the items row touches, the rest of a need stays as it is
+    steps = [[(slot, delta, minimum) for slot, (delta, minimum) in enumerate(zip(row_deltas, row_minimums))
+              if delta or minimum] for row_deltas, row_minimums in zip(table.deltas.tolist(), table.minimums.tolist())]
+
+    def regress(counts, row):
+        counts = list(counts)
+        for slot, delta, minimum in steps[row]:
+            counts[slot] = max(counts[slot] - delta, minimum)
+        return tuple(counts)
+
+    return tool_slots, made_by, makes, requires, regress
+
+
+def need_bounds(table, held):
+    # The (limits, caps) a need stepped back towards the inventory held (a tuple of counts) is pruned by, or None if
+    # the table has no limits. Forwards, a recipe isn't fired once the inventory holds the limit of what it makes (see
+    # item_limits), and the inventory holds at least the need, so a need at the limit of what the step before it
+    # makes is dropped; nor can a need ask for more than an inventory kept to the limits ever holds, its cap. Both
+    # only hold because any plan within the limits can be stepped back over in its own order (see relevant_floors)
+    limits = table.limit_list
+    if limits is None:
+        return None
+    #an item is only made while below its limit, so one firing can take it at most this far past
+    caps = [max(count, limit - 1 + most)
+            for count, limit, most in zip(held, limits, table.produces.max(axis=0).tolist())]
+    return limits, caps
+
+
+def relevant_floors(table, held):
+    # How much of each item a need has to ask for before the rows making it are stepped back over: what is held of
+    # an item nothing uses up (a tool, a cart), since making more of it only helps once more is needed, but 0 of
+    # anything else. Stock held can be used up before a plan makes more of it, and then the need just after (or the
+    # limits) can be far below the stock, e.g. from 5 cobble a plan mines more for the furnace once the stone_pickaxe
+    # used up 3; waiting for the need to pass the stock would push the mining back past the stone_pickaxe
+    consumed = table.consumes.any(axis=0).tolist()
+    return [0 if used else count for count, used in zip(held, consumed)]
+
+
+def over_bounds(table, bounds, before, row):
+    # Why the need before row falls outside bounds (from need_bounds): 'limit' if row makes an item the need already
+    # holds the limit of, 'cap' if it asks for more of an item than its cap, else None
+    if bounds is None:
+        return None
+    limits, caps = bounds
+    if any(before[slot] >= limits[slot] for slot in table.made[row]):
+        return 'limit'
+    if any(map(gt, before, caps)):
+        return 'cap'
+    return None
+
+
+def make_regression_heuristic(table, state, tool_slots):
+    # The backwards counterpart of make_relaxed_heuristic. The part of the plan before a need can only use the tools
+    # held at the start and the ones it makes itself, and those can't be among the tools already made later on. For
+    # each such tool set, the cheapest cost of one unit of each item with the recipes those tools allow (from what
+    # the initial state holds, see cheapest_units) is a feasible dual of the LP relaxation of making the need and
+    # the tools from the initial state. The heuristic is the smallest of those bounds over the tool sets that hold
+    # every tool the need asks for and none of the tools already made, so it never overestimates.
+    # heuristic(counts, made) takes a need and the bit mask (over tool_slots) of the tools made, heuristic.many does
+    # the same for a matrix of needs
+    held = state.counts
+    stock = tuple(slot for slot, count in enumerate(held) if count)
+    held_mask = sum(1 << bit for bit, slot in enumerate(tool_slots) if held[slot])
+    tool_set = set(tool_slots)
+    row_masks = [sum(1 << tool_slots.index(slot) for slot in required if slot in tool_set)
+                 for required in table.required]
+    held_counts = np.array(held)
+    #an item nothing consumes can only be made in whole batches of what its recipes make, so what's missing of it
+    #rounds up to a whole number of batches (e.g. 20 rails means 32 made), as in make_relaxed_heuristic
+    batches = np.ones(len(held), dtype=np.int64)
+    for slot in range(len(held)):
+        made = set(table.produces[:, slot].tolist()) - {0}
+        if made and not table.consumes[:, slot].any():
+            batches[slot] = reduce(gcd, made)
+    whole_costs = all(float(cost).is_integer() for cost in table.costs)
+    unit_cost_cache = {}
+    bound_cache = {}
+
+    def unit_costs(mask):
+        if mask not in unit_cost_cache:
+            rows = [row for row, row_mask in enumerate(row_masks) if row_mask & mask == row_mask]
+            unit_cost_cache[mask] = cheapest_units(table, rows, stock)[0]
+        return unit_cost_cache[mask]
+
+    def bounds(needed, made):
+        # (weights, floors) matrices with a row per tool set that holds the needed tools and none of the made ones.
+        # A tool set's bound is its weights . max(need - held, floors), where floors is 1 for each tool it makes
+        key = (needed, made)
+        if key not in bound_cache:
+            weights = []
+            floors = []
+            for mask in range(1 << len(tool_slots)):
+                if mask & needed != needed or mask & made or mask & held_mask != held_mask:
+                    continue
+                costs = unit_costs(mask)
+                floor = [0] * len(held)
+                for bit, slot in enumerate(tool_slots):
+                    if mask & ~held_mask & (1 << bit):
+                        floor[slot] = 1
+                if any(costs[slot] == float('inf') for slot, amount in enumerate(floor) if amount):
+                    continue
+                weights.append(costs)
+                floors.append(floor)
+            bound_cache[key] = (np.array(weights, dtype=float).reshape(-1, len(held)),
+                                np.array(floors, dtype=np.int64).reshape(-1, len(held)))
+        return bound_cache[key]
+
+    def heuristic(counts, made):
+        needed = 0
+        for bit, slot in enumerate(tool_slots):
+            if counts[slot] > held[slot]:
+                needed |= 1 << bit
+        weights, floors = bounds(needed, made)
+        if not len(weights):
+            return float('inf')
+        short = -(-np.maximum(np.array(counts) - held_counts, 0) // batches) * batches
+        short = np.maximum(short, floors)
+        #an item no recipe can make with a tool set only rules that set out if some of it is still missing
+        with np.errstate(invalid='ignore'):
+            values = np.where(short > 0, weights * short, 0).sum(axis=1)
+        value = values.min()
+        if value == float('inf'):
+            return value
+        return ceil(value - 1e-9) if whole_costs else value
+
+    def many(counts, made):
+        # The heuristic of many needs at once, as an array: counts is a (needs, items) matrix and made an array of
+        # their masks. Needs asking for the same tools share their bounds, so each such group is one computation
+        counts = np.asarray(counts, dtype=np.int64).reshape(-1, len(held))
+        made = np.asarray(made, dtype=np.int64).reshape(-1)
+        values = np.empty(len(counts))
+        width = len(tool_slots)
+        bits = 1 << np.arange(width, dtype=np.int64)
+        needed = ((counts[:, tool_slots] > held_counts[tool_slots]) * bits).sum(axis=1)
+        keys, groups = np.unique(needed | (made << width), return_inverse=True)
+        groups = groups.reshape(-1)
+        #the rows of each group, one after another
+        order = np.argsort(groups, kind='stable')
+        ends = np.cumsum(np.bincount(groups, minlength=len(keys)))[:-1]
+        for key, rows in zip(keys.tolist(), np.split(order, ends)):
+            weights, floors = bounds(key & ((1 << width) - 1), key >> width)
+            if not len(weights):
+                values[rows] = float('inf')
+                continue
+            short = -(-np.maximum(counts[rows] - held_counts, 0) // batches) * batches
+            short = np.maximum(short[:, None, :], floors[None])
+            with np.errstate(invalid='ignore'):
+                values[rows] = np.where(short > 0, weights[None] * short, 0).sum(axis=2).min(axis=1)
+        if whole_costs:
+            finite = np.isfinite(values)
+            values[finite] = np.ceil(values[finite] - 1e-9)
+        return values
+
+    heuristic.many = many
+    return heuristic
+
+
+def regression_search(table, state, goal, limit, weight=1, stats=None, probe=None):
+    # Searches backwards from goal to state over the recipes of a RecipeTable, primitive or macro, keeping to the
+    # table's item limits if it has them (see RecipeTable.with_limits and need_bounds). Returns a [(state, action)]
+    # plan from state, like search, or None. With a weight above 1 the heuristic is scaled up by it, which finds a
+    # plan sooner but no longer promises the cheapest one. stats and probe are as for search
+    start_time = time()
+    layout = state.layout
+    held = state.counts
+    tool_slots, made_by, makes, requires, regress = regression_steps(table, goal)
+    heuristic = make_regression_heuristic(table, state, tool_slots)
+    bounds = need_bounds(table, held)
+    floors = relevant_floors(table, held)
+
+    def step(node, row):
+        # (reason, None) if row can't be stepped back over from node, else (None, the node before it)
+        counts, made = node
+        if (makes[row] | requires[row]) & made:
+            return 'tool made', None
+        before = regress(counts, row)
+        reason = over_bounds(table, bounds, before, row)
+        if reason is not None:
+            return reason, None
+        return None, (before, made | makes[row])
+
+    def relevant_rows(counts):
+        rows = set()
+        for slot, amount in enumerate(counts):
+            if amount > floors[slot]:
+                rows.update(made_by[slot])
+        return rows
+
+    if probe is not None:
+        unwrapped = heuristic
+
+        def heuristic(counts, made):
+            with probe.timer('heuristic'):
+                probe.count('heuristic calls')
+                return unwrapped(counts, made)
+    dominance = Dominance(layout, [len(layout.items)])
+
+    start = (layout.state(goal).counts, 0)
+    state_count = 0
+    distances = {start: 0}
+    parent = {start: None}
+    queue = [(heuristic(*start), 0, start)]
+    if probe is not None:
+        probe.timers['setup'] += time() - start_time
+    while queue and time() - start_time < limit:
+        priority, curr_dist, node = heappop(queue)
+        curr_dist = -curr_dist
+        if curr_dist > distances[node]:
+            #queued again since at a lower cost
+            continue
+        counts, made = node
+        state_count += 1
+        if probe is not None:
+            probe.expanded(len(queue))
+        if all(map(le, counts, held)):
+            print("Compute Time: " + str(time() - start_time))
+            print("Game Time: {cost = " + str(curr_dist) + "}")
+            print("States Visited: " + str(state_count))
+            if stats is not None:
+                stats['states'] = state_count
+            if probe is not None:
+                probe.timers['search'] += time() - start_time
+            rows = []
+            while parent[node] is not None:
+                node, row = parent[node]
+                rows.append(row)
+            #the rows were found from the goal back, so they are already in forward order
+            return replay(table, state, rows)
+        dominance.add(Need(tuple(-amount for amount in counts) + (made,)), curr_dist)
+        relevant = relevant_rows(counts)
+        #the need this one was stepped back from, and over which row
+        after, last = parent[node] if parent[node] is not None else (None, None)
+        if last is not None:
+            relevant_after = relevant_rows(after[0])
+        for row in relevant:
+            reason, previous = step(node, row)
+            if reason is None and last is not None and row > last and row in relevant_after:
+                #two recipes that could go in either order are only tried in one: the higher row can't come right
+                #before the lower one, unless the other order would need more or isn't allowed
+                middle = step(after, row)[1]
+                if middle is not None and last in relevant_rows(middle[0]):
+                    swapped = step(middle, last)[1]
+                    if swapped is not None and all(map(le, swapped[0], previous[0])):
+                        reason = 'order'
+            if reason is not None:
+                if probe is not None:
+                    probe.count('pruned: ' + reason)
+                continue
+            before = previous[0]
+            pathcost = curr_dist + table.costs[row]
+            if previous in distances and pathcost >= distances[previous]:
+                if probe is not None:
+                    probe.count('duplicates')
+                continue
+            if dominance.dominated(Need(tuple(-amount for amount in before) + (previous[1],)), pathcost):
+                if probe is not None:
+                    probe.count('pruned: dominated')
+                continue
+            estimate = heuristic(*previous)
+            if estimate == float('inf'):
+                if probe is not None:
+                    probe.count('pruned: unreachable')
+                continue
+            distances[previous] = pathcost
+            parent[previous] = (node, row)
+            heappush(queue, (pathcost + weight * estimate, -pathcost, previous))
+
+    if stats is not None:
+        stats['states'] = state_count
+    if probe is not None:
+        probe.timers['search'] += time() - start_time
+    print(time() - start_time, 'seconds.')
+    if queue:
+        print("Failed to find a path from", state, 'within time limit.')
+    else:
+        print("Failed to find a path from", state, '(no needs left to search).')
+    return None
+
+
+def replay(table, state, rows):
+    # Fires rows of the table from state in order, as a [(state, action)] plan ending in "End of Path"
+    path = []
+    layout = state.layout
+    for row in rows:
+        path.append((state, table.names[row]))
+        counts = list(state.counts)
+        for slot, change in table.changes[row]:
+            counts[slot] += change
+        state = State(layout, tuple(counts))
+    path.append((state, "End of Path"))
+    return path
@@ -0,0 +1,299 @@
+from heapq import heapify, heappop, heappush
+from operator import gt, le
+from timeit import default_timer as time
+
+import numpy as np
+
+from craft_planner import State, Dominance
+from regression import (Need, regression_steps, need_bounds, over_bounds, relevant_floors, make_regression_heuristic,
+                        replay)
+
+# Replans as a plan is carried out, keeping the search from one call to the next. The search is the backward one of
+# regression.py, in the spirit of D* Lite: it grows a tree of needs from the goal, and what a need costs from the goal
+# doesn't depend on the inventory at all, only which needs count as reached and what the heuristic says do.
+#
+# While the live inventory is one the last plan passes through, only the steps taken have changed, and the rest of
+# that plan is returned as it is, without searching. When the inventory drifts from the plan (an extra drop, a lost
+# item), the tree is kept and repaired:
+#   - an expanded need that the new inventory covers is queued again, as a plan found already
+#   - an expanded need now missing an item it didn't miss before only stepped back over the recipes that were
+#     relevant then, so it is queued again to step back over the newly relevant ones (and only those)
+#   - the needs waiting to be expanded are estimated again against the new inventory, all in one go (see
+#     heuristic.many). Nothing costing more than the cheapest need the inventory covers could come off the queue
+#     before it, so those are left waiting as they are
+# and the search carries on from there. Everything else, the costs, parents and children of every need expanded, is
+# used as it is, so the search only expands what the change touched.
+#
+# A change of goal moves the root of the tree, so it gets a tree of its own. The last few trees are kept, so going
+# back to an earlier goal picks its tree up where it was left. Unlike regression_search, two steps that could go in
+# either order are both tried, since which one is pruned depends on the inventory.
+
+
+class SearchTree(object):
+    """ The backward search for one goal, over one table, kept between calls (see the top of this file). Every need
+        found is kept in arrays (its counts, made mask, cost, whether it was expanded and whether it waits to be), so
+        the repair is a few array operations over the whole tree.
+    """
+
+    def __init__(self, table, goal, weight=1):
+        layout = table.layout
+        self.table = table
+        self.layout = layout
+        self.weight = weight
+        self.tool_slots, self.made_by, self.makes, self.requires, self.regress = regression_steps(table, goal)
+        self.bounds = None
+        self.floors = None
+        self.held = None
+        self.heuristic = None
+        self.dominance = Dominance(layout, [len(layout.items)])
+        self.root = (layout.state(goal).counts, 0)
+        self.distances = {self.root: 0}
+        self.parent = {self.root: None}
+        self.queue = []             #(priority, -cost, need), the open needs estimated for the current inventory
+        self.tried = {}             #expanded need -> rows stepped back over from it so far
+        self.capped = set()         #(need, row) steps pruned for asking more of an item than its cap
+        self.nodes = []
+        self.index = {}             #need -> its place in nodes and the arrays
+        self.needs = np.zeros((64, len(layout.items)), dtype=np.int64)
+        self.made = np.zeros(64, dtype=np.int64)
+        self.costs = np.zeros(64)
+        self.closed = np.zeros(64, dtype=bool)
+        self.open = np.zeros(64, dtype=bool)
+        self.found(self.root, 0)
+
+    def found(self, node, cost):
+        # Records a need as open at cost, adding it to the arrays if it is new
+        index = self.index.get(node)
+        if index is None:
+            index = self.index[node] = len(self.nodes)
+            if index == len(self.costs):
+                #double the room whenever the arrays fill up, as Dominance does
+                for name in ('needs', 'made', 'costs', 'closed', 'open'):
+                    array = getattr(self, name)
+                    setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+            self.needs[index] = node[0]
+            self.made[index] = node[1]
+            self.nodes.append(node)
+        self.distances[node] = cost
+        self.costs[index] = cost
+        self.open[index] = True
+
+    def relevant(self, counts):
+        # The rows that make an item counts asks for, past what the inventory holds of it if nothing uses it up (see
+        # relevant_floors)
+        rows = set()
+        for slot, amount in enumerate(counts):
+            if amount > self.floors[slot]:
+                rows.update(self.made_by[slot])
+        return rows
+
+    def covered(self, counts):
+        return all(map(le, counts, self.held))
+
+    def step(self, node, row):
+        # The need before row given node after it, or None if row can't be stepped back over from node
+        counts, made = node
+        if (self.makes[row] | self.requires[row]) & made:
+            return None
+        before = self.regress(counts, row)
+        #as in regression_search. The caps grow with the inventory, so a step they prune is remembered to be tried
+        #again if they do
+        reason = over_bounds(self.table, self.bounds, before, row)
+        if reason is not None:
+            if reason == 'cap':
+                self.capped.add((node, row))
+            return None
+        return before, made | self.makes[row]
+
+    def move_to(self, held, stats):
+        # Repairs the tree for the inventory held (a tuple of counts), see the top of this file. Nothing costing more
+        # than the cheapest need the inventory covers can come off the queue before it, so only the open needs that
+        # cost no more than that are estimated again; the rest wait until an inventory makes them worth it
+        old = self.held
+        self.held = held
+        self.heuristic = make_regression_heuristic(self.table, State(self.layout, held), self.tool_slots)
+        retry = set()
+        bounds = need_bounds(self.table, held)
+        #the caps only grow when the inventory holds more than an item's limit, and then the steps they pruned are
+        #allowed again
+        if self.bounds is not None and any(map(gt, bounds[1], self.bounds[1])):
+            for node, row in self.capped:
+                if node in self.tried:
+                    self.tried[node].discard(row)
+                    retry.add(self.index[node])
+            self.capped = set()
+        self.bounds = bounds
+        self.floors = relevant_floors(self.table, held)
+
+        used = len(self.nodes)
+        needs = self.needs[:used]
+        costs = self.costs[:used]
+        counts = np.array(held)
+        covered = (needs <= counts).all(axis=1)
+        bound = costs[covered].min() if covered.any() else float('inf')
+        if old is not None:
+            changed = np.flatnonzero(counts != np.array(old))
+            gained = ((needs[:, changed] > counts[changed]) & ~(needs[:, changed] > np.array(old)[changed])).any(axis=1)
+            retry.update(np.flatnonzero(self.closed[:used] & (gained | (covered & (costs <= bound)))).tolist())
+            for index in retry:
+                node = self.nodes[index]
+                if not self.open[index] and (covered[index] or self.relevant(node[0]) - self.tried[node]):
+                    self.open[index] = True
+                    stats['reopened'] += 1
+
+        rekey = np.flatnonzero(self.open[:used] & (costs <= bound))
+        estimates = self.heuristic.many(needs[rekey], self.made[rekey])
+        estimates[covered[rekey]] = 0
+        finite = np.isfinite(estimates)
+        rekey = rekey[finite]
+        priorities = costs[rekey] + self.weight * estimates[finite]
+        self.queue = list(zip(priorities.tolist(), (-costs[rekey]).tolist(), [self.nodes[index] for index in rekey]))
+        heapify(self.queue)
+        stats['rekeyed'] = len(estimates)
+
+    def search(self, limit, stats):
+        # Carries the search on until a need the inventory covers comes off the queue, and returns the rows of its
+        # plan, or None once the queue runs dry or limit seconds are up. The tree is left as it is either way, so the
+        # next call carries on from here
+        start_time = time()
+        distances = self.distances
+        count = 0
+        while self.queue and time() - start_time < limit:
+            priority, cost, node = heappop(self.queue)
+            cost = -cost
+            index = self.index[node]
+            if cost > distances[node] or not self.open[index]:
+                #queued again since at a lower cost, or expanded already
+                continue
+            if self.covered(node[0]):
+                #left queued, so the next call finds it again straight away if nothing has changed
+                heappush(self.queue, (priority, -cost, node))
+                stats['states'] = count
+                rows = []
+                while self.parent[node] is not None:
+                    node, row = self.parent[node]
+                    rows.append(row)
+                return rows
+            count += 1
+            self.open[index] = False
+            self.closed[index] = True
+            self.dominance.add(Need(tuple(-amount for amount in node[0]) + (node[1],)), cost)
+            tried = self.tried.setdefault(node, set())
+            rows = self.relevant(node[0]) - tried
+            tried.update(rows)
+            for row in rows:
+                previous = self.step(node, row)
+                if previous is None:
+                    continue
+                pathcost = cost + self.table.costs[row]
+                if previous in distances and pathcost >= distances[previous]:
+                    continue
+                if self.dominance.dominated(Need(tuple(-amount for amount in previous[0]) + (previous[1],)), pathcost):
+                    continue
+                self.found(previous, pathcost)
+                self.parent[previous] = (node, row)
+                if previous in self.tried:
+                    #reached at a lower cost than when it was expanded, so all of its steps are worth trying again
+                    self.tried[previous] = set()
+                estimate = 0 if self.covered(previous[0]) else self.heuristic(*previous)
+                #a need the heuristic rules out stays open, to be estimated again for the next inventory
+                if estimate != float('inf'):
+                    heappush(self.queue, (pathcost + self.weight * estimate, -pathcost, previous))
+        stats['states'] = count
+        return None
+
+
+class Replanner(object):
+    """ Plans for one Planner's recipes and options again and again as the inventory (or the goal) changes, keeping
+        the search from call to call (see the top of this file). Searches backwards like a Planner with
+        search='regression', so of the options only the weight, macros, skip_dominated and limits count.
+
+        Not thread-safe: each executor of a plan keeps its own Replanner.
+    """
+
+    def __init__(self, planner, goal=None, keep=4):
+        self.planner = planner
+        self.goal = goal
+        self.keep = keep
+        self.trees = {}             #goal -> (SearchTree, macro steps), the most recently used last
+        self.last = None            #(goal, plan) of the last plan returned
+
+    def tree(self, goal):
+        key = tuple(sorted((item, amount) for item, amount in goal.items() if amount))
+        found = self.trees.pop(key, None)
+        if found is None:
+            table, steps = self.planner.search_table(goal)[:2]
+            found = (SearchTree(table, goal, self.planner.weight), steps)
+            if len(self.trees) >= self.keep:
+                del self.trees[next(iter(self.trees))]
+        self.trees[key] = found
+        return found
+
+    def plan(self, current, goal=None, deadline=30, stats=None):
+        # Plans from current (an inventory dict or a State) to goal, or to the last goal given if goal is None.
+        # Returns a [(state, action)] plan over the primitive recipes, or None if the search ran out of needs or of
+        # deadline seconds (the next call carries on where it stopped). stats, if given, is a dict that gets the
+        # needs expanded by this call under 'states', how many expanded needs the repair queued again under
+        # 'reopened', and how many needs it estimated again under 'rekeyed'
+        start_time = time()
+        if goal is not None:
+            self.goal = goal
+        if self.goal is None:
+            raise ValueError('no goal to plan for')
+        layout = self.planner.layout
+        state = current if isinstance(current, State) else layout.state(current)
+        if self.last is not None and self.last[0] == self.goal:
+            #the inventory is one the last plan passes through, so nothing has changed but the steps taken, and the
+            #rest of that plan is still the best (partway through a macro, too, which a search over macros can't do)
+            for position, (planned, action) in enumerate(self.last[1]):
+                if planned == state:
+                    if stats is not None:
+                        stats.update(states=0, reopened=0, rekeyed=0)
+                    return self.last[1][position:]
+        tree, steps = self.tree(self.goal)
+        found = {'reopened': 0, 'rekeyed': 0}
+        if tree.held != state.counts:
+            tree.move_to(state.counts, found)
+        rows = tree.search(deadline - (time() - start_time), found)
+        if stats is not None:
+            stats.update(found)
+        if rows is None:
+            print(time() - start_time, 'seconds.')
+            if tree.queue:
+                print("Failed to find a path from", state, 'within time limit.')
+            else:
+                print("Failed to find a path from", state, '(no needs left to search).')
+            return None
+        plan = replay(tree.table, state, rows)
+        print("Compute Time: " + str(time() - start_time))
+        print("Game Time: {cost = " + str(sum(tree.table.costs[row] for row in rows)) + "}")
+        print("States Visited: " + str(found['states']))
+        plan = self.planner.expand(plan, steps)
+        self.last = (dict(self.goal), plan)
+        return plan
+
+
+if __name__ == '__main__':
+    from loader import load_crafting
+    from planner import Planner
+    Crafting = load_crafting('Crafting.json')
+
+    # Carries out a plan for a cart step by step, losing a stick a few steps in, and replans after every step (the
+    # problem's own goal is more than a backward search finishes in time)
+    planner = Planner.from_crafting(Crafting, search='regression')
+    replanner = Replanner(planner, {'cart': 1})
+    plan = replanner.plan(Crafting['Initial'])
+    taken = 0
+    while plan and len(plan) > 1:
+        action = plan[0][1]
+        current = plan[1][0]
+        taken += 1
+        if taken == 5 and current['stick']:
+            print('Lost a stick')
+            counts = list(current.counts)
+            counts[planner.layout.index['stick']] -= 1
+            current = current.with_counts(tuple(counts))
+        stats = {}
+        start_time = time()
+        plan = replanner.plan(current, stats=stats)
+        print('%-20s replanned in %.4fs, %s' % (action, time() - start_time, stats))
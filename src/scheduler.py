@@ -0,0 +1,209 @@
+import sys
+from collections import namedtuple, defaultdict, deque
+from heapq import heappop, heappush
+from timeit import default_timer as time
+
+# Turns a sequential [(state, action)] plan into a schedule for several workers crafting at once, from one shared
+# inventory. A step takes what it consumes when it starts and adds what it produces when it finishes, Time later, and
+# each tool it requires is in its hands for that long, so one stone_pickaxe can't mine on two workers at the same time.
+#
+# First the plan is turned into a partial order: every unit a step consumes is traced back to the step that produced
+# it, and every tool it requires to the step that made it. Any order of the steps that keeps to those links has
+# the items each step needs in the inventory, so the steps are free to overlap otherwise. The steps are then list
+# scheduled: whenever a worker is free it takes the ready step with the longest chain of work still behind it.
+#
+# A plan that is cheapest for one worker usually makes one of each tool, and then every step needing that tool waits
+# its turn however many workers there are. makespan_plan plans for the workers instead: it asks the planner for one
+# more copy of the busiest tool, and keeps the plan if its schedule finishes sooner. Tools aren't owned by a worker,
+# whoever is free picks up a free copy.
+
+#after holds the indexes of the steps that have to finish before this one can start
+Step = namedtuple('Step', ['index', 'action', 'duration', 'after'])
+
+
+def partial_order(plan, recipes):
+    # The plan's steps as a list of Steps. Units are handed out oldest first, so a step depends on the earliest
+    # producers it can
+    held = defaultdict(deque)       #item -> [producer, amount, users] lots, the initial inventory's producer is None
+    for item, amount in plan[0][0].items():
+        if amount:
+            held[item].append([None, amount, []])
+    steps = []
+    for index, (state, action) in enumerate(plan[:-1]):
+        rule = recipes[action]
+        after = set()
+        for item, amount in rule.get('Requires', {}).items():
+            needed = 1 if amount is True else amount
+            for lot in held[item]:
+                if needed <= 0:
+                    break
+                after.add(lot[0])
+                lot[2].append(index)
+                needed -= lot[1]
+            if needed > 0:
+                raise ValueError('step %d (%s) requires %s before it is made' % (index, action, item))
+        for item, amount in rule.get('Consumes', {}).items():
+            lots = held[item]
+            while amount > 0 and lots:
+                lot = lots[0]
+                #the steps that only needed the item to be there have to be done with it first
+                after.add(lot[0])
+                after.update(lot[2])
+                taken = min(amount, lot[1])
+                lot[1] -= taken
+                amount -= taken
+                if not lot[1]:
+                    lots.popleft()
+            if amount > 0:
+                raise ValueError('step %d (%s) consumes more %s than is held' % (index, action, item))
+        for item, amount in rule['Produces'].items():
+            held[item].append([index, amount, []])
+        after.discard(None)
+        after.discard(index)
+        steps.append(Step(index, action, rule['Time'], frozenset(after)))
+    return steps
+
+
+def critical_path(steps):
+    # The longest chain of work from the start of each step to the end of the plan, its own Time included. Steps
+    # only depend on earlier ones, so one pass from the back does it
+    tails = [step.duration for step in steps]
+    for step in reversed(steps):
+        for other in step.after:
+            tails[other] = max(tails[other], steps[other].duration + tails[step.index])
+    return tails
+
+
+def schedule(plan, recipes, workers=2):
+    # Schedules plan over the given number of workers. Returns (entries, makespan), where entries holds a
+    # (start, worker, action) for each step, in order of start time
+    steps = partial_order(plan, recipes)
+    tails = critical_path(steps)
+    waiting = [len(step.after) for step in steps]
+    followers = [[] for step in steps]
+    for step in steps:
+        for other in step.after:
+            followers[other].append(step.index)
+    inventory = defaultdict(int, plan[0][0].items())
+    in_use = defaultdict(int)
+    ready = [step.index for step in steps if not step.after]
+    running = []                    #heap of (finish, worker, index)
+    free = list(range(workers))
+    entries = []
+    now = 0
+    while ready or running:
+        #hand out ready steps, longest chain first, to free workers while their tools are free
+        ready.sort(key=lambda index: (-tails[index], index))
+        for index in list(ready):
+            if not free:
+                break
+            rule = recipes[steps[index].action]
+            tools = [(item, 1 if amount is True else amount) for item, amount in rule.get('Requires', {}).items()]
+            if any(inventory[item] - in_use[item] < amount for item, amount in tools):
+                continue
+            for item, amount in tools:
+                in_use[item] += amount
+            for item, amount in rule.get('Consumes', {}).items():
+                inventory[item] -= amount
+            worker = free.pop(0)
+            ready.remove(index)
+            entries.append((now, worker, steps[index].action))
+            heappush(running, (now + steps[index].duration, worker, index))
+        if not running:
+            raise ValueError('no step can start, the plan is not valid from its first state')
+        #move on to the next step to finish, and everything finishing with it
+        now = running[0][0]
+        while running and running[0][0] == now:
+            finish, worker, index = heappop(running)
+            rule = recipes[steps[index].action]
+            for item, amount in rule.get('Requires', {}).items():
+                in_use[item] -= 1 if amount is True else amount
+            for item, amount in rule['Produces'].items():
+                inventory[item] += amount
+            free.append(worker)
+            for follower in followers[index]:
+                waiting[follower] -= 1
+                if not waiting[follower]:
+                    ready.append(follower)
+        free.sort()
+    return entries, now
+
+
+def tool_time(plan, recipes):
+    # {tool: total Time of the plan's steps that require it}
+    busy = defaultdict(int)
+    for state, action in plan[:-1]:
+        for item in recipes[action].get('Requires', {}):
+            busy[item] += recipes[action]['Time']
+    return dict(busy)
+
+
+def lower_bound(plan, recipes, workers=2):
+    # No schedule of the plan's steps can finish sooner than its longest chain, its total work split evenly between
+    # the workers, or the work needing a tool split evenly between the copies of it the plan ends up with
+    steps = partial_order(plan, recipes)
+    bound = max(max(critical_path(steps) or [0]), sum(step.duration for step in steps) / float(workers))
+    final = plan[-1][0]
+    for tool, busy in tool_time(plan, recipes).items():
+        bound = max(bound, busy / float(max(final[tool], 1)))
+    return bound
+
+
+def makespan_plan(planner, initial, goal, workers=2, deadline=30, trial_limit=2):
+    # Plans from initial to goal with a planner.Planner for the given number of workers. Starting from the planner's
+    # own plan, the goal asks for one more copy of a tool, busiest first, as long as there are fewer copies than
+    # workers, and the first plan that schedules sooner is kept. Each of those plans gets at most trial_limit seconds,
+    # and the whole thing stops when no extra tool helps or after deadline seconds. Returns (plan, entries, makespan)
+    # for the best plan found, or None
+    start_time = time()
+    recipes = planner.compiled.recipes
+    plan = planner.plan(initial, goal, deadline)
+    if not plan:
+        return None
+    best = (plan,) + schedule(plan, recipes, workers)
+    best_goal = dict(goal)
+    improved = True
+    while improved:
+        improved = False
+        busy = tool_time(best[0], recipes)
+        for tool in sorted(busy, key=lambda tool: -busy[tool]):
+            copies = best[0][-1][0][tool]
+            remaining = deadline - (time() - start_time)
+            if copies >= workers or remaining <= 0:
+                continue
+            trial_goal = dict(best_goal)
+            trial_goal[tool] = copies + 1
+            plan = planner.plan(initial, trial_goal, min(remaining, trial_limit))
+            if not plan:
+                continue
+            entries, makespan = schedule(plan, recipes, workers)
+            if makespan < best[2]:
+                best = (plan, entries, makespan)
+                best_goal = trial_goal
+                improved = True
+                break
+    return best
+
+
+def format_schedule(entries, makespan):
+    lines = ['%6s  %-6s %s' % ('start', 'worker', 'action')]
+    for start, worker, action in entries:
+        lines.append('%6g  %-6d %s' % (start, worker, action))
+    lines.append('Makespan: ' + str(makespan))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from loader import load_crafting
+    Crafting = load_crafting('Crafting.json')
+
+    # Plans the problem for the number of workers given as the first argument (2 by default), e.g.
+    # python scheduler.py 3, and prints the schedule
+    from planner import Planner
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    found = makespan_plan(Planner.from_crafting(Crafting), Crafting['Initial'], Crafting['Goal'], workers, 30)
+    if found:
+        resulting_plan, entries, makespan = found
+        print(format_schedule(entries, makespan))
+        print('Sequential: ' + str(sum(Crafting['Recipes'][action]['Time'] for state, action in resulting_plan[:-1])))
+        print('Lower bound: ' + str(lower_bound(resulting_plan, Crafting['Recipes'], workers)))
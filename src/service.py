@@ -0,0 +1,395 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from time import time as wall_time
+from timeit import default_timer as time
+
+from loader import is_count
+from plan_cache import canonical_hash, plan_cost
+from planner import Planner, compile_recipes
+
+# An asyncio front end to the planner, for callers that can't block on a search. Searches run in a process pool, so
+# the event loop only ever waits on futures, and every request gets its own deadline.
+#
+# Cancelling a request (a client going away) cancels its search for real, not just the wait for it: every search is
+# handed a probe (see Cancellable) that the search calls once per expanded state, and that gives up the search as soon
+# as the service sets the search's flag in a shared array. The worker is then free for the next search straight away.
+#
+# Identical requests (same initial inventory, goal and options) arriving while a search for them is still running
+# don't start another one: they wait on the running search, which is only cancelled once every request waiting on it
+# has gone. A request that joins a search gets that search's result, found within the deadline of the request that
+# started it.
+#
+# Requests and responses are JSON lines, over stdin/stdout or a Unix socket:
+#   {"id": ..., "Initial": {...}, "Goal": {...}, "deadline": seconds}
+#       -> {"id": ..., "plan": [action, ...], "cost": ..., "states": ..., "time": ..., "coalesced": ...}
+#   {"id": ..., "metrics": true}
+#       -> {"id": ..., "metrics": {...}}                (see PlanningService.metrics)
+# "plan" and "cost" are null when no plan was found in time, and a request that fails gets {"id": ..., "error": ...},
+# as does one that isn't an object with amounts of known items (id null if it has none).
+# Responses are written as their searches finish, not in request order. On stdin, the end of input waits for the
+# requests still open; on a socket, the client closing its end cancels them.
+#
+#   python service.py --recipes Crafting.json --workers 4
+#   python service.py --socket /tmp/planner.sock
+
+#how many searches can be queued or running at once, a request past that waits for one to finish
+MAX_SEARCHES = 256
+#how many of the latest request latencies the metrics are worked out from
+LATENCY_WINDOW = 1000
+#how long past its deadline a search is waited on, for the time it takes to come back from the worker
+DEADLINE_SLACK = 1.0
+
+_flags = None               #the shared cancellation flags, one per search slot, in each worker
+_Crafting = None            #the Crafting dict the workers plan with
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Cancellable(object):
+    """ A stand-in for an instrument.Probe that collects nothing, and raises Cancelled out of the search once the
+        flag for its search slot is set. The flag is only read every check_every expansions.
+    """
+
+    def __init__(self, flags, slot, check_every=64):
+        self.flags = flags
+        self.slot = slot
+        self.check_every = check_every
+        self.expansions = 0
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+
+    def count(self, name, amount=1):
+        pass
+
+    @contextmanager
+    def timer(self, phase):
+        yield
+
+    def expanded(self, open_size):
+        self.expansions += 1
+        if self.expansions % self.check_every == 0 and self.flags[self.slot]:
+            raise Cancelled()
+
+    def wrap_graph(self, graph, checks=None):
+        return graph
+
+    def wrap_heuristic(self, heuristic):
+        return heuristic
+
+
+def init_worker(flags, Crafting):
+    # Runs once in each worker, and compiles the recipes there once
+    global _flags, _Crafting
+    #the searches print as they go, which would only end up in the service's output
+    sys.stdout = open(os.devnull, 'w')
+    _flags = flags
+    _Crafting = Crafting
+    compile_recipes(Crafting['Items'], Crafting['Recipes'])
+
+
+def run_search(slot, initial, goal, deadline, options):
+    # Plans one problem in a worker, giving up at deadline (wall clock seconds) or once the slot's flag is set
+    start_time = time()
+    limit = deadline - wall_time()
+    if limit <= 0:
+        return {'plan': None, 'cost': None, 'states': 0, 'time': 0}
+    stats = {}
+    try:
+        plan = Planner.from_crafting(_Crafting, **options).plan(initial, goal, limit, stats=stats,
+                                                               probe=Cancellable(_flags, slot))
+    except Cancelled:
+        return {'cancelled': True, 'states': stats.get('states'), 'time': time() - start_time}
+    return {'plan': [action for state, action in plan[:-1]] if plan else None,
+            'cost': plan_cost(plan, _Crafting['Recipes']) if plan else None,
+            'states': stats.get('states'), 'time': time() - start_time}
+
+
+class Search(object):
+    # One search for a problem: the task that waits for a search slot and runs it in the pool, the slot while it has
+    # one, and how many requests are waiting on it
+    def __init__(self, key):
+        self.key = key
+        self.task = None
+        self.slot = None
+        self.waiters = 0
+
+
+class PlanningService(object):
+    """ Plans requests for one recipe set in a pool of worker processes (see the top of this file). Must be used from
+        within a running event loop, and closed with close() when done.
+
+        options are Planner options, used for every search.
+    """
+
+    def __init__(self, Crafting, workers=None, options=None, default_deadline=30, max_searches=MAX_SEARCHES):
+        self.Crafting = Crafting
+        self.items = set(Crafting['Items'])
+        self.options = dict(options or {})
+        self.default_deadline = default_deadline
+        self.workers = workers or os.cpu_count()
+        context = get_context('spawn')
+        self.flags = context.Array('b', max_searches, lock=False)
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=init_worker,
+                                        initargs=(self.flags, Crafting))
+        self.free_slots = list(range(max_searches))
+        self.slots = asyncio.Semaphore(max_searches)
+        self.searches = {}          #request key -> Search still running
+        self.waiting = 0            #searches waiting for a free slot
+        self.open = 0               #requests not answered yet
+        self.counters = defaultdict(int)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        #the recipes are part of every request key, since one key may be shared by services on other recipes
+        self.recipes_key = canonical_hash({'Items': Crafting['Items'], 'Recipes': Crafting['Recipes']})
+
+    def key(self, initial, goal):
+        return canonical_hash({'recipes': self.recipes_key, 'Initial': initial, 'Goal': goal,
+                               'options': self.options})
+
+    def start(self, key, initial, goal, deadline):
+        # Starts a Search for the problem, giving up at deadline (wall clock seconds)
+        search = self.searches[key] = Search(key)
+        search.task = asyncio.ensure_future(self.run(search, initial, goal, deadline))
+
+        def finished(task):
+            if self.searches.get(key) is search:
+                del self.searches[key]
+
+        search.task.add_done_callback(finished)
+        return search
+
+    async def run(self, search, initial, goal, deadline):
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        search.slot = self.free_slots.pop()
+        self.flags[search.slot] = 0
+        try:
+            #once the search is in the pool it is only ever stopped through its flag, so the slot isn't handed on
+            #while the worker could still be reading it
+            future = asyncio.get_running_loop().run_in_executor(self.pool, run_search, search.slot, initial, goal,
+                                                                deadline, self.options)
+            while True:
+                try:
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    self.flags[search.slot] = 1
+        finally:
+            self.free_slots.append(search.slot)
+            search.slot = None
+            self.slots.release()
+
+    def cancel(self, search):
+        if self.searches.get(search.key) is search:
+            del self.searches[search.key]
+        if search.slot is None:
+            #still waiting for a slot
+            search.task.cancel()
+        else:
+            self.flags[search.slot] = 1
+
+    async def plan(self, initial, goal, deadline=None):
+        # Plans from initial to goal within deadline seconds (the service's default_deadline if None). Returns a dict
+        # with the plan as a list of actions (None if none was found in time), its cost, the states searched, the
+        # search's time and whether the request joined a search already running. Raises asyncio.TimeoutError if the
+        # search doesn't come back in time, and cancelling the call cancels the search, unless other requests are
+        # still waiting on it
+        start_time = time()
+        deadline = self.default_deadline if deadline is None else deadline
+        self.counters['requests'] += 1
+        self.open += 1
+        key = self.key(initial, goal)
+        search = self.searches.get(key)
+        coalesced = search is not None
+        if coalesced:
+            self.counters['coalesced'] += 1
+        else:
+            search = self.start(key, initial, goal, wall_time() + deadline)
+        search.waiters += 1
+        try:
+            result = await asyncio.wait_for(asyncio.shield(search.task), deadline + DEADLINE_SLACK)
+        except asyncio.CancelledError:
+            self.counters['cancelled'] += 1
+            raise
+        except asyncio.TimeoutError:
+            self.counters['timed out'] += 1
+            raise
+        except Exception:
+            self.counters['failed'] += 1
+            raise
+        finally:
+            self.open -= 1
+            search.waiters -= 1
+            if not search.waiters and not search.task.done():
+                #nobody is left waiting for it
+                self.cancel(search)
+        if result.get('cancelled'):
+            #cancelled by the last request waiting on it just as this one joined
+            self.counters['cancelled'] += 1
+            raise asyncio.CancelledError()
+        self.counters['planned' if result['plan'] is not None else 'no plan'] += 1
+        self.latencies.append(time() - start_time)
+        return dict(result, coalesced=coalesced)
+
+    def metrics(self):
+        # A dict of the service's state: requests open, searches waiting for a slot, searches started and not done
+        # (and not cancelled), queue depth (those of them no worker is free for), the counters (requests, coalesced,
+        # planned, no plan, cancelled, timed out, failed) and the mean, median, 95th percentile and maximum latency
+        # in seconds of the latest answered requests
+        searches = len(self.searches)
+        metrics = {'open': self.open, 'waiting': self.waiting, 'searches': searches, 'workers': self.workers,
+                   'queue_depth': max(searches - self.workers, 0), 'counters': dict(self.counters)}
+        latencies = sorted(self.latencies)
+        if latencies:
+            metrics['latency'] = {'mean': sum(latencies) / len(latencies),
+                                  'p50': latencies[len(latencies) // 2],
+                                  'p95': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+                                  'max': latencies[-1]}
+        return metrics
+
+    def close(self):
+        for slot in range(len(self.flags)):
+            self.flags[slot] = 1
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def request_problems(request, items):
+    # What is wrong with a plan request, as a list of messages, given the recipe set's Items
+    problems = []
+    for key in ('Initial', 'Goal'):
+        if key not in request and key == 'Initial':
+            continue
+        amounts = request.get(key)
+        if not isinstance(amounts, dict):
+            problems.append(key + ' should be an object of item amounts')
+            continue
+        for item, amount in amounts.items():
+            if item not in items:
+                problems.append('%s: %r is not in Items' % (key, item))
+            elif not is_count(amount):
+                problems.append('%s: %r should be a whole number of at least 0, not %r' % (key, item, amount))
+    deadline = request.get('deadline')
+    if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or deadline < 0):
+        problems.append('deadline should be a number of seconds, not %r' % (deadline,))
+    return problems
+
+
+async def answer(service, request):
+    # The response to one request line, as a dict
+    if not isinstance(request, dict):
+        return {'id': None, 'error': 'a request should be an object'}
+    if request.get('metrics'):
+        return {'id': request.get('id'), 'metrics': service.metrics()}
+    problems = request_problems(request, service.items)
+    if problems:
+        return {'id': request.get('id'), 'error': '; '.join(problems)}
+    try:
+        result = await service.plan(request.get('Initial', {}), request['Goal'], request.get('deadline'))
+    except asyncio.TimeoutError:
+        return {'id': request.get('id'), 'error': 'deadline passed'}
+    except (KeyError, ValueError) as e:
+        return {'id': request.get('id'), 'error': repr(e)}
+    return dict(result, id=request.get('id'))
+
+
+async def serve_stream(service, reader, write, cancel_on_eof):
+    # Answers the JSON lines read from reader, passing each response line to write. At the end of the input the
+    # requests still open are cancelled with cancel_on_eof, or else waited for
+    tasks = set()
+
+    async def respond(request):
+        try:
+            response = await answer(service, request)
+        except Exception as e:
+            #every request gets its response line, or a client waiting on its id would wait forever
+            response = {'id': request.get('id') if isinstance(request, dict) else None, 'error': repr(e)}
+        write(json.dumps(response) + '\n')
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                write(json.dumps({'error': 'bad JSON: ' + str(e)}) + '\n')
+                continue
+            task = asyncio.ensure_future(respond(request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (ConnectionError, asyncio.CancelledError):
+        cancel_on_eof = True
+    if cancel_on_eof:
+        for task in tasks:
+            task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def serve_stdio(service):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    output = sys.stdout
+
+    def write(text):
+        output.write(text)
+        output.flush()
+
+    await serve_stream(service, reader, write, cancel_on_eof=False)
+
+
+async def serve_unix(service, path):
+    async def connected(reader, writer):
+        def write(text):
+            if not writer.is_closing():
+                writer.write(text.encode('utf-8'))
+
+        try:
+            await serve_stream(service, reader, write, cancel_on_eof=True)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(connected, path)
+    async with server:
+        await server.serve_forever()
+
+
+async def main(args):
+    from loader import load_crafting
+    Crafting = load_crafting(args.recipes)
+    options = {'heuristic': args.heuristic, 'search': args.search, 'node_budget': args.node_budget}
+    service = PlanningService(Crafting, args.workers, options, args.deadline)
+    try:
+        if args.socket:
+            await serve_unix(service, args.socket)
+        else:
+            await serve_stdio(service)
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve plans over stdio or a Unix socket.')
+    parser.add_argument('--recipes', default='Crafting.json', help='crafting file with the Items and Recipes')
+    parser.add_argument('--socket', default=None, help='Unix socket path to listen on (default: stdin/stdout)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--deadline', type=float, default=30, help='seconds allowed for a request without one')
+    parser.add_argument('--heuristic', default='priority', choices=['priority', 'hand_tuned', 'relaxed', 'pattern'])
+    parser.add_argument('--search', default='astar', choices=['astar', 'anytime', 'bounded', 'regression',
+                                                                     'hierarchical', 'bulk'])
+    parser.add_argument('--node-budget', type=int, default=100000, help='states kept in memory by --search bounded')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,146 @@
+from collections import namedtuple
+
+import numpy as np
+
+from craft_planner import RecipeTable, Layout
+
+# Replays plans to check them, without any of the search's machinery. A plan is a list of action names (or a
+# [(state, action)] plan, see actions), and replaying it is array arithmetic over the RecipeTable's delta matrix: the
+# inventory after each step is the initial inventory plus the cumulative sum of the deltas of the steps so far, so the
+# inventory before every step comes out of one cumsum, and every step is checked against its recipe's minimums with
+# one comparison. run_many does the same for any number of plans at once, laid end to end as one long plan, with each
+# plan's running sum started again from its own initial inventory.
+#
+# A step is illegal when the inventory before it doesn't meet its recipe's minimums (what it consumes, and the tools
+# it requires). Replay stops at the first illegal step, so the final inventory and time of an illegal plan are those
+# of the steps before it.
+
+#first_illegal is the index of the first step that can't be taken (None if every step can), missing the {item: amount}
+#it was short of. final is the {item: amount} inventory at the end of the replay, time the total Time of the steps
+#replayed, and goal_met whether the plan is legal and its final inventory meets the goal
+Outcome = namedtuple('Outcome', ['legal', 'first_illegal', 'missing', 'final', 'time', 'goal_met'])
+
+
+def actions(plan):
+    # The action names of a [(state, action)] plan, or of a list of names, without the closing "End of Path"
+    names = [step[1] for step in plan] if plan and isinstance(plan[0], (tuple, list)) else list(plan)
+    return names[:-1] if names and names[-1] == "End of Path" else names
+
+
+class Simulator(object):
+    """ Replays plans over one recipe set's RecipeTable (see the top of this file). """
+
+    def __init__(self, table):
+        self.table = table
+        self.layout = table.layout
+        self.costs = np.array(table.costs, dtype=float)
+
+    @classmethod
+    def from_crafting(cls, Crafting):
+        return cls(RecipeTable(Crafting['Recipes'], Layout(Crafting['Items'])))
+
+    def rows(self, plan):
+        # The table rows of a plan's actions, as an array. An action that isn't a recipe raises a ValueError. A plan
+        # that is already an array of rows is passed through
+        if isinstance(plan, np.ndarray):
+            return plan
+        names = actions(plan)
+        try:
+            return np.fromiter(map(self.table.rows.__getitem__, names), dtype=np.int64, count=len(names))
+        except KeyError as e:
+            raise ValueError('unknown action ' + repr(e.args[0]))
+
+    def vector(self, inventory):
+        counts = np.zeros(len(self.layout.items), dtype=np.int64)
+        for item, amount in dict(inventory or {}).items():
+            counts[self.layout.index[item]] = amount
+        return counts
+
+    def inventory(self, counts):
+        items = self.layout.items
+        return dict((items[slot], amount) for slot, amount in enumerate(counts.tolist()) if amount)
+
+    def trajectory(self, plan, initial=None):
+        # The inventory before the first step and after each step, as a (steps + 1, items) array, replayed whether the
+        # steps are legal or not
+        deltas = self.table.deltas[self.rows(plan)]
+        start = self.vector(initial)
+        return np.vstack([start, start + np.cumsum(deltas, axis=0)])
+
+    def run(self, plan, initial=None, goal=None):
+        # The Outcome of replaying one plan from initial (an inventory dict) against goal
+        return self.run_many([plan], initial, goal)[0]
+
+    def run_many(self, plans, initial=None, goal=None):
+        # The Outcome of each of plans. initial and goal are either one inventory dict for every plan, or a list with
+        # one for each
+        count = len(plans)
+        if not count:
+            return []
+
+        def per_plan(value):
+            if isinstance(value, (list, tuple)):
+                return np.array([self.vector(inventory) for inventory in value])
+            return np.tile(self.vector(value), (count, 1))
+        starts = per_plan(initial)
+        goals = per_plan(goal)
+        plan_rows = [self.rows(plan) for plan in plans]
+        lengths = np.array([len(rows) for rows in plan_rows], dtype=np.int64)
+        rows = np.concatenate(plan_rows)
+        #which plan each step belongs to, and where each plan's steps begin
+        owner = np.repeat(np.arange(count), lengths)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        step_index = np.arange(len(rows)) - offsets[owner]
+        deltas = self.table.deltas[rows]
+        #the running sum over every plan at once, less what the plans before each one added up to
+        totals = np.cumsum(deltas, axis=0)
+        before_plan = np.vstack([np.zeros((1, deltas.shape[1]), dtype=np.int64), totals])[offsets]
+        after = totals - before_plan[owner] + starts[owner]
+        before = after - deltas
+        short = np.maximum(self.table.minimums[rows] - before, 0)
+        illegal = short.any(axis=1)
+        #the first illegal step of each plan, or its length if it has none
+        first = lengths.copy()
+        np.minimum.at(first, owner[illegal], step_index[illegal])
+        #the inventory where each replay stops, and the Time of the steps before that
+        stop = offsets + first - 1
+        finals = np.where((first > 0)[:, None], after[np.maximum(stop, 0)] if len(rows) else starts, starts)
+        replayed = step_index < first[owner]
+        times = np.bincount(owner[replayed], weights=self.costs[rows[replayed]], minlength=count)
+        met = (finals >= goals).all(axis=1)
+        outcomes = []
+        for plan in range(count):
+            legal = bool(first[plan] == lengths[plan])
+            missing = {}
+            if not legal:
+                missing = self.inventory(short[offsets[plan] + first[plan]])
+            outcomes.append(Outcome(legal, None if legal else int(first[plan]), missing, self.inventory(finals[plan]),
+                                    float(times[plan]), legal and bool(met[plan])))
+        return outcomes
+
+
+def check_plan(Crafting, plan, initial=None, goal=None):
+    # The Outcome of a plan for a crafting problem, from Crafting['Initial'] to Crafting['Goal'] unless others are
+    # given
+    simulator = Simulator.from_crafting(Crafting)
+    return simulator.run(plan, Crafting.get('Initial') if initial is None else initial,
+                         Crafting.get('Goal') if goal is None else goal)
+
+
+if __name__ == '__main__':
+    # Checks a plan, one action per line as in solution.txt (lines that aren't recipe names are skipped), e.g.
+    # python simulator.py solution.txt
+    import sys
+    from loader import load_crafting
+    Crafting = load_crafting('Crafting.json')
+    with open(sys.argv[1] if len(sys.argv) > 1 else 'solution.txt') as f:
+        plan = [line.strip() for line in f if line.strip() in Crafting['Recipes']]
+    outcome = check_plan(Crafting, plan)
+    print('Steps: ' + str(len(plan)))
+    print('Legal: ' + str(outcome.legal))
+    if not outcome.legal:
+        print('First illegal step: ' + str(outcome.first_illegal) + ' (' + plan[outcome.first_illegal] + '), short of '
+              + str(outcome.missing))
+    print('Game Time: ' + str(outcome.time))
+    print('Final: ' + str(outcome.final))
+    print('Goal met: ' + str(outcome.goal_met))
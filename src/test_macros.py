@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+from loader import load_crafting
+from plan_cache import plan_cost
+from planner import Planner
+
+Crafting = load_crafting(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Crafting.json'), directory=None)
+
+#problems starting out with intermediates the macro chains make (ore, cobble, stick...)
+HELD = [
+    ({'iron_axe': 4, 'ore': 3, 'rail': 4}, {'cart': 1}),
+    ({'cobble': 2, 'ore': 4}, {'stone_axe': 2, 'rail': 7}),
+    ({'stick': 1, 'bench': 3, 'ore': 3}, {'wooden_pickaxe': 1, 'ingot': 3}),
+    ({'wood': 2, 'coal': 1}, {'ingot': 2}),
+]
+
+
+def cost(initial, goal, **options):
+    plan = Planner.from_crafting(Crafting, heuristic='relaxed', **options).plan(initial, goal, 20)
+    assert plan is not None
+    return plan_cost(plan, Crafting['Recipes'])
+
+
+@pytest.mark.parametrize('initial, goal', HELD)
+def test_macros_use_held_intermediates(initial, goal):
+    assert cost(initial, goal, macros=True) == cost(initial, goal, macros=False, skip_dominated=False)
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from loader import load_crafting
+from plan_cache import plan_cost
+from planner import Planner
+
+Crafting = load_crafting(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Crafting.json'), directory=None)
+
+#problems starting out with stock the plan uses up before it has to make more of it
+HELD = [
+    ({'plank': 8}, {'stone_axe': 1}),
+    ({'plank': 2, 'stick': 4}, {'furnace': 1, 'iron_axe': 1}),
+    ({'coal': 6, 'cobble': 5, 'bench': 1}, {'ingot': 1}),
+    ({'cobble': 3, 'coal': 5, 'bench': 1}, {'furnace': 1}),
+]
+
+
+def cheapest(initial, goal):
+    plan = Planner.from_crafting(Crafting, heuristic='relaxed', macros=False, skip_dominated=False).plan(initial, goal)
+    return plan_cost(plan, Crafting['Recipes'])
+
+
+@pytest.mark.parametrize('initial, goal', HELD)
+@pytest.mark.parametrize('limits', [True, False])
+def test_regression_from_held_stock(initial, goal, limits):
+    plan = Planner.from_crafting(Crafting, search='regression', macros=False, limits=limits).plan(initial, goal, 20)
+    assert plan is not None
+    assert plan_cost(plan, Crafting['Recipes']) == cheapest(initial, goal)
+
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from loader import load_crafting
+from plan_cache import plan_cost
+from planner import Planner
+from replanner import Replanner
+from test_regression import HELD, cheapest
+
+Crafting = load_crafting(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Crafting.json'), directory=None)
+
+
+@pytest.mark.parametrize('initial, goal', HELD)
+def test_replanner_from_held_stock(initial, goal):
+    replanner = Replanner(Planner.from_crafting(Crafting, search='regression', macros=False))
+    plan = replanner.plan(initial, goal, 20)
+    assert plan is not None
+    assert plan_cost(plan, Crafting['Recipes']) == cheapest(initial, goal)
+
+
+def test_replanner_after_losing_stock():
+    # Plans from held stock, then replans after a stick is lost partway through
+    replanner = Replanner(Planner.from_crafting(Crafting, search='regression', macros=False))
+    plan = replanner.plan({'plank': 8}, {'stone_axe': 1}, 20)
+    for position, (state, action) in enumerate(plan):
+        if state['stick']:
+            break
+    counts = list(state.counts)
+    counts[state.layout.index['stick']] -= 1
+    current = state.with_counts(tuple(counts))
+    replanned = replanner.plan(current, deadline=20)
+    assert replanned is not None
+    assert replanned[-1][0]['stone_axe'] == 1
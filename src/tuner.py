@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import random
+import sys
+from math import exp, log
+from multiprocessing import get_context
+from threading import Lock
+from timeit import default_timer as time
+
+import craft_planner
+import craft_planner_modified
+from benchmark import CORPUS
+from loader import load_crafting
+from plan_cache import plan_cost
+from planner import Planner
+
+# Tunes the hand-picked constants of the 'priority' and 'hand_tuned' heuristics (craft_planner.HEURISTIC_WEIGHTS and
+# craft_planner_modified.WEIGHTS) against a corpus of problems, instead of by trial and error on one goal. A candidate
+# is a dict of weights, handed to the Planner as heuristic_weights, and it is scored on each problem it is run on by
+# plan cost, compute time and states visited (see SCORING). Every (candidate, problem) run happens in a process pool.
+#
+# Problems are grouped into goal families by the items their goal asks for, since the constants were picked per goal
+# (the branches of craft_planner_modified.make_heuristic are chosen the same way), and each family gets its own best
+# weights. Candidates are searched in log space, since the weights run from 10 to 5000000000:
+#   random      weights drawn around the defaults, each scaled by up to e**spread either way
+#   grid        one weight at a time, scaled by each of GRID_FACTORS
+#   evolve      a simple evolution strategy: each generation draws candidates around the mean of the best ones so
+#               far, and the spread shrinks when a generation finds nothing better (CMA-ES without the covariance)
+#
+#   python tuner.py --heuristic hand_tuned --method evolve --budget 48
+#
+# adds {heuristic: {family: weights}} to TUNED (or --output), which load_tuned reads back for a goal. A Planner with
+# no heuristic_weights of its own plans with the weights in TUNED for its goal's family, if there are any.
+
+#the heuristics that can be tuned, with the Planner options they are run with (as in portfolio.DEFAULT_CONFIGS)
+TUNABLE = {
+    'priority': ({'heuristic': 'priority', 'macros': True, 'skip_dominated': True}, craft_planner.HEURISTIC_WEIGHTS),
+    'hand_tuned': ({'heuristic': 'hand_tuned', 'macros': False, 'skip_dominated': False},
+                   craft_planner_modified.WEIGHTS),
+}
+
+#a run scores its plan cost plus these per second and per state visited. A run that finds no plan scores FAILED
+SCORING = {'time': 10, 'states': 0.001}
+FAILED = 1e6
+#a candidate only replaces the best so far if it scores this much (as a fraction) lower, so timing noise alone
+#doesn't pick new weights
+TOLERANCE = 0.01
+
+GRID_FACTORS = (0.1, 0.5, 2, 10)
+
+#where tuner.py's main stores the best weights, and where Planner looks for them
+TUNED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tuned_weights.json')
+
+_tuned = {}                 #path -> (modification time, {heuristic: {family: weights}})
+_tuned_lock = Lock()
+
+
+def family(goal):
+    # The goal family of a goal: the items it asks for, in order, e.g. 'cart+rail'
+    return '+'.join(sorted(goal))
+
+
+def silence():
+    #the searches print as they go, which would only interleave between workers
+    sys.stdout = open(os.devnull, 'w')
+
+
+def run_problem(task):
+    # Runs one candidate on one problem, in a pool worker. task is (Crafting, options, weights, problem, limit)
+    Crafting, options, weights, problem, limit = task
+    stats = {}
+    start_time = time()
+    planner = Planner.from_crafting(Crafting, heuristic_weights=weights, **options)
+    plan = planner.plan(problem['Initial'], problem['Goal'], limit, stats=stats)
+    return {'time': time() - start_time, 'states': stats.get('states'),
+            'cost': plan_cost(plan, Crafting['Recipes']) if plan else None}
+
+
+def score(results, scoring=SCORING):
+    # The total score of a candidate's runs, lower is better
+    total = 0
+    for result in results:
+        if result['cost'] is None:
+            total += FAILED
+        else:
+            total += result['cost'] + scoring['time'] * result['time'] + scoring['states'] * (result['states'] or 0)
+    return total
+
+
+def evaluate(pool, Crafting, options, candidates, families, limit):
+    # Scores each (family, weights) candidate on every problem of its family, all in one go over the pool. Returns a
+    # (score, results) pair for each candidate
+    tasks = []
+    for name, weights in candidates:
+        tasks.extend((Crafting, options, weights, problem, limit) for problem in families[name])
+    results = pool.map(run_problem, tasks)
+    scored = []
+    for name, weights in candidates:
+        count = len(families[name])
+        scored.append((score(results[:count]), results[:count]))
+        results = results[count:]
+    return scored
+
+
+def rounded(weights):
+    #three significant figures are plenty for weights found by a noisy search, and keep whole numbers whole
+    return dict((key, int(round(value)) if abs(value) >= 100 else float('%.3g' % value))
+                for key, value in weights.items())
+
+
+def scaled(center, spread, rng):
+    # Weights drawn around center (weights in log space), each moved by a normal step of the given spread
+    return rounded(dict((key, exp(value + rng.gauss(0, spread))) for key, value in center.items()))
+
+
+def to_logs(weights):
+    return dict((key, log(value)) for key, value in weights.items())
+
+
+def grid(defaults):
+    # Every weight scaled by each of GRID_FACTORS, one at a time. The candidates go round every weight for each
+    # factor, the factors nearest 1 first, so a budget short of the whole grid still tries every weight
+    factors = sorted(GRID_FACTORS, key=lambda factor: abs(log(factor)))
+    return [rounded(dict(defaults, **{key: defaults[key] * factor})) for factor in factors
+            for key in sorted(defaults)]
+
+
+def tune(Crafting, heuristic='hand_tuned', method='evolve', budget=32, problems=CORPUS, limit=5, workers=None,
+         population=8, spread=1.0, seed=0, report=None):
+    # Tunes a heuristic's weights for each goal family of problems, trying up to budget candidates per family on
+    # top of the defaults. Returns {family: {'weights', 'score', 'default_score', 'results'}}, with the defaults
+    # kept when nothing beats them. report, if given, is called with (family, weights, score) for each new best
+    options, defaults = TUNABLE[heuristic]
+    defaults = dict(defaults)
+    rng = random.Random(seed)
+    families = {}
+    for problem in problems:
+        families.setdefault(family(problem['Goal']), []).append(problem)
+    best = {}
+    context = get_context('spawn')
+    pool = context.Pool(workers, initializer=silence)
+    try:
+        def consider(candidates):
+            # Scores candidates and keeps any that beat their family's best by more than the noise in timing.
+            # Returns the (family, weights, score) of each candidate and the families that got a new best
+            scored = evaluate(pool, Crafting, options, candidates, families, limit)
+            improved = set()
+            for (name, weights), (total, results) in zip(candidates, scored):
+                if name not in best or total < best[name]['score'] * (1 - TOLERANCE):
+                    best[name] = dict(best.get(name, {}), weights=weights, score=total, results=results)
+                    improved.add(name)
+                    if report is not None:
+                        report(name, weights, total)
+            return [(name, weights, total) for (name, weights), (total, results) in zip(candidates, scored)], improved
+
+        consider([(name, defaults) for name in families])
+        for name in families:
+            best[name]['default_score'] = best[name]['score']
+
+        if method == 'grid':
+            candidates = grid(defaults)
+            if len(candidates) > budget:
+                print('Only trying %d of the %d grid candidates (see --budget)' % (budget, len(candidates)))
+                candidates = candidates[:budget]
+            consider([(name, weights) for name in families for weights in candidates])
+        elif method == 'random':
+            center = to_logs(defaults)
+            consider([(name, scaled(center, spread, rng)) for name in families for _ in range(budget)])
+        elif method == 'evolve':
+            #the mean and spread of each family's search, and the best few candidates it has seen
+            means = dict((name, to_logs(defaults)) for name in families)
+            spreads = dict((name, spread) for name in families)
+            elite = dict((name, [(best[name]['score'], defaults)]) for name in families)
+            used = 0
+            while used < budget:
+                size = min(population, budget - used)
+                candidates = [(name, scaled(means[name], spreads[name], rng)) for name in families
+                              for _ in range(size)]
+                scored, improved = consider(candidates)
+                used += size
+                for name, weights, total in scored:
+                    elite[name].append((total, weights))
+                for name in families:
+                    elite[name] = sorted(elite[name], key=lambda entry: entry[0])[:max(population // 2, 1)]
+                    logs = [to_logs(weights) for total, weights in elite[name]]
+                    means[name] = dict((key, sum(entry[key] for entry in logs) / len(logs)) for key in defaults)
+                    #a 1/5th-success style rule: widen the search while it keeps finding better weights
+                    spreads[name] *= 1.5 if name in improved else 0.7
+        else:
+            raise ValueError('unknown method ' + repr(method))
+    finally:
+        pool.close()
+        pool.join()
+    return best
+
+
+def load_tuned(path, heuristic, goal):
+    # The weights stored by tuner.py's main for a heuristic and the family of goal, or None if there are none. The
+    # file is only read again once it changes
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _tuned_lock:
+        cached = _tuned.get(path)
+    if cached is None or cached[0] != modified:
+        with open(path) as f:
+            cached = (modified, json.load(f))
+        with _tuned_lock:
+            _tuned[path] = cached
+    return cached[1].get(heuristic, {}).get(family(goal))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune heuristic weights over a corpus of problems.')
+    parser.add_argument('--recipes', default='Crafting.json', help='crafting file with the Items and Recipes')
+    parser.add_argument('--heuristic', default='hand_tuned', choices=sorted(TUNABLE))
+    parser.add_argument('--method', default='evolve', choices=['random', 'grid', 'evolve'])
+    parser.add_argument('--budget', type=int, default=32, help='candidates tried per goal family')
+    parser.add_argument('--problems', nargs='*', default=[problem['name'] for problem in CORPUS],
+                        help='problems from the benchmark corpus to tune on')
+    parser.add_argument('--limit', type=float, default=5, help='seconds allowed per run')
+    parser.add_argument('--workers', type=int, default=None, help='processes in the pool (default: one per CPU)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=TUNED, help='JSON file the best weights are added to (default: the one '
+                                                        'Planner reads them from)')
+    args = parser.parse_args()
+
+    Crafting = load_crafting(args.recipes)
+
+    def report(name, weights, total):
+        print('%-24s %14.1f' % (name, total))
+        sys.stdout.flush()
+
+    start_time = time()
+    problems = [problem for problem in CORPUS if problem['name'] in args.problems]
+    best = tune(Crafting, args.heuristic, args.method, args.budget, problems, args.limit, args.workers,
+                seed=args.seed, report=report)
+    print('')
+    print('%-24s %14s %14s' % ('family', 'default', 'tuned'))
+    for name in sorted(best):
+        print('%-24s %14.1f %14.1f' % (name, best[name]['default_score'], best[name]['score']))
+    print('Compute Time: ' + str(time() - start_time))
+    if args.output:
+        tuned = {}
+        if os.path.exists(args.output):
+            with open(args.output) as f:
+                tuned = json.load(f)
+        tuned.setdefault(args.heuristic, {}).update((name, best[name]['weights']) for name in best)
+        with open(args.output, 'w') as f:
+            json.dump(tuned, f, indent=1, sort_keys=True)
+        print('Weights written to', args.output)